@@ -1,24 +1,66 @@
+import contextlib
+import fnmatch
+import hashlib
 import os
 import random
 import re
+import shutil
 import stat
 import subprocess
+import tarfile
+import threading
 import time
-from typing import List, Tuple, Iterable, Dict
+from typing import ContextManager, IO, List, Tuple, Iterable, Iterator, Dict, Optional, Sequence, Set
 
 from loguru import logger
 
+from .exclude_matcher import ExcludeMatcher
 from .glob_like import GlobLike
-from .my_stdout import Stdout
+from .listing_store import ListingStore
+from .mutation_queue import EXISTS_CHECK, MISSING_CHECK, NOT_DIR_CHECK, FullCheck, MutationQueue
+from .my_stdout import ReadLines, Stdout
 from .os_like import OSLike
+from .shell_session import CommandKind, ShellSession
+from .sync_metrics import SyncMetrics
 
 
 class AdbFileSystem(GlobLike, OSLike):
     """Mimics os's file interface but uses the adb utility."""
 
-    def __init__(self, adb: List[bytes]) -> None:
-        self.stat_cache = {}  # type: Dict[bytes, os.stat_result]
+    def __init__(self, adb: List[bytes], stat_backend: Optional[bool] = None,
+                 metrics: Optional[SyncMetrics] = None) -> None:
+        """Creates the file system.
+
+        Args:
+          adb: Command line to invoke adb with.
+          stat_backend: Whether to list with 'stat -c' instead of parsing
+            'ls -l'; detected on first use if None.
+          metrics: Where to account adb invocations; a new SyncMetrics if None.
+        """
+        self.stat_backend = stat_backend
+        self.metrics = SyncMetrics() if metrics is None else metrics
+        self.stat_cache = ListingStore()
+        self.listdir_cache = {}  # type: Dict[bytes, List[bytes]]
         self.adb = adb
+        self.shell = ShellSession(adb, self.metrics)
+        # Sessions besides shell, started for listdir() calls on several threads.
+        self.shells_lock = threading.Lock()
+        self.extra_shells = []  # type: List[ShellSession]
+        self.idle_shells = []  # type: List[ShellSession]
+        self._shell_lent = False
+        # Held while using stat_cache, which listings on several threads fill.
+        self.stat_cache_lock = threading.Lock()
+        self.mutations = MutationQueue()
+        self.mutations_lock = threading.RLock()
+        # Failed mutations of the current batch flushed before its end.
+        self.batch_failures = []  # type: List[Tuple[bytes, bytes]]
+        self._batch_depth = 0
+        self._arg_max = None  # type: Optional[int]
+        self._serial = None  # type: Optional[str]
+        self._tree_listing = None  # type: Optional[Iterator[bytes]]
+        self._find_newer = None  # type: Optional[bool]
+        # Directories listed by a filtered tree listing, until listdir() is done with them.
+        self.filtered_dirs = set()  # type: Set[bytes]
 
     # Regarding parsing stat results, we only care for the following fields:
     # - st_size
@@ -107,6 +149,38 @@ class AdbFileSystem(GlobLike, OSLike):
                 time.strptime(
                     match.group('st_mtime').decode('ascii'), '%Y-%m-%d %H:%M')))
 
+        filename = groups['filename']
+        return self.MakeStat(st_mode, st_size, st_mtime), filename
+
+    # Output format for 'stat -c': size, mtime in seconds, raw mode in hex, path.
+    STAT_FORMAT = b'%s %Y %f %n'
+
+    @classmethod
+    def StatLineToStat(cls, line: bytes) -> Tuple[os.stat_result, bytes]:
+        """Convert a line of 'stat -c STAT_FORMAT' output to a stat result.
+
+        Unlike 'ls -l', this gives mtimes to the second, and is parsed with a
+        single split.
+
+        Args:
+          line: Output line of 'stat -c STAT_FORMAT' on Android.
+
+        Returns:
+          os.stat_result for the line, and the path as printed.
+
+        Raises:
+          OSError: if the given string is not a 'stat -c' output line (but maybe
+          an error message instead).
+        """
+        try:
+            st_size, st_mtime, st_mode, path = line.split(b' ', 3)
+            return cls.MakeStat(int(st_mode, 16), int(st_size), int(st_mtime)), path
+        except ValueError:
+            raise OSError('Unparseable stat result.')
+
+    @staticmethod
+    def MakeStat(st_mode: int, st_size: Optional[int], st_mtime: int) -> os.stat_result:
+        """Builds a stat result from the fields we care for."""
         # Fill the rest with dummy values.
         st_ino = 1
         st_rdev = 0
@@ -115,10 +189,8 @@ class AdbFileSystem(GlobLike, OSLike):
         st_gid = -2  # Nobody.
         st_atime = st_ctime = st_mtime
 
-        stbuf = os.stat_result((st_mode, st_ino, st_rdev, st_nlink, st_uid, st_gid,
-                                st_size, st_atime, st_mtime, st_ctime))
-        filename = groups['filename']
-        return stbuf, filename
+        return os.stat_result((st_mode, st_ino, st_rdev, st_nlink, st_uid, st_gid,
+                               st_size, st_atime, st_mtime, st_ctime))
 
     def QuoteArgument(self, arg: bytes) -> bytes:
         # Quotes an argument for use by adb shell.
@@ -147,114 +219,832 @@ class AdbFileSystem(GlobLike, OSLike):
                 b'(', s.encode('utf-8')
             ]
         for test_string in test_strings:
-            good = False
-            with Stdout(self.adb +
-                        [b'shell',
-                         b'date +%s' % (self.QuoteArgument(test_string),)]) as stdout:
-                for line in stdout:
-                    line = line.rstrip(b'\r\n')
-                    if line == test_string:
-                        good = True
-            if not good:
+            try:
+                lines = self._ShellLines(
+                    b'date +%s' % (self.QuoteArgument(test_string),))
+            except OSError:
+                return False
+            if test_string not in lines:
                 return False
         return True
 
+    def UsesStat(self) -> bool:
+        """Tells whether listings use 'stat -c' rather than parsing 'ls -l'."""
+        if self.stat_backend is None:
+            status, output = self.shell.Run(self._FindStat([b'/'], b'-maxdepth 0'))
+            try:
+                self.stat_backend = status == 0 and self.StatLineToStat(
+                    output.split(b'\n')[0].rstrip(b'\r'))[1].startswith(b'/')
+            except OSError:
+                self.stat_backend = False
+            logger.info('Listing with {}.', 'stat' if self.stat_backend else 'ls')
+        return self.stat_backend
+
+    def MtimePrecision(self) -> int:
+        """Returns the resolution in seconds of the mtimes listings report."""
+        return 1 if self.UsesStat() else 60
+
+    def SupportsNewer(self) -> bool:
+        """Tells whether the device's 'find' takes '-newermt @SECONDS'."""
+        if self._find_newer is None:
+            status, output = self.shell.Run(b'find / -maxdepth 0 -newermt @0')
+            self._find_newer = status == 0 and output.strip() == b'/'
+        return self._find_newer
+
+    def FindPredicates(self, root: bytes, excludes: Optional[ExcludeMatcher],
+                       time_range: Optional[Sequence[Optional[int]]]) -> bytes:
+        """Returns 'find' predicates leaving out what a walk would skip anyway.
+
+        Excluded names are pruned, and files whose mtimes are out of range are
+        left out; directories are always kept. Only what the device tells
+        apart exactly like the host does is filtered, so the result holds
+        everything the walk keeps, and possibly more.
+
+        Args:
+          root: Where 'find' starts, which is never pruned.
+          excludes: Matcher whose find_names are pruned.
+          time_range: Inclusive range of the mtimes of files to keep.
+
+        Returns:
+          Predicates for _FindStat(); empty if nothing can be filtered.
+        """
+        predicates = []  # type: List[bytes]
+        root_name = self._NormalizeDir(root).rsplit(b'/', 1)[-1]
+        names = [name for name in (excludes.find_names if excludes is not None else [])
+                 if not fnmatch.fnmatchcase(root_name, name)]
+        if names:
+            predicates.append(b'\\( %s \\) -prune -o' % (
+                b' -o '.join(b'-name %s' % (self.QuoteArgument(name),) for name in names),))
+        newer = []  # type: List[bytes]
+        if time_range is not None and self.SupportsNewer():
+            # A second wider on both ends, as the device may have fractions of
+            # seconds that the host truncates.
+            if time_range[0] is not None:
+                newer.append(b'-newermt @%d' % (int(time_range[0]) - 1,))
+            if time_range[1] is not None:
+                newer.append(b'! -newermt @%d' % (int(time_range[1]) + 1,))
+        if not names and not newer:
+            return b''
+        # Symlinks count as files, as the walk does not follow them.
+        predicates.append(b'\\( -type d -o \\( -type f -o -type l \\) %s \\)' % (b' '.join(newer),))
+        return b' '.join(predicates)
+
+    def _FindStat(self, paths: List[bytes], options: bytes) -> bytes:
+        """Returns a command printing 'stat -c STAT_FORMAT' lines found below paths."""
+        return b"find %s %s -exec stat -c '%s' {} +" % (
+            b' '.join(self.QuoteArgument(path + b'/') for path in paths),
+            options, self.STAT_FORMAT)
+
+    def _FindStatTree(self, root: bytes, predicates: bytes) -> bytes:
+        """Returns a command listing a tree with 'stat -c STAT_FORMAT' lines.
+
+        Like 'ls -alR', it prints every directory as a section of its own: a
+        'path:' header, a line per entry, and an empty line. Directories come
+        in the order 'find' meets them, so the root's section is complete
+        after its first few lines, while 'find -exec stat' on the whole tree
+        prints the root's last entry only at its very end.
+        """
+        return (b"find %s %s -type d -print | while IFS= read -r d; do printf '%%s:\\n' \"$d\"; "
+                b"find \"$d\" -mindepth 1 -maxdepth 1 %s -exec stat -c '%s' {} +; echo; done") % (
+                    self.QuoteArgument(root + b'/'), predicates, predicates, self.STAT_FORMAT)
+
+    def _Stream(self, service: bytes, command: bytes, check: bool = True) -> ContextManager[IO[bytes]]:
+        """Runs a device command, streaming its output.
+
+        Args:
+          service: b'shell' or b'exec-out', which does not mangle binary output.
+          command: Shell command line, quoted as for 'adb shell'.
+          check: Whether a failure of the command should raise OSError when the
+            block ends.
+
+        Returns:
+          A context manager giving the output stream.
+        """
+        return Stdout(self.adb + [service, command], check=check)
+
+    def Close(self) -> None:
+        """Stops the shell session and any running tree listing."""
+        self.FinishTreeListing()
+        self.shell.Close()
+        with self.shells_lock:
+            shells, self.extra_shells, self.idle_shells = self.extra_shells, [], []
+        for shell in shells:
+            shell.Close()
+
+    def _NewShell(self) -> ShellSession:
+        """Creates another shell session to the device."""
+        return ShellSession(self.adb, self.metrics)
+
+    @contextlib.contextmanager
+    def _ListingShell(self) -> Iterator[ShellSession]:
+        """Lends shell, or another session while a listing holds it.
+
+        Lets listings on several threads run at once; a new session is started
+        when all are lent. Other commands keep to shell.
+        """
+        with self.shells_lock:
+            if not self._shell_lent:
+                self._shell_lent = True
+                shell = self.shell
+            else:
+                shell = self.idle_shells.pop() if self.idle_shells else None
+        if shell is None:
+            shell = self._NewShell()
+            with self.shells_lock:
+                self.extra_shells.append(shell)
+        try:
+            yield shell
+        finally:
+            with self.shells_lock:
+                if shell is self.shell:
+                    self._shell_lent = False
+                else:
+                    self.idle_shells.append(shell)
+
+    def _Shell(self, command: bytes) -> int:
+        """Runs a command in the shell session, returning its exit status."""
+        status, _ = self.shell.Run(command)
+        return status
+
+    def _ShellLines(self, command: bytes) -> List[bytes]:
+        """Runs a command in the shell session, returning its output lines.
+
+        Raises:
+          OSError: if the command exited with nonzero status.
+        """
+        status, output = self.shell.Run(command)
+        if output.endswith(b'\n'):
+            output = output[:-1]
+        lines = [line.rstrip(b'\r') for line in output.split(b'\n')] if output else []
+        if status != 0:
+            raise OSError('Subprocess exited with nonzero status.')
+        return lines
+
+    def PrefetchTree(self, path: bytes, excludes: Optional[ExcludeMatcher] = None,
+                     time_range: Optional[Sequence[Optional[int]]] = None) -> None:
+        """Starts listing a whole directory tree with a single 'ls -alR'.
+
+        The output is parsed lazily: listdir() reads ahead in the stream until
+        the requested directory has been listed, so walking the tree costs one
+        process instead of one per directory. Directories the stream does not
+        cover fall back to a regular 'ls -al'.
+
+        Args:
+          path: Root of the tree, spelled the same way as later listdir() calls.
+          excludes: Names to leave out of the listing; see FindPredicates().
+          time_range: Range of file mtimes to list; see FindPredicates().
+            Directories listed with a filter are reported by ListedFiltered().
+        """
+        self.FinishTreeListing()
+        predicates = self.FindPredicates(path, excludes, time_range) if self.UsesStat() else b''
+        self._tree_listing = self._ParseTreeListing(path, predicates)
+
+    def FinishTreeListing(self) -> None:
+        """Stops reading a tree listing started by PrefetchTree()."""
+        if self._tree_listing is not None:
+            self._tree_listing.close()
+            self._tree_listing = None
+        self.listdir_cache.clear()
+        self.filtered_dirs.clear()
+
+    @staticmethod
+    def _NormalizeDir(path: bytes) -> bytes:
+        path = re.sub(b'/+', b'/', path)
+        return path.rstrip(b'/') or b'/'
+
+    def RebasePath(self, root: bytes, path: bytes) -> bytes:
+        """Spells a path printed by the device relative to root as the caller does.
+
+        Args:
+          root: Directory as passed by the caller, e.g. with a trailing slash.
+          path: Path below root as printed by a device command.
+        """
+        norm_root = self._NormalizeDir(root)
+        path = self._NormalizeDir(path)
+        if path == norm_root:
+            return root
+        if path.startswith(norm_root + b'/'):
+            return root + path[len(norm_root):]
+        logger.warning('Unexpected directory in listing: {}.', path)
+        return path
+
+    def ParseListing(self, lines: Iterable[bytes], root: bytes,
+                     directory: Optional[bytes] = None) -> Iterator[Tuple[bytes, List[bytes]]]:
+        """Parses 'ls -al' output for one or more directories into stat_cache.
+
+        Args:
+          lines: Output lines; directories other than the first are introduced by
+            a 'path:' header, as printed by 'ls -alR' or 'ls -al dir1 dir2'.
+          root: Directory all listed paths are below.
+          directory: Directory of a leading section without header; root if None.
+
+        Yields:
+          (directory, names) as soon as the listing of a directory is complete.
+        """
+        if directory is None:
+            directory = root
+        entries = []  # type: List[Tuple[bytes, os.stat_result]]
+        started = False
+        expect_header = True
+        for line in lines:
+            line = line.rstrip(b'\r\n')
+            if not line:
+                expect_header = True
+                continue
+            if expect_header and line.endswith(b':'):
+                if started:
+                    yield self._Listed(directory, entries)
+                directory = self.RebasePath(root, line[:-1])
+                entries = []
+                started = True
+                expect_header = False
+                continue
+            started = True
+            expect_header = False
+            if line.startswith(b'total '):
+                continue
+            try:
+                statdata, filename = self.LsToStat(line)
+            except OSError:
+                continue
+            if filename is None:
+                logger.error('Could not parse {}.', line)
+            elif filename != b'.' and filename != b'..':
+                entries.append((filename, statdata))
+        if started:
+            yield self._Listed(directory, entries)
+
+    def _Listed(self, directory: bytes, entries: List[Tuple[bytes, os.stat_result]]
+                ) -> Tuple[bytes, List[bytes]]:
+        """Stores the complete listing of a directory, returning its names."""
+        with self.stat_cache_lock:
+            self.stat_cache.SetDir(directory, entries)
+        return directory, [name for name, _ in entries]
+
+    def ParseStatTree(self, lines: Iterable[bytes], root: bytes) -> Iterator[Tuple[bytes, List[bytes]]]:
+        """Parses _FindStatTree() output into stat_cache.
+
+        Args:
+          lines: Output lines, in sections of a 'path:' header, 'stat -c' lines
+            and an empty line.
+          root: Directory all listed paths are below.
+
+        Yields:
+          (directory, names) as soon as the section of a directory has ended.
+        """
+        directory = None  # type: Optional[bytes]
+        entries = []  # type: List[Tuple[bytes, os.stat_result]]
+        for line in lines:
+            line = line.rstrip(b'\r\n')
+            if not line:
+                if directory is not None:
+                    yield self._Listed(directory, entries)
+                directory = None
+            elif directory is None:
+                if line.endswith(b':'):
+                    directory = self.RebasePath(root, line[:-1])
+                    entries = []
+            else:
+                try:
+                    statdata, path = self.StatLineToStat(line)
+                except OSError:
+                    continue
+                entries.append((path[path.rfind(b'/') + 1:], statdata))
+        # A section without its empty line was cut short, and is left out.
+
+    def ParseStatListing(self, lines: Iterable[bytes], root: bytes,
+                         dirs: Optional[Iterable[bytes]] = None
+                         ) -> Iterator[Tuple[bytes, List[bytes]]]:
+        """Parses 'find ... -exec stat' output for one or more directories into stat_cache.
+
+        Args:
+          lines: Output lines in the order 'find' prints them, each directory
+            before its contents.
+          root: Directory all listed paths are below.
+          dirs: Directories whose contents the output lists; every directory in
+            the output if None.
+
+        Yields:
+          (directory, names) as soon as the listing of a directory is complete.
+        """
+        if dirs is not None:
+            dirs = set(self._NormalizeDir(d) for d in dirs)
+        # Directories being listed, innermost last: (path as printed without
+        # trailing slash, path as spelled by the caller, entries).
+        stack = []  # type: List[Tuple[bytes, bytes, List[Tuple[bytes, os.stat_result]]]]
+        for line in lines:
+            try:
+                statdata, path = self.StatLineToStat(line.rstrip(b'\r\n'))
+            except OSError:
+                continue
+            if b'//' in path or path.endswith(b'/'):
+                path = self._NormalizeDir(path)
+            while stack and not path.startswith(stack[-1][0] + b'/'):
+                _, directory, entries = stack.pop()
+                yield self._Listed(directory, entries)
+            if dirs is None:
+                listed = stat.S_ISDIR(statdata.st_mode)
+            else:
+                listed = path in dirs
+            if stack:
+                name = path[len(stack[-1][0]) + 1:]
+                if b'/' in name:
+                    continue
+                directory = stack[-1][1] + b'/' + name
+                stack[-1][2].append((name, statdata))
+            elif listed:
+                directory = self.RebasePath(root, path)
+            else:
+                continue
+            if listed:
+                stack.append((path.rstrip(b'/'), directory, []))
+        while stack:
+            _, directory, entries = stack.pop()
+            yield self._Listed(directory, entries)
+
+    def ListTree(self, root: bytes, predicates: bytes = b'') -> Iterator[Tuple[bytes, List[bytes]]]:
+        """Lists a whole tree with a single command, filling stat_cache.
+
+        Args:
+          root: Root of the tree.
+          predicates: From FindPredicates(), to list only part of the tree;
+            requires UsesStat().
+
+        Yields:
+          (directory, names) as soon as the listing of a directory is complete;
+          directories are spelled relative to root as the caller does.
+        """
+        if self.UsesStat():
+            command = self._FindStatTree(root, predicates)
+        else:
+            command = b'ls -alR %s' % (self.QuoteArgument(root + b'/'),)
+        with self.metrics.Call('shell stream ' + CommandKind(command)), \
+                self._Stream(b'shell', command, check=False) as stdout:
+            if self.UsesStat():
+                yield from self.ParseStatTree(ReadLines(stdout), root)
+            else:
+                yield from self.ParseListing(ReadLines(stdout), root)
+
+    def _ParseTreeListing(self, root: bytes, predicates: bytes) -> Iterator[bytes]:
+        """Feeds ListTree() output into listdir_cache, yielding each directory."""
+        for directory, names in self.ListTree(root, predicates):
+            self.listdir_cache[directory] = names
+            if predicates:
+                self.filtered_dirs.add(directory)
+            yield directory
+
+    def ListedFiltered(self, path: bytes) -> bool:
+        """Tells whether the last listing of a directory may have left entries out.
+
+        The listing then lacks what the filters of PrefetchTree() caught,
+        with no record of it. Call once, after listdir().
+        """
+        if path in self.filtered_dirs:
+            self.filtered_dirs.discard(path)
+            return True
+        return False
+
+    def ListDirs(self, root: bytes, dirs: List[bytes]) -> Iterator[Tuple[bytes, List[bytes]]]:
+        """Lists several directories below root with few commands, filling stat_cache.
+
+        Yields:
+          (directory, names) for each directory that could be listed.
+        """
+        for chunk in self._Chunks(dirs):
+            if self.UsesStat():
+                _, output = self.shell.Run(self._FindStat(chunk, b'-maxdepth 1'))
+                yield from self.ParseStatListing(output.split(b'\n'), root, chunk)
+                continue
+            _, output = self.shell.Run(b'ls -al %s' % (
+                b' '.join(self.QuoteArgument(d + b'/') for d in chunk),))
+            yield from self.ParseListing(output.split(b'\n'), root,
+                                         chunk[0] if len(chunk) == 1 else None)
+
+    def StatMany(self, paths: List[bytes]) -> Dict[bytes, os.stat_result]:
+        """Lstats several paths with few commands, filling stat_cache.
+
+        Returns:
+          The stat results of all paths that exist; symlinks are left out when
+          parsing 'ls -l'.
+        """
+        results = {}  # type: Dict[bytes, os.stat_result]
+        to_stat = self.StatLineToStat if self.UsesStat() else self.LsToStat
+        command = b"stat -c '%s'" % (self.STAT_FORMAT,) if self.UsesStat() else b'ls -ald'
+        for chunk in self._Chunks(paths):
+            _, output = self.shell.Run(b'%s %s' % (
+                command, b' '.join(self.QuoteArgument(path) for path in chunk)))
+            for line in output.split(b'\n'):
+                line = line.rstrip(b'\r')
+                if not line:
+                    continue
+                try:
+                    statdata, filename = to_stat(line)
+                except OSError:
+                    continue
+                if filename is not None:
+                    with self.stat_cache_lock:
+                        self.stat_cache.Set(filename, statdata)
+                    results[filename] = statdata
+        return results
+
+    def _Chunks(self, paths: List[bytes]) -> Iterator[List[bytes]]:
+        """Splits paths into chunks that fit into one device command line."""
+        budget = self._ArgBudget()
+        chunk = []  # type: List[bytes]
+        size = 0
+        for path in paths:
+            if chunk and size + len(path) + 3 > budget:
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(path)
+            size += len(path) + 3
+        if chunk:
+            yield chunk
+
+    def SelectNames(self, path: bytes, *, file_type: Optional[int] = None,
+                    time_range: Optional[Sequence[Optional[int]]] = None) -> Optional[Set[bytes]]:
+        """Filters a directory listed before, without stat'ing each entry.
+
+        See ListingStore.Select().
+
+        Returns:
+          The names kept; None if path has not been listed.
+        """
+        with self.stat_cache_lock:
+            # Select() views the columns that listings append to.
+            names = self.stat_cache.Select(path, file_type=file_type, time_range=time_range)
+        return None if names is None else set(names)
+
+    def GetSerial(self) -> str:
+        """Returns the serial number of the device."""
+        if self._serial is None:
+            with self.metrics.Call('get-serialno'):
+                self._serial = subprocess.check_output(
+                    self.adb + [b'get-serialno']).decode('ascii', 'replace').strip()
+        return self._serial
+
+    def _ListFromTree(self, path: bytes) -> Optional[List[bytes]]:
+        """Returns the names in path from the running tree listing, if any."""
+        if path not in self.listdir_cache and self._tree_listing is not None:
+            for directory in self._tree_listing:
+                if directory == path:
+                    break
+            else:
+                self._tree_listing = None
+        return self.listdir_cache.pop(path, None)
+
     def listdir(self, path: bytes) -> Iterable[bytes]:  # os's name, so pylint: disable=g-bad-name
         """List the contents of a directory, caching them for later lstat calls."""
-        with Stdout(self.adb +
-                    [b'shell',
-                     b'ls -al %s' % (self.QuoteArgument(path + b'/'),)]) as stdout:
-            for line in stdout:
-                if line.startswith(b'total '):
-                    continue
-                line = line.rstrip(b'\r\n')
+        names = self._ListFromTree(path)
+        if names is not None:
+            yield from names
+            return
+        # The output is read completely before yielding anything, as the caller
+        # will issue further commands while iterating.
+        if self.UsesStat():
+            with self._ListingShell() as shell:
+                status, output = shell.Run(self._FindStat([path], b'-mindepth 1 -maxdepth 1'))
+            entries = []
+            for line in output.split(b'\n'):
                 try:
-                    statdata, filename = self.LsToStat(line)
+                    statdata, filename = self.StatLineToStat(line.rstrip(b'\r'))
                 except OSError:
                     continue
-                if filename is None:
-                    logger.error('Could not parse {}.', line)
-                else:
-                    self.stat_cache[path + b'/' + filename] = statdata
-                    yield filename
+                entries.append((filename[filename.rfind(b'/') + 1:], statdata))
+            yield from self._Listed(path, entries)[1]
+            if status != 0:
+                raise OSError('Subprocess exited with nonzero status.')
+            return
+        with self._ListingShell() as shell:
+            status, output = shell.Run(b'ls -al %s' % (self.QuoteArgument(path + b'/'),))
+        entries = []
+        for line in output.split(b'\n'):
+            if not line or line.startswith(b'total '):
+                continue
+            line = line.rstrip(b'\r')
+            try:
+                statdata, filename = self.LsToStat(line)
+            except OSError:
+                continue
+            if filename is None:
+                logger.error('Could not parse {}.', line)
+            else:
+                entries.append((filename, statdata))
+        yield from self._Listed(path, entries)[1]
+        if status != 0:
+            raise OSError('Subprocess exited with nonzero status.')
 
     def lstat(self, path: bytes) -> os.stat_result:  # os's name, so pylint: disable=g-bad-name
         """Stat a file."""
-        if path in self.stat_cache:
-            return self.stat_cache[path]
-        return self._stat_lstat(path, b'ls -ald %s')
+        with self.stat_cache_lock:
+            statdata = self.stat_cache.Get(path)
+        if statdata is not None:
+            return statdata
+        return self._stat_lstat(path, b'')
 
     def stat(self, path: bytes) -> os.stat_result:  # os's name, so pylint: disable=g-bad-name
         """Stat a file."""
-        if path in self.stat_cache and not stat.S_ISLNK(
-                self.stat_cache[path].st_mode):
-            return self.stat_cache[path]
-        return self._stat_lstat(path, b'ls -aldL %s')
+        with self.stat_cache_lock:
+            statdata = self.stat_cache.Get(path)
+        if statdata is not None and not stat.S_ISLNK(statdata.st_mode):
+            return statdata
+        return self._stat_lstat(path, b'L')
 
-    def _stat_lstat(self, path: bytes, ls_command: bytes):
+    def _stat_lstat(self, path: bytes, flags: bytes):
         """Stat or lstat a file."""
-        with Stdout(
-                self.adb +
-                [b'shell', ls_command % (self.QuoteArgument(path),)]) as stdout:
-            for line in stdout:
-                if line.startswith(b'total '):
-                    continue
-                line = line.rstrip(b'\r\n')
-                statdata, _ = self.LsToStat(line)
-                self.stat_cache[path] = statdata
-                return statdata
+        if self.UsesStat():
+            command = b"stat -%sc '%s' %s" % (flags, self.STAT_FORMAT, self.QuoteArgument(path))
+            to_stat = self.StatLineToStat
+        else:
+            command = b'ls -ald%s %s' % (flags, self.QuoteArgument(path))
+            to_stat = self.LsToStat
+        for line in self._ShellLines(command):
+            if not line or line.startswith(b'total '):
+                continue
+            statdata, _ = to_stat(line)
+            with self.stat_cache_lock:
+                self.stat_cache.Set(path, statdata)
+            return statdata
         raise OSError('No such file or directory')
 
-    def unlink(self, path: bytes) -> None:  # os's name, so pylint: disable=g-bad-name
-        """Delete a file."""
-        if subprocess.call(
-                self.adb + [b'shell', b'rm %s' % (self.QuoteArgument(path),)]) != 0:
-            raise OSError('unlink failed')
+    # Flush a batch early once this many mutations are queued.
+    MAX_QUEUED_MUTATIONS = 4096
+
+    @contextlib.contextmanager
+    def Batch(self) -> Iterator[None]:
+        """Queues unlink, rmdir, makedirs and utime calls until the block ends.
+
+        The queued mutations are then sent as a few multi-path commands. Errors
+        are not raised by the calls themselves, nor when mutations are flushed
+        early, but all together when the block ends.
+
+        Usage:
+          with adb.Batch():
+            adb.unlink(...)
+
+        Raises:
+          OSError: on leaving the block, if any queued mutation failed.
+        """
+        self._batch_depth += 1
+        try:
+            yield
+        except BaseException:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self._ReportFailures(self._BatchFailures())
+            raise
+        self._batch_depth -= 1
+        if not self._batch_depth:
+            failures = self._BatchFailures()
+            self._ReportFailures(failures)
+            if failures:
+                raise OSError('%d queued operations failed' % (len(failures),))
+
+    def _BatchFailures(self) -> List[Tuple[bytes, bytes]]:
+        """Flushes the batch, returning the failures of all its flushes."""
+        with self.mutations_lock:
+            failures = self.batch_failures + self.Flush()
+            self.batch_failures = []
+        return failures
+
+    def _FlushEarly(self) -> None:
+        """Runs the queued mutations now, keeping failures for the end of the batch."""
+        with self.mutations_lock:
+            self.batch_failures.extend(self.Flush())
+
+    def Flush(self) -> List[Tuple[bytes, bytes]]:
+        """Runs all queued mutations.
+
+        Returns:
+          (command, path) for every mutation that failed.
+        """
+        with self.mutations_lock:
+            if not self.mutations:
+                return []
+            return self.mutations.Flush(self.shell.Run, self.QuoteArgument,
+                                        self._ArgBudget())
 
-    def rmdir(self, path: bytes) -> None:  # os's name, so pylint: disable=g-bad-name
-        """Delete a directory."""
-        if subprocess.call(
-                self.adb +
-                [b'shell', b'rmdir %s' % (self.QuoteArgument(path),)]) != 0:
-            raise OSError('rmdir failed')
+    @staticmethod
+    def _ReportFailures(failures: List[Tuple[bytes, bytes]]) -> None:
+        for command, path in failures:
+            logger.error('{} failed: {}', command.decode(errors='replace'), path)
+
+    def _ArgBudget(self) -> int:
+        """Returns how many bytes of paths fit into one device command line."""
+        if self._arg_max is None:
+            self._arg_max = 131072
+            try:
+                lines = self._ShellLines(b'getconf ARG_MAX')
+                if lines and lines[0].isdigit():
+                    self._arg_max = int(lines[0])
+            except OSError:
+                pass
+        # Leave room for the environment and the command itself.
+        return min(self._arg_max // 2, 1 << 18)
+
+    def _Mutate(self, command: bytes, check: Optional[bytes], path: bytes,
+                error: str, precheck: Optional[bytes] = None) -> None:
+        """Runs or queues a mutation; see MutationQueue.Add()."""
+        if self._batch_depth:
+            with self.mutations_lock:
+                self.mutations.Add(command, check, path, precheck)
+                if len(self.mutations) >= self.MAX_QUEUED_MUTATIONS:
+                    self._FlushEarly()
+            return
+        # Fails exactly when the same operation in a batch would.
+        script = b'%s "$p" || ! { %s; }' % (command, FullCheck(command, check))
+        if precheck:
+            script = b'! { %s; } && { %s; }' % (precheck, script)
+        if self._Shell(b'p=%s; %s' % (self.QuoteArgument(path), script)) != 0:
+            raise OSError(error)
+
+    def unlink(self, path: bytes, missing_ok: bool = False) -> None:  # os's name, so pylint: disable=g-bad-name
+        """Delete a file.
+
+        Args:
+          path: File to delete.
+          missing_ok: Whether a file that is already gone counts as deleted.
+        """
+        self._Mutate(b'rm', EXISTS_CHECK, path, 'unlink failed', None if missing_ok else MISSING_CHECK)
+
+    def rmdir(self, path: bytes, missing_ok: bool = False) -> None:  # os's name, so pylint: disable=g-bad-name
+        """Delete a directory.
+
+        Args:
+          path: Directory to delete.
+          missing_ok: Whether a directory that is already gone counts as deleted.
+        """
+        self._Mutate(b'rmdir', EXISTS_CHECK, path, 'rmdir failed', None if missing_ok else MISSING_CHECK)
 
     def makedirs(self, path: bytes) -> None:  # os's name, so pylint: disable=g-bad-name
         """Create a directory."""
-        if subprocess.call(
-                self.adb +
-                [b'shell', b'mkdir -p %s' % (self.QuoteArgument(path),)]) != 0:
-            raise OSError('mkdir failed')
+        self._Mutate(b'mkdir -p', NOT_DIR_CHECK, path, 'mkdir failed')
 
     def utime(self, path: bytes, times: Tuple[float, float]) -> None:
         """Set the time of a file to a specified unix time."""
         atime, mtime = times
         timestr = time.strftime('%Y%m%d%H%M.%S',
                                 time.localtime(mtime)).encode('ascii')
-        if subprocess.call(
-                self.adb +
-                [b'shell',
-                 b'touch -mt %s %s' % (timestr, self.QuoteArgument(path))]) != 0:
-            raise OSError('touch failed')
+        self._Mutate(b'touch -mt %s' % (timestr,), None, path, 'touch failed')
         timestr = time.strftime('%Y%m%d%H%M.%S',
                                 time.localtime(atime)).encode('ascii')
-        if subprocess.call(
-                self.adb +
-                [b'shell',
-                 b'touch -at %s %s' % (timestr, self.QuoteArgument(path))]) != 0:
-            raise OSError('touch failed')
+        self._Mutate(b'touch -at %s' % (timestr,), None, path, 'touch failed')
 
     def glob(self, path: bytes) -> Iterable[bytes]:  # glob's name, so pylint: disable=g-bad-name
-        with Stdout(
-                self.adb +
-                [b'shell', b'for p in %s; do echo "$p"; done' % (path,)]) as stdout:
-            for line in stdout:
-                yield line.rstrip(b'\r\n')
+        for line in self._ShellLines(b'for p in %s; do echo "$p"; done' % (path,)):
+            yield line
 
     def Push(self, src: bytes, dst: bytes) -> None:
         """Push a file from the local file system to the Android device."""
-        if subprocess.call(self.adb + [b'push', src, dst]) != 0:
+        # Directories queued for creation must exist first, and files queued
+        # for deletion must not take the pushed file with them.
+        self._FlushEarly()
+        with self.metrics.Call('push'):
+            status = subprocess.call(self.adb + [b'push', src, dst])
+        if status != 0:
             raise OSError('push failed')
 
+    def PullMany(self, srcs: List[bytes], dst: bytes) -> None:
+        """Pull several files or directories with a single adb command.
+
+        Args:
+          srcs: Paths on the Android device.
+          dst: Existing local directory to pull them into or, for a single
+            remote directory, the local path to create for it.
+        """
+        with self.metrics.Call('pull'):
+            status = subprocess.call(self.adb + [b'pull'] + srcs + [dst])
+        if status != 0:
+            raise OSError('pull failed')
+
+    # A pull streams into its destination name plus this suffix, which is
+    # renamed once complete; what an interrupted pull left is resumed.
+    PART_SUFFIX = b'.meow.part'
+    # Resumed pulls restart at a multiple of this.
+    RESUME_BLOCK_SIZE = 1 << 16
+
+    def PullHashed(self, src: bytes, dst: bytes, size: Optional[int] = None) -> str:
+        """Pull a file by streaming it through 'adb exec-out', hashing on the way.
+
+        The file is written to dst + PART_SUFFIX, then renamed to dst. If such a
+        part file is left from an interrupted pull and its whole blocks match
+        the start of the file on the device, the pull resumes after them with
+        'dd skip='.
+
+        Args:
+          src: Path on the Android device.
+          dst: Path on the local file system.
+          size: Expected size of the file, if known.
+
+        Returns:
+          The hex MD5 digest of the file at dst.
+
+        Raises:
+          OSError: if the pull failed or the file did not have the expected size.
+        """
+        part = dst + self.PART_SUFFIX
+        offset, md5 = self._ResumeOffset(src, part, size)
+        command = b'dd if=%s bs=%d skip=%d 2>/dev/null' % (
+            self.QuoteArgument(src), self.RESUME_BLOCK_SIZE, offset // self.RESUME_BLOCK_SIZE)
+        with self.metrics.Call('exec-out dd'), self._Stream(b'exec-out', command) as stdout, \
+                open(part, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            while chunk := stdout.read(1 << 20):
+                md5.update(chunk)
+                f.write(chunk)
+            written = f.tell()
+        if size is not None and written != size:
+            raise OSError('pulled %d of %d bytes' % (written, size))
+        os.replace(part, dst)
+        return md5.hexdigest()
+
+    def _ResumeOffset(self, src: bytes, part: bytes, size: Optional[int]) -> Tuple[int, 'hashlib._Hash']:
+        """Checks how much of a part file left by an earlier pull can be kept.
+
+        Returns:
+          The offset to resume at, and an MD5 object fed with the data before it.
+        """
+        md5 = hashlib.md5()
+        try:
+            length = os.path.getsize(part)
+        except OSError:
+            return 0, md5
+        blocks = length // self.RESUME_BLOCK_SIZE
+        if blocks == 0 or (size is not None and length > size):
+            return 0, md5
+        offset = blocks * self.RESUME_BLOCK_SIZE
+        with open(part, 'rb') as f:
+            while chunk := f.read(min(1 << 20, offset - f.tell())):
+                md5.update(chunk)
+        # Reading the range again on the device is cheap next to sending it.
+        status, output = self.shell.Run(b'dd if=%s bs=%d count=%d 2>/dev/null | md5sum' % (
+            self.QuoteArgument(src), self.RESUME_BLOCK_SIZE, blocks))
+        if status != 0 or output[:32].decode('ascii', 'replace') != md5.hexdigest():
+            logger.info('Cannot resume {}, starting over.', part)
+            return 0, hashlib.md5()
+        logger.info('Resuming {} at {} bytes.', part, offset)
+        return offset, md5
+
+    def Md5Many(self, paths: List[bytes]) -> Dict[bytes, str]:
+        """Hashes remote files with 'md5sum' on the device, using few commands.
+
+        Returns:
+          The hex MD5 digest of every path that could be read.
+        """
+        digests = {}  # type: Dict[bytes, str]
+        for chunk in self._Chunks(paths):
+            _, output = self.shell.Run(b'md5sum %s' % (
+                b' '.join(self.QuoteArgument(path) for path in chunk),))
+            for line in output.split(b'\n'):
+                line = line.rstrip(b'\r')
+                # Names with special characters are escaped and marked with a
+                # leading backslash; leave them unverified.
+                if len(line) > 34 and line[32:34] == b'  ' and not line.startswith(b'\\'):
+                    digests[line[34:]] = line[:32].decode('ascii')
+        return digests
+
+    def PullTar(self, src: bytes, names: List[bytes], dst: bytes) -> None:
+        """Pull files through one tar stream, avoiding per-file round trips.
+
+        The files are archived on the fly by 'tar' on the device, streamed over
+        'adb exec-out' and extracted as they arrive, keeping their mtimes.
+        Nothing is staged on either side.
+
+        Args:
+          src: Remote directory the names are relative to.
+          names: Names of regular files below src, each starting with a slash.
+          dst: Existing local directory the names are relative to.
+
+        Raises:
+          OSError: if the stream broke off or did not contain every file.
+        """
+        missing = set(names)
+        # exec-out passes stderr in the same stream, where warnings would
+        # corrupt the archive; files tar could not read are reported missing.
+        command = b'cd %s 2>/dev/null && tar -cf - %s 2>/dev/null' % (
+            self.QuoteArgument(src),
+            b' '.join(self.QuoteArgument(b'.' + name) for name in names))
+        with self.metrics.Call('exec-out tar'), self._Stream(b'exec-out', command) as stdout:
+            try:
+                with tarfile.open(fileobj=stdout, mode='r|', encoding='utf-8',
+                                  errors='surrogateescape') as tar:
+                    for member in tar:
+                        name = member.name.encode('utf-8', 'surrogateescape')
+                        name = name[1:] if name.startswith(b'./') else b'/' + name
+                        if not member.isfile() or name not in missing:
+                            logger.warning('Unexpected tar member: {}.', name)
+                            continue
+                        with open(dst + name, 'wb') as f:
+                            shutil.copyfileobj(tar.extractfile(member), f, 1 << 20)
+                        os.utime(dst + name, (member.mtime, member.mtime))
+                        missing.discard(name)
+            except tarfile.TarError as e:
+                raise OSError('Broken tar stream: %s' % (e,))
+        if missing:
+            raise OSError('%d files missing from tar stream' % (len(missing),))
+
     def Pull(self, src: bytes, dst: bytes) -> None:
         """Pull a file from the Android device to the local file system."""
         dst_original = None
@@ -263,7 +1053,9 @@ class AdbFileSystem(GlobLike, OSLike):
         if len(dst) > 200:
             dst_original = dst.decode(errors='replace')
             dst = dst[:dst.rfind(b'/') + 1] + str(random.randint(0, 1000000000)).encode('ascii')
-        if subprocess.call(self.adb + [b'pull', src, dst]) != 0:
+        with self.metrics.Call('pull'):
+            status = subprocess.call(self.adb + [b'pull', src, dst])
+        if status != 0:
             raise OSError('pull failed')
         if dst_original is not None:
             os.rename(dst, dst_original)
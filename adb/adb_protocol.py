@@ -0,0 +1,250 @@
+import errno
+import os
+import socket
+import struct
+from typing import BinaryIO, List, Optional, Set, Tuple
+
+# Where the adb server listens unless configured otherwise.
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 5037
+# Largest payload of a sync DATA message.
+SYNC_DATA_MAX = 64 * 1024
+
+# Device features for the sync requests with 64 bit sizes and full stat results.
+FEATURE_LS_V2 = 'ls_v2'
+FEATURE_STAT_V2 = 'stat_v2'
+
+# Sync message header: id and a length or value.
+_HEADER = struct.Struct('<4sI')
+# Rest of a v1 STAT response: mode, size, mtime.
+_STAT_V1 = struct.Struct('<III')
+# Rest of a v1 DENT message: mode, size, mtime, name length.
+_DENT_V1 = struct.Struct('<IIII')
+# Rest of a v2 stat response: error, dev, ino, mode, nlink, uid, gid, size,
+# atime, mtime, ctime.
+_STAT_V2 = struct.Struct('<IQQIIIIQqqq')
+# Rest of a v2 DNT2 message: the same, then the name length.
+_DENT_V2 = struct.Struct('<IQQIIIIQqqqI')
+
+
+class AdbServer(object):
+    """Talks to the adb server through its smart socket protocol.
+
+    Every request is a hex length and a service name; the server answers OKAY
+    or FAIL and a message. Requests to a device first select it with
+    host:transport, after which the socket belongs to the device service.
+    """
+
+    def __init__(self, serial: Optional[str] = None, host: str = DEFAULT_HOST,
+                 port: int = DEFAULT_PORT) -> None:
+        """Creates the client.
+
+        Args:
+          serial: Device to talk to; the only one connected if None.
+          host: Address of the adb server.
+          port: Port of the adb server.
+        """
+        self.serial = serial
+        self.host = host
+        self.port = port
+
+    def Query(self, request: bytes) -> bytes:
+        """Sends a host request and returns the server's reply."""
+        sock = self._Connect()
+        try:
+            _Request(sock, request)
+            return _RecvExactly(sock, int(_RecvExactly(sock, 4), 16))
+        finally:
+            sock.close()
+
+    def DeviceQuery(self, request: bytes) -> bytes:
+        """Sends a host request about the device, e.g. b'get-serialno'."""
+        if self.serial is None:
+            return self.Query(b'host:' + request)
+        return self.Query(b'host-serial:%s:%s' % (self.serial.encode(), request))
+
+    def Open(self, service: bytes) -> socket.socket:
+        """Connects to a service of the device, e.g. b'sync:' or b'shell:ls'.
+
+        Returns:
+          The socket, carrying the service's raw stream.
+
+        Raises:
+          OSError: if the server or the device refused.
+        """
+        sock = self._Connect()
+        try:
+            if self.serial is None:
+                _Request(sock, b'host:transport-any')
+            else:
+                _Request(sock, b'host:transport:' + self.serial.encode())
+            _Request(sock, service)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def Features(self) -> Set[str]:
+        """Returns the features both the device and the server support."""
+        return set(self.DeviceQuery(b'features').decode('ascii', 'replace').split(','))
+
+    def _Connect(self) -> socket.socket:
+        sock = socket.create_connection((self.host, self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+
+class SyncConnection(object):
+    """A 'sync:' service connection: listings, stat results and file transfers.
+
+    Requests are answered in order, so a connection serves one caller at a
+    time. After an error the device may have dropped the connection; callers
+    should not reuse it then.
+    """
+
+    def __init__(self, sock: socket.socket, features: Set[str]) -> None:
+        self.sock = sock
+        self.ls_v2 = FEATURE_LS_V2 in features
+        self.stat_v2 = FEATURE_STAT_V2 in features
+
+    def List(self, path: bytes) -> List[Tuple[bytes, os.stat_result]]:
+        """Lists a directory, '.' and '..' included.
+
+        Raises:
+          OSError: if the directory could not be read; the device then lists
+            nothing, not even '.'.
+        """
+        v2 = self.ls_v2
+        self._Send(b'LIS2' if v2 else b'LIST', path)
+        dent = _DENT_V2 if v2 else _DENT_V1
+        entries = []  # type: List[Tuple[bytes, os.stat_result]]
+        while True:
+            msg_id = _RecvExactly(self.sock, 4)
+            fields = dent.unpack(_RecvExactly(self.sock, dent.size))
+            if msg_id == b'DONE':
+                break
+            if msg_id not in (b'DNT2', b'DENT'):
+                raise OSError('Unexpected sync message: %r' % (msg_id,))
+            name = _RecvExactly(self.sock, fields[-1])
+            if v2:
+                if fields[0]:
+                    continue
+                entries.append((name, _StatV2(fields)))
+            else:
+                mode, size, mtime, _ = fields
+                entries.append((name, _Stat(mode, size, mtime)))
+        if not entries:
+            raise OSError(errno.EACCES, 'Cannot list directory', path)
+        return entries
+
+    def Lstat(self, path: bytes) -> os.stat_result:
+        """Returns the lstat() result of a path.
+
+        Without stat_v2, sizes are truncated to 32 bits.
+        """
+        if self.stat_v2:
+            return self._StatV2(b'LST2', path)
+        self._Send(b'STAT', path)
+        msg_id = _RecvExactly(self.sock, 4)
+        if msg_id != b'STAT':
+            raise OSError('Unexpected sync message: %r' % (msg_id,))
+        mode, size, mtime = _STAT_V1.unpack(_RecvExactly(self.sock, _STAT_V1.size))
+        if mode == 0:
+            raise OSError(errno.ENOENT, 'No such file or directory', path)
+        return _Stat(mode, size, mtime)
+
+    def Stat(self, path: bytes) -> os.stat_result:
+        """Returns the stat() result of a path; requires stat_v2."""
+        return self._StatV2(b'STA2', path)
+
+    def _StatV2(self, request: bytes, path: bytes) -> os.stat_result:
+        self._Send(request, path)
+        msg_id = _RecvExactly(self.sock, 4)
+        if msg_id != request:
+            raise OSError('Unexpected sync message: %r' % (msg_id,))
+        fields = _STAT_V2.unpack(_RecvExactly(self.sock, _STAT_V2.size))
+        if fields[0]:
+            raise OSError(fields[0], os.strerror(fields[0]), path)
+        return _StatV2(fields)
+
+    def Recv(self, path: bytes, f: BinaryIO) -> int:
+        """Copies a file of the device into f, returning the number of bytes."""
+        self._Send(b'RECV', path)
+        num_bytes = 0
+        while True:
+            msg_id, length = _HEADER.unpack(_RecvExactly(self.sock, _HEADER.size))
+            if msg_id == b'DONE':
+                return num_bytes
+            if msg_id == b'FAIL':
+                raise OSError('pull failed: %s' % (
+                    _RecvExactly(self.sock, length).decode('utf-8', 'replace'),))
+            if msg_id != b'DATA' or length > SYNC_DATA_MAX:
+                raise OSError('Unexpected sync message: %r' % (msg_id,))
+            f.write(_RecvExactly(self.sock, length))
+            num_bytes += length
+
+    def Send(self, f: BinaryIO, path: bytes, mode: int, mtime: int) -> None:
+        """Writes the contents of f to a file of the device.
+
+        The device creates missing parent directories.
+
+        Args:
+          f: Stream to read the contents from.
+          path: Path on the device.
+          mode: Mode of the file; the device only keeps the permission bits.
+          mtime: Modification time to give the file.
+        """
+        self._Send(b'SEND', b'%s,%d' % (path, mode))
+        while chunk := f.read(SYNC_DATA_MAX):
+            self.sock.sendall(_HEADER.pack(b'DATA', len(chunk)) + chunk)
+        self.sock.sendall(_HEADER.pack(b'DONE', mtime & 0xffffffff))
+        msg_id, length = _HEADER.unpack(_RecvExactly(self.sock, _HEADER.size))
+        if msg_id == b'FAIL':
+            raise OSError('push failed: %s' % (
+                _RecvExactly(self.sock, length).decode('utf-8', 'replace'),))
+        if msg_id != b'OKAY':
+            raise OSError('Unexpected sync message: %r' % (msg_id,))
+
+    def Close(self) -> None:
+        """Ends the connection."""
+        try:
+            self.sock.sendall(_HEADER.pack(b'QUIT', 0))
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _Send(self, request: bytes, path: bytes) -> None:
+        self.sock.sendall(_HEADER.pack(request, len(path)) + path)
+
+
+def _Request(sock: socket.socket, request: bytes) -> None:
+    """Sends a smart socket request and waits for OKAY."""
+    sock.sendall(b'%04x' % (len(request),) + request)
+    status = _RecvExactly(sock, 4)
+    if status == b'OKAY':
+        return
+    if status == b'FAIL':
+        message = _RecvExactly(sock, int(_RecvExactly(sock, 4), 16))
+        raise OSError('adb: %s' % (message.decode('utf-8', 'replace'),))
+    raise OSError('Unexpected adb server status: %r' % (status,))
+
+
+def _RecvExactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise OSError('adb connection closed')
+        received += n
+    return bytes(data)
+
+
+def _Stat(mode: int, size: int, mtime: int) -> os.stat_result:
+    return os.stat_result((mode, 1, 0, 1, -2, -2, size, mtime, mtime, mtime))
+
+
+def _StatV2(fields: Tuple[int, ...]) -> os.stat_result:
+    _, dev, ino, mode, nlink, uid, gid, size, atime, mtime, ctime = fields[:11]
+    return os.stat_result((mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime))
@@ -0,0 +1,208 @@
+import contextlib
+import os
+import socket
+import stat
+import threading
+from typing import IO, Iterable, Iterator, List, Optional, Set
+
+from .adb_file_system import AdbFileSystem
+from .adb_protocol import DEFAULT_HOST, DEFAULT_PORT, FEATURE_STAT_V2, AdbServer, SyncConnection
+from .shell_session import ShellSession
+from .sync_metrics import SyncMetrics
+
+
+class AdbSocketFileSystem(AdbFileSystem):
+    """An AdbFileSystem talking to the adb server directly, without adb processes.
+
+    Listings, stat results and transfers go over 'sync:' connections, which
+    are kept open and reused; commands go over 'shell:' and 'exec:' streams,
+    and the shell session is a long-lived 'exec:sh'. Stat results from sync
+    have mtimes to the second whatever the device's 'ls' prints.
+
+    The smart socket protocol does not report exit statuses, so streamed
+    commands never fail by status; pulls through them check their sizes.
+    """
+
+    def __init__(self, serial: Optional[str] = None, host: str = DEFAULT_HOST,
+                 port: int = DEFAULT_PORT, stat_backend: Optional[bool] = None,
+                 metrics: Optional[SyncMetrics] = None) -> None:
+        """Creates the file system.
+
+        Args:
+          serial: Device to talk to; the only one connected if None.
+          host: Address of the adb server.
+          port: Port of the adb server.
+          stat_backend: See AdbFileSystem.
+          metrics: See AdbFileSystem.
+        """
+        super().__init__([b'adb'] + ([b'-s', serial.encode()] if serial is not None else []),
+                         stat_backend, metrics)
+        self.server = AdbServer(serial, host, port)
+        self.shell = self._NewShell()
+        self.sync_lock = threading.Lock()
+        self.idle_syncs = []  # type: List[SyncConnection]
+        self._features = None  # type: Optional[Set[str]]
+
+    def Features(self) -> Set[str]:
+        """Returns the features of the device and the adb server."""
+        if self._features is None:
+            self._features = self.server.Features()
+        return self._features
+
+    @contextlib.contextmanager
+    def _Sync(self) -> Iterator[SyncConnection]:
+        """Lends an idle sync connection, opening one if there is none.
+
+        A connection that saw an error is closed instead of given back.
+        """
+        with self.sync_lock:
+            sync = self.idle_syncs.pop() if self.idle_syncs else None
+        if sync is None:
+            sync = SyncConnection(self.server.Open(b'sync:'), self.Features())
+        try:
+            yield sync
+        except BaseException:
+            sync.Close()
+            raise
+        with self.sync_lock:
+            self.idle_syncs.append(sync)
+
+    def Close(self) -> None:
+        """Closes the shell session and all sync connections."""
+        super().Close()
+        with self.sync_lock:
+            syncs, self.idle_syncs = self.idle_syncs, []
+        for sync in syncs:
+            sync.Close()
+
+    def _NewShell(self) -> 'SocketShellSession':
+        return SocketShellSession(self.server, self.metrics)
+
+    def GetSerial(self) -> str:
+        """Returns the serial number of the device."""
+        if self._serial is None:
+            with self.metrics.Call('get-serialno'):
+                self._serial = self.server.DeviceQuery(b'get-serialno').decode('ascii', 'replace').strip()
+        return self._serial
+
+    @contextlib.contextmanager
+    def _Stream(self, service: bytes, command: bytes, check: bool = True) -> Iterator[IO[bytes]]:
+        sock = self.server.Open((b'exec:' if service == b'exec-out' else b'shell:') + command)
+        stream = sock.makefile('rb')
+        try:
+            yield stream
+        finally:
+            stream.close()
+            sock.close()
+
+    def listdir(self, path: bytes) -> Iterable[bytes]:  # os's name, so pylint: disable=g-bad-name
+        """List the contents of a directory, caching them for later lstat calls."""
+        names = self._ListFromTree(path)
+        if names is not None:
+            yield from names
+            return
+        with self.metrics.Call('sync list'), self._Sync() as sync:
+            entries = sync.List(path)
+        yield from self._Listed(path, [(name, s) for name, s in entries
+                                       if name != b'.' and name != b'..'])[1]
+
+    def _stat_lstat(self, path: bytes, flags: bytes) -> os.stat_result:
+        """Stat or lstat a file."""
+        follow = flags == b'L'
+        if follow and FEATURE_STAT_V2 not in self.Features():
+            # Version 1 of sync only has lstat.
+            return super()._stat_lstat(path, flags)
+        with self.metrics.Call('sync stat'), self._Sync() as sync:
+            statdata = sync.Stat(path) if follow else sync.Lstat(path)
+        with self.stat_cache_lock:
+            self.stat_cache.Set(path, statdata)
+        return statdata
+
+    def Push(self, src: bytes, dst: bytes) -> None:
+        """Push a file from the local file system to the Android device."""
+        # Directories queued for creation must exist first, and files queued
+        # for deletion must not take the pushed file with them.
+        self._FlushEarly()
+        s = os.stat(src)
+        with self.metrics.Call('sync send'), self._Sync() as sync, open(src, 'rb') as f:
+            sync.Send(f, dst, s.st_mode, int(s.st_mtime))
+
+    def Pull(self, src: bytes, dst: bytes) -> None:
+        """Pull a file from the Android device to the local file system."""
+        with self.metrics.Call('sync recv'), self._Sync() as sync:
+            self._Recv(sync, src, dst)
+
+    def PullMany(self, srcs: List[bytes], dst: bytes) -> None:
+        """Pull several files or directories over one sync connection.
+
+        Args:
+          srcs: Paths on the Android device.
+          dst: Existing local directory to pull them into or, for a single
+            remote directory, the local path to create for it.
+        """
+        with self.metrics.Call('sync recv'), self._Sync() as sync:
+            for src in srcs:
+                target = dst
+                if os.path.isdir(dst):
+                    target = dst + b'/' + src.rstrip(b'/').rsplit(b'/', 1)[-1]
+                self._RecvTree(sync, src, target)
+
+    def _RecvTree(self, sync: SyncConnection, src: bytes, dst: bytes) -> None:
+        with self.stat_cache_lock:
+            statdata = self.stat_cache.Get(src)
+        if statdata is None:
+            statdata = sync.Lstat(src)
+        if not stat.S_ISDIR(statdata.st_mode):
+            self._Recv(sync, src, dst)
+            return
+        os.makedirs(dst, exist_ok=True)
+        for name, s in sync.List(src):
+            if name == b'.' or name == b'..':
+                continue
+            if stat.S_ISDIR(s.st_mode):
+                self._RecvTree(sync, src + b'/' + name, dst + b'/' + name)
+            else:
+                self._Recv(sync, src + b'/' + name, dst + b'/' + name)
+
+    @staticmethod
+    def _Recv(sync: SyncConnection, src: bytes, dst: bytes) -> None:
+        try:
+            with open(dst, 'wb') as f:
+                sync.Recv(src, f)
+        except BaseException:
+            try:
+                os.unlink(dst)
+            except OSError:
+                pass
+            raise
+
+
+class SocketShellSession(ShellSession):
+    """A ShellSession whose shell is an 'exec:sh' stream of the adb server."""
+
+    def __init__(self, server: AdbServer, metrics: Optional[SyncMetrics] = None) -> None:
+        super().__init__([], metrics)
+        self.server = server
+
+    def _Start(self) -> '_SocketProcess':
+        if self.popen is None:
+            self.popen = _SocketProcess(self.server.Open(b'exec:sh'))
+            self._buffer = b''
+        return self.popen
+
+
+class _SocketProcess(object):
+    """The parts of subprocess.Popen that ShellSession uses, over a socket."""
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.stdin = sock.makefile('wb')
+        self.stdout = sock.makefile('rb')
+
+    def wait(self, timeout: Optional[float] = None) -> int:  # Popen's name, so pylint: disable=g-bad-name
+        # Closing the stream ends the shell; there is no exit status to wait for.
+        self.sock.close()
+        return 0
+
+    def kill(self) -> None:  # Popen's name, so pylint: disable=g-bad-name
+        self.sock.close()
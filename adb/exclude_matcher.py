@@ -0,0 +1,83 @@
+import re
+from typing import Iterable, Optional
+
+
+class ExcludeMatcher(object):
+    """Decides whether an entry is excluded, without touching any file system.
+
+    Each pattern applies relative to every directory of the tree, as if it
+    were globbed in each of them: an entry is excluded if its last path
+    components match the components of a pattern. Matching
+    follows glob rules: '*', '?' and '[...]' do not cross '/', and do not
+    match a leading '.' unless the pattern component starts with one. A
+    pattern equal to an entry's name always excludes it.
+    """
+
+    def __init__(self, patterns: Optional[Iterable[str]]) -> None:
+        self.names = set()  # type: set
+        # Patterns 'find -name' matches exactly like Match() does: fnmatch()
+        # lets a leading wildcard match a leading '.', and its brackets and
+        # backslashes differ from ours.
+        self.find_names = []  # type: list[bytes]
+        single = []  # type: list[bytes]
+        multi = []  # type: list[bytes]
+        for pattern in patterns or []:
+            encoded = pattern.encode()
+            components = encoded.split(b'/')
+            if len(components) == 1:
+                self.names.add(encoded)
+                if encoded and not _HasMagic(encoded[:1]) and b'[' not in encoded and b'\\' not in encoded:
+                    self.find_names.append(encoded)
+                if _HasMagic(encoded):
+                    single.append(_TranslateComponent(encoded))
+            else:
+                multi.append(b'/'.join(_TranslateComponent(c) for c in components))
+        self.single = re.compile(b'(?:%s)\\Z' % (b'|'.join(single),), re.DOTALL) if single else None
+        self.multi = re.compile(b'(?:^|/)(?:%s)\\Z' % (b'|'.join(multi),), re.DOTALL) if multi else None
+
+    def Match(self, path: bytes) -> bool:
+        """Tells whether an entry is excluded.
+
+        Args:
+          path: Path of the entry relative to the root of the tree.
+        """
+        name = path[path.rfind(b'/') + 1:]
+        if name in self.names:
+            return True
+        if self.single is not None and self.single.match(name):
+            return True
+        return self.multi is not None and self.multi.search(path) is not None
+
+
+def _HasMagic(component: bytes) -> bool:
+    return re.search(b'[*?[]', component) is not None
+
+
+def _TranslateComponent(component: bytes) -> bytes:
+    """Translates one glob path component into a regular expression."""
+    if not _HasMagic(component):
+        return re.escape(component)
+    parts = [] if component.startswith(b'.') else [b'(?!\\.)']
+    i = 0
+    while i < len(component):
+        c = component[i:i + 1]
+        i += 1
+        if c == b'*':
+            parts.append(b'[^/]*')
+        elif c == b'?':
+            parts.append(b'[^/]')
+        elif c == b'[':
+            end = component.find(b']', i + 1 if component[i:i + 1] in (b'!', b']') else i)
+            if end < 0:
+                parts.append(b'\\[')
+                continue
+            chars = component[i:end]
+            i = end + 1
+            if chars.startswith(b'!'):
+                chars = b'^' + chars[1:]
+            elif chars.startswith(b'^'):
+                chars = b'\\' + chars
+            parts.append(b'[' + chars.replace(b'\\', b'\\\\') + b']')
+        else:
+            parts.append(re.escape(c))
+    return b''.join(parts)
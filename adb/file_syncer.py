@@ -1,68 +1,200 @@
-import glob
+import collections
+import dataclasses
+import functools
+import itertools
 import os
+import re
 import stat
+import threading
 import time
 from types import TracebackType
-from typing import cast, List, Tuple, Callable, Iterable, Optional, Type, Union, Sequence
+from typing import List, Tuple, Callable, Iterable, Iterator, Optional, Set, Type, Sequence
 
 from loguru import logger
 
 from .adb_file_system import AdbFileSystem
+from .exclude_matcher import ExcludeMatcher
 from .glob_like import GlobLike
+from .listing_cache import ListingCache
+from .listing_prefetcher import ListingPrefetcher
+from .local_file_system import LocalFileSystem
 from .os_like import OSLike
+from .run_ahead import RunAhead
 from .sync_config import SyncConfig
+from .sync_plan import COPY, CONFLICT, DELETE, SEED, PlanOp, PlanWriter
+from .transfer_plan import DIR, FILE, FILES, HASHED, TAR, TREE, PlanHashedPulls, PlanPulls, PlanTarPulls
+from .transfer_pool import TransferPool
+
+# Diff records the pipelined scan may produce ahead of the copies.
+MAX_SCANNED_AHEAD = 10000
+
+# A name with its local and remote stat results; None where it is missing.
+DiffRecord = Tuple[bytes, Optional[os.stat_result], Optional[os.stat_result]]
+
+
+def _Batched(method: Callable[..., None]) -> Callable[..., None]:
+    """Runs a sync phase with the remote mutations queued, flushing at its end."""
+
+    @functools.wraps(method)
+    def Wrapper(self: 'FileSyncer', *args) -> None:
+        with self.adb.Batch():
+            method(self, *args)
+
+    return Wrapper
 
 
 class FileSyncer(object):
     """File synchronizer."""
 
-    def __init__(self, adb: AdbFileSystem, local_path: bytes, remote_path: bytes, config: SyncConfig) -> None:
+    def __init__(self, adb: AdbFileSystem, local_path: bytes, remote_path: bytes, config: SyncConfig,
+                 plan_path: Optional[str] = None, seed_path: Optional[bytes] = None) -> None:
+        """Creates the syncer.
+
+        Args:
+          plan_path: With config.dry_run, where to write the operations the sync
+            would perform, for ApplyPlan().
+          seed_path: Earlier snapshot of local_path. Remote files missing
+            locally that it holds unchanged are linked from it instead of
+            pulled; see PerformSeeding().
+        """
         self.local = local_path
         self.remote = remote_path
         self.config = config
         self.adb = adb
+        # Shared with adb, which accounts its invocations there.
+        self.metrics = adb.metrics
+        self.excludes = ExcludeMatcher(config.excludes)
         self.num_bytes = 0
+        self.lock = threading.Lock()
         self.start_time = time.time()
+        self.seed = seed_path
+        self.plan = None  # type: Optional[PlanWriter]
+        if plan_path is not None and config.dry_run:
+            self.plan = PlanWriter(plan_path, local_path, remote_path, config, seed_path)
+        # Indexed by direction: 0 is local to remote, 1 remote to local.
+        self.src_to_dst = (config.local_to_remote, config.remote_to_local)
+        self.dst_to_src = (config.remote_to_local, config.local_to_remote)
+        self.src = (local_path, remote_path)
+        self.dst = (remote_path, local_path)
+        self.local_fs = LocalFileSystem()
+        self.dst_fs = (adb, self.local_fs)  # type: Tuple[OSLike, OSLike]
+        self.push = ('Push', 'Pull')
+        self.copy = (adb.Push, adb.Pull)  # type: Tuple[Callable[[bytes, bytes], None], ...]
 
     # Attributes filled in later.
-    local_only = None  # type: List[Tuple[bytes, os.stat_result]]
-    both = None  # type: List[Tuple[bytes, os.stat_result, os.stat_result]]
-    remote_only = None  # type: List[Tuple[bytes, os.stat_result]]
-    src_to_dst = None  # type: Tuple[bool, bool]
-    dst_to_src = None  # type: Tuple[bool, bool]
-    src_only = None  # type: Tuple[List[Tuple[bytes, os.stat_result]], List[Tuple[bytes, os.stat_result]]]
-    dst_only = None  # type: Tuple[List[Tuple[bytes, os.stat_result]], List[Tuple[bytes, os.stat_result]]]
-    src = None  # type: Tuple[bytes, bytes]
-    dst = None  # type: Tuple[bytes, bytes]
-    dst_fs = None  # type: Tuple[OSLike, OSLike]
-    push = None  # type: Tuple[str, str]
-    copy = None  # type: Tuple[Callable[[bytes, bytes], None], Callable[[bytes, bytes], None]]
+    # The diff, produced lazily while both sides are walked. Each phase wraps
+    # it in a stage; PerformCopies() finally drives it.
+    diff = None  # type: Iterator[DiffRecord]
+    remote_skipped = None  # type: Set[bytes]
+    # Local part files left by interrupted pulls, by the names they are for.
+    leftover_parts = None  # type: Set[bytes]
+    # What the local walk left out, as BuildFileList() records it.
+    local_skipped = None  # type: Set[bytes]
 
     def IsWorking(self) -> bool:
         """Tests the adb connection."""
         return self.adb.IsWorking()
 
-    def ScanAndDiff(self) -> None:
-        """Scans the local and remote locations and identifies differences."""
+    def ScanAndDiff(self, remotelist: Optional[Iterable[Tuple[bytes, os.stat_result]]] = None,
+                    remote_skipped: Optional[Set[bytes]] = None) -> None:
+        """Scans the local and remote locations and identifies differences.
+
+        Args:
+          remotelist: Listing of the remote location, already filtered by the
+            time range, e.g. a partition from ScanAndDiffShared(); walked here
+            if None.
+          remote_skipped: What BuildFileList() records as skipped for
+            remotelist; required with it.
+        """
         logger.info('Scanning and diffing...')
-        locallist = BuildFileList(
-            cast(OSLike, os), self.local, self.config.copy_links, b'',
-            self.config.excludes, time_range=self.config.time_range)
-        remotelist = BuildFileList(self.adb, self.remote, self.config.copy_links, b'',
-                                   self.config.excludes, time_range=self.config.time_range)
-        self.local_only, self.both, self.remote_only = DiffLists(
-            locallist, remotelist)
-        if not self.local_only and not self.both and not self.remote_only:
+        self.local_skipped = set()
+        locallist = self._CountWalk('scan_local', functools.partial(
+            BuildFileList, self.local_fs, self.local, self.config.copy_links, b'',
+            self.excludes, time_range=self.config.time_range, skipped=self.local_skipped))
+        self.leftover_parts = set()
+        if remotelist is None:
+            self.PrefetchRemote(self.config.time_range)
+            self.remote_skipped = set()
+            remotelist = self.WalkRemote(self.config.time_range, self.remote_skipped)
+        else:
+            self.remote_skipped = remote_skipped
+        # Includes the scans; less them, the time spent diffing.
+        self.diff = self.metrics.Timed('scan_and_diff', self._Diff(
+            self.metrics.Timed('scan_local', locallist),
+            self.metrics.Timed('scan_remote', remotelist)))
+
+    def PrefetchRemote(self, time_range: Optional[Sequence[Optional[int]]]) -> None:
+        """Starts listing the remote tree in bulk, as configured.
+
+        Args:
+          time_range: Range of file mtimes the walk keeps. Unless links are
+            followed, the device lists only those, and no excluded names.
+        """
+        with self.metrics.Phase('prefetch'):
+            cache_path = None
+            if self.config.listing_cache is not None:
+                # Serials of network devices contain ':', which Windows does not allow.
+                cache_path = os.path.join(
+                    self.config.listing_cache, re.sub(r'[^\w.-]', '_', self.adb.GetSerial()) + '.sqlite')
+                if self.config.dry_run and not os.path.exists(cache_path):
+                    # A dry run leaves no cache behind.
+                    cache_path = None
+            if cache_path is not None:
+                cache = ListingCache(cache_path)
+                try:
+                    cache.Prefetch(self.adb, self.remote, save=not self.config.dry_run)
+                finally:
+                    cache.Close()
+            elif self.config.bulk_listing and self.config.copy_links:
+                self.adb.PrefetchTree(self.remote)
+            elif self.config.bulk_listing:
+                self.adb.PrefetchTree(self.remote, self.excludes, time_range)
+
+    def WalkRemote(self, time_range: Optional[Sequence[Optional[int]]],
+                   skipped: Set[bytes]) -> Iterator[Tuple[bytes, os.stat_result]]:
+        """Walks the remote tree with BuildFileList().
+
+        Without a listing prefetched in bulk, config.scan_workers directories
+        are listed at once, ahead of the walk.
+        """
+        walk = functools.partial(BuildFileList, self.adb, self.remote, self.config.copy_links, b'',
+                                 self.excludes, time_range=time_range, skipped=skipped)
+        if (self.config.scan_workers <= 1 or self.config.bulk_listing
+                or self.config.listing_cache is not None):
+            yield from self._CountWalk('scan_remote', walk)
+            return
+        root = len(self.remote)
+        with ListingPrefetcher(self.adb, self.config.scan_workers, self.remote,
+                               lambda path: not self.excludes.Match(path[root:]),
+                               self.config.copy_links) as lister:
+            yield from self._CountWalk('scan_remote', functools.partial(walk, lister=lister))
+
+    def _CountWalk(self, name: str, walk: Callable[..., Iterator[Tuple[bytes, os.stat_result]]]
+                   ) -> Iterator[Tuple[bytes, os.stat_result]]:
+        """Passes on walk(counts=...), adding its WalkCounts to the metrics as it ends."""
+        counts = WalkCounts()
+        try:
+            yield from walk(counts=counts)
+        finally:
+            self.metrics.AddWalk(name, dataclasses.asdict(counts))
+
+    def _Diff(self, locallist: Iterable[Tuple[bytes, os.stat_result]],
+              remotelist: Iterable[Tuple[bytes, os.stat_result]]) -> Iterator[DiffRecord]:
+        """Yields the diff of both walks, then ends the remote tree listing."""
+        seen = False
+        suffix = AdbFileSystem.PART_SUFFIX
+        for record in DiffStreams(locallist, remotelist):
+            seen = True
+            name, localstat, remotestat = record
+            if (remotestat is None and self.config.remote_to_local and name.endswith(suffix)
+                    and stat.S_ISREG(localstat.st_mode)):
+                # Resumed by the pull it is for, if any; not a file to sync.
+                self.leftover_parts.add(name[:-len(suffix)])
+                continue
+            yield record
+        self.adb.FinishTreeListing()
+        if not seen:
             logger.warning('No files seen. User error?')
-        self.src_to_dst = (self.config.local_to_remote, self.config.remote_to_local)
-        self.dst_to_src = (self.config.remote_to_local, self.config.local_to_remote)
-        self.src_only = (self.local_only, self.remote_only)
-        self.dst_only = (self.remote_only, self.local_only)
-        self.src = (self.local, self.remote)
-        self.dst = (self.remote, self.local)
-        self.dst_fs = (self.adb, cast(OSLike, os))
-        self.push = ('Push', 'Pull')
-        self.copy = (self.adb.Push, self.adb.Pull)
 
     def PerformDeletions(self) -> None:
         """Perform all deleting necessary for the file sync operation."""
@@ -70,121 +202,410 @@ class FileSyncer(object):
             return
         for i in [0, 1]:
             if self.src_to_dst[i] and not self.dst_to_src[i]:
-                if not self.src_only[i] and not self.both:
-                    logger.error('Cowardly refusing to delete everything.')
-                else:
-                    for name, s in reversed(self.dst_only[i]):
-                        dst_name = self.dst[i] + name
-                        logger.info('{}-Delete: {}', self.push[i], dst_name)
-                        if stat.S_ISDIR(s.st_mode):
-                            if not self.config.dry_run:
-                                self.dst_fs[i].rmdir(dst_name)
-                        else:
-                            if not self.config.dry_run:
-                                self.dst_fs[i].unlink(dst_name)
-                    del self.dst_only[i][:]
-
-    def PerformOverwrites(self) -> None:
-        """Delete files/directories that are in the way for overwriting."""
-        src_only_prepend = (
-            [], []
-        )  # type: Tuple[List[Tuple[bytes, os.stat_result]], List[Tuple[bytes, os.stat_result]]]
-        for name, localstat, remotestat in self.both:
-            if stat.S_ISDIR(localstat.st_mode) and stat.S_ISDIR(remotestat.st_mode):
-                # A dir is a dir is a dir.
-                continue
-            elif stat.S_ISDIR(localstat.st_mode) or stat.S_ISDIR(remotestat.st_mode):
-                # Dir vs file? Nothing to do here yet.
-                input("folder and file with same name, enter anything to skip, or terminate the program.")
-                continue
+                self.diff = self._Deletions(i, self.diff)
+
+    def _Deletions(self, i: int, records: Iterator[DiffRecord]) -> Iterator[DiffRecord]:
+        """Deletes what only exists at the destination, passing on everything else."""
+        # Held back until the source turns out not to be empty or, for a
+        # pipelined scan, until the scan is complete.
+        defer = self.config.pipelined_scan
+        waiting = []  # type: List[Tuple[bytes, os.stat_result]]
+        source_seen = False
+        # Directories to remove once the stream has left them, innermost last.
+        dirs = []  # type: List[Tuple[bytes, os.stat_result]]
+        for record in records:
+            name, src_stat, dst_stat = record[0], record[1 + i], record[2 - i]
+            if src_stat is not None:
+                if not source_seen and not defer:
+                    for entry in waiting:
+                        self._DeleteMissing(i, dirs, *entry)
+                    del waiting[:]
+                source_seen = True
+                yield record
+            elif not source_seen or defer:
+                waiting.append((name, dst_stat))
             else:
-                # File vs file? Compare sizes.
-                if localstat.st_size == remotestat.st_size and not self.config.del_source:
-                    continue
-            l2r = self.config.local_to_remote
-            r2l = self.config.remote_to_local
-            if l2r and r2l:
-                # Truncate times to full minutes, as Android's "ls" only outputs minute
-                # accuracy.
-                localminute = int(localstat.st_mtime / 60)
-                remoteminute = int(remotestat.st_mtime / 60)
-                if localminute > remoteminute:
-                    r2l = False
-                elif localminute < remoteminute:
-                    l2r = False
-            if l2r and r2l and not self.config.del_source:
-                logger.warning('Unresolvable: {}', name)
-                continue
-            if l2r:
-                i = 0  # Local to remote operation.
-                src_stat = localstat
-                dst_stat = remotestat
-            else:
-                i = 1  # Remote to local operation.
-                src_stat = remotestat
-                dst_stat = localstat
-            dst_name = self.dst[i] + name
-            logger.info('{}-Delete-Conflicting: {}', self.push[i], dst_name)
-            if stat.S_ISDIR(localstat.st_mode) or stat.S_ISDIR(remotestat.st_mode):
-                if not self.config.allow_replace:
-                    logger.info('Would have to replace to do this. '
-                                 'Use --force to allow this.')
-                    continue
-            if not self.config.allow_overwrite:
-                logger.info('Would have to overwrite to do this, '
-                             'which --no-clobber forbids.')
-                continue
-            if stat.S_ISDIR(dst_stat.st_mode):
-                kill_files = [
-                    x for x in self.dst_only[i] if x[0][:len(name) + 1] == name + b'/'
-                ]
-                self.dst_only[i][:] = [
-                    x for x in self.dst_only[i] if x[0][:len(name) + 1] != name + b'/'
-                ]
-                for l, s in reversed(kill_files):
-                    if stat.S_ISDIR(s.st_mode):
-                        if not self.config.dry_run:
-                            self.dst_fs[i].rmdir(self.dst[i] + l)
-                    else:
-                        if not self.config.dry_run:
-                            self.dst_fs[i].unlink(self.dst[i] + l)
+                self._DeleteMissing(i, dirs, name, dst_stat)
+        if not source_seen:
+            if waiting:
+                logger.error('Cowardly refusing to delete everything.')
+        else:
+            for entry in waiting:
+                self._DeleteMissing(i, dirs, *entry)
+        while dirs:
+            self._Delete(i, *dirs.pop())
+
+    def _DeleteMissing(self, i: int, dirs: List[Tuple[bytes, os.stat_result]], name: bytes,
+                       s: os.stat_result) -> None:
+        # Everything below a directory comes right after it in the stream.
+        while dirs and not name.startswith(dirs[-1][0] + b'/'):
+            self._Delete(i, *dirs.pop())
+        if stat.S_ISDIR(s.st_mode):
+            dirs.append((name, s))
+        else:
+            self._Delete(i, name, s)
+
+    def _Delete(self, i: int, name: bytes, s: os.stat_result) -> None:
+        dst_name = self.dst[i] + name
+        logger.info('{}-Delete: {}', self.push[i], dst_name)
+        if self.plan is not None:
+            self.plan.Add(DELETE, i, '', [(name, s)])
+        with self.metrics.Phase('delete'):
+            if stat.S_ISDIR(s.st_mode):
                 if not self.config.dry_run:
                     self.dst_fs[i].rmdir(dst_name)
-            elif stat.S_ISDIR(src_stat.st_mode):
-                if not self.config.dry_run:
-                    self.dst_fs[i].unlink(dst_name)
             else:
                 if not self.config.dry_run:
                     self.dst_fs[i].unlink(dst_name)
-            src_only_prepend[i].append((name, src_stat))
-        for i in [0, 1]:
-            self.src_only[i][:0] = src_only_prepend[i]
 
+    def PerformOverwrites(self) -> None:
+        """Delete files/directories that are in the way for overwriting."""
+        self.diff = self._Overwrites(self.diff)
+
+    def _Overwrites(self, records: Iterator[DiffRecord]) -> Iterator[DiffRecord]:
+        """Clears the way for entries to overwrite, passing them on as source only."""
+        # A folder skipped for having a file's name, whose contents are skipped too.
+        skipped = None  # type: Optional[bytes]
+        for record in records:
+            name, localstat, remotestat = record
+            if skipped is not None and name.startswith(skipped + b'/'):
+                continue
+            skipped = None
+            if localstat is None or remotestat is None:
+                yield record
+                continue
+            i = self._Overwrite(name, localstat, remotestat)
+            if i is None and stat.S_ISDIR(localstat.st_mode) != stat.S_ISDIR(remotestat.st_mode):
+                skipped = name
+            if i == 0:
+                yield name, localstat, None
+            elif i == 1:
+                yield name, None, remotestat
+
+    def _Overwrite(self, name: bytes, localstat: os.stat_result,
+                   remotestat: os.stat_result) -> Optional[int]:
+        """Deletes the destination of an entry that exists on both sides, if needed.
+
+        Returns:
+          The direction to copy the entry in, or None to leave it alone.
+        """
+        if stat.S_ISDIR(localstat.st_mode) and stat.S_ISDIR(remotestat.st_mode):
+            # A dir is a dir is a dir.
+            return None
+        elif stat.S_ISDIR(localstat.st_mode) or stat.S_ISDIR(remotestat.st_mode):
+            # Dir vs file? Nothing to do here yet.
+            if threading.current_thread() is not threading.main_thread():
+                # E.g. a pipelined scan, or one of several devices; there is
+                # nobody to ask, so take the answer that keeps going.
+                logger.warning('Folder and file with same name, skipping: {}',
+                               (self.local + name).decode('utf-8', 'replace'))
+                return None
+            input("folder and file with same name, enter anything to skip, or terminate the program.")
+            return None
+        else:
+            # File vs file? Compare sizes.
+            if localstat.st_size == remotestat.st_size and not self.config.del_source:
+                return None
+        l2r = self.config.local_to_remote
+        r2l = self.config.remote_to_local
+        if l2r and r2l:
+            # Truncate times to what the device reports, e.g. full minutes, as
+            # Android's "ls" only outputs minute accuracy.
+            precision = self.adb.MtimePrecision()
+            localtime = int(localstat.st_mtime // precision)
+            remotetime = int(remotestat.st_mtime // precision)
+            if localtime > remotetime:
+                r2l = False
+            elif localtime < remotetime:
+                l2r = False
+        if l2r and r2l and not self.config.del_source:
+            logger.warning('Unresolvable: {}', name)
+            return None
+        if l2r:
+            i = 0  # Local to remote operation.
+        else:
+            i = 1  # Remote to local operation.
+        dst_name = self.dst[i] + name
+        logger.info('{}-Delete-Conflicting: {}', self.push[i], dst_name)
+        if not self.config.allow_overwrite:
+            logger.info('Would have to overwrite to do this, '
+                         'which --no-clobber forbids.')
+            return None
+        if self.plan is not None:
+            self.plan.Add(CONFLICT, i, '', [(name, remotestat if i == 0 else localstat)])
+        if not self.config.dry_run:
+            with self.metrics.Phase('overwrite'):
+                self.dst_fs[i].unlink(dst_name)
+        return i
+
+    def PerformSeeding(self) -> None:
+        """Take what is missing locally from the earlier snapshot, where unchanged.
+
+        A remote entry missing locally is taken from the snapshot if it has
+        the entry with the same type and, for files, the same size and mtime
+        (as precise as the device reports it). Files are hardlinked, or
+        copied where the local file system cannot link them; directories are
+        created, so that the rest of their contents is pulled file by file
+        and never as a whole. Only for pulls that keep their sources.
+        """
+        if (self.seed is None or not self.config.remote_to_local or self.config.local_to_remote
+                or self.config.del_source):
+            return
+        self.diff = self._Seeds(self.diff)
+
+    def _Seeds(self, records: Iterator[DiffRecord]) -> Iterator[DiffRecord]:
+        """Seeds what it can, passing it on as existing on both sides."""
+        precision = self.adb.MtimePrecision()
+        for record in records:
+            name, localstat, remotestat = record
+            if localstat is None and remotestat is not None:
+                seedstat = self._SeedStat(name, remotestat, precision)
+                if seedstat is not None:
+                    self._Seed(name, remotestat)
+                    yield name, seedstat, remotestat
+                    continue
+            yield record
+
+    def _SeedStat(self, name: bytes, remotestat: os.stat_result,
+                  precision: int) -> Optional[os.stat_result]:
+        """Returns the snapshot's stat result for an entry, if it can seed it."""
+        try:
+            seedstat = self.local_fs.lstat(self.seed + name)
+        except OSError:
+            return None
+        if stat.S_IFMT(seedstat.st_mode) != stat.S_IFMT(remotestat.st_mode):
+            return None
+        if stat.S_ISDIR(seedstat.st_mode):
+            return seedstat
+        if (stat.S_ISREG(seedstat.st_mode) and seedstat.st_size == remotestat.st_size
+                and int(seedstat.st_mtime // precision) == int(remotestat.st_mtime // precision)):
+            return seedstat
+        return None
+
+    def _Seed(self, name: bytes, remotestat: os.stat_result) -> None:
+        dst_name = self.local + name
+        logger.info('Seed: {}', dst_name)
+        if self.plan is not None:
+            self.plan.Add(SEED, 1, '', [(name, remotestat)])
+        if self.config.dry_run:
+            return
+        with self.metrics.Phase('seed'):
+            if stat.S_ISDIR(remotestat.st_mode):
+                os.makedirs(dst_name, exist_ok=True)
+                self._SetTimes(1, name, remotestat)
+                return
+            try:
+                self.local_fs.Link(self.seed + name, dst_name)
+            except OSError:
+                self.local_fs.CopyFile(self.seed + name, dst_name)
+
+    @_Batched
     def PerformCopies(self) -> None:
-        """Perform all copying necessary for the file sync operation."""
-        for i in [0, 1]:
-            if self.src_to_dst[i]:
-                for name, s in self.src_only[i]:
-                    src_name = self.src[i] + name
-                    dst_name = self.dst[i] + name
-                    logger.info('{}: {}', self.push[i], src_name.decode("utf-8", "replace")
-                                 + " -> " + dst_name.decode("utf-8", "replace"))
-                    if stat.S_ISDIR(s.st_mode):
-                        if not self.config.dry_run:
-                            self.dst_fs[i].makedirs(dst_name)
-                    else:
-                        with DeleteInterruptedFile(self.config.dry_run, self.dst_fs[i], dst_name):
+        """Perform all copying necessary for the file sync operation.
+
+        This consumes the diff, so the deletions and overwrites staged by the
+        earlier phases happen along the way. With a pipelined scan, the diff is
+        produced on a separate thread, so listing goes on while copying. The
+        'copy' phase is the wall time of all of it.
+        """
+        with self.metrics.Phase('copy'):
+            if self.config.pipelined_scan:
+                self.diff = RunAhead(self.diff, MAX_SCANNED_AHEAD)
+            directions = [i for i in [0, 1] if self.src_to_dst[i]]
+            streams = itertools.tee(self.diff, len(directions)) if len(directions) > 1 else [self.diff]
+            for i, records in zip(directions, streams):
+                src_only = ((record[0], record[1 + i]) for record in records
+                            if record[1 + i] is not None and record[2 - i] is None)
+                if i == 1 and self.config.del_source and self.config.verify_before_delete:
+                    if self.config.transfer_mode != 'pull' or self.config.batch_pulls:
+                        logger.info('Verifying before deleting sources: pulling one file at a time, '
+                                    'instead of transfer_mode={!r}, batch_pulls={}.',
+                                    self.config.transfer_mode, self.config.batch_pulls)
+                    units = PlanHashedPulls(src_only)
+                elif i == 1 and self.config.transfer_mode == 'tar':
+                    units = PlanTarPulls(src_only)
+                elif i == 1 and self.config.batch_pulls:
+                    units = PlanPulls(src_only, self.src[i], self.dst[i], self.remote_skipped)
+                else:
+                    units = ((DIR if stat.S_ISDIR(s.st_mode) else FILE, [(name, s)])
+                             for name, s in src_only)
+                with TransferPool(self.config.transfer_workers, self.config.transfer_limit) as pool:
+                    for kind, entries in units:
+                        if self.plan is not None:
+                            self.plan.Add(COPY, i, kind, entries)
+                        if kind == DIR:
+                            # Created right away, before any of its contents is queued.
+                            name, s = entries[0]
+                            self._LogCopy(i, name)
                             if not self.config.dry_run:
-                                self.copy[i](src_name, dst_name)
-                                if self.config.del_source:
-                                    self.dst_fs[1 - i].unlink(src_name)
-                            if stat.S_ISREG(s.st_mode):
-                                self.num_bytes += s.st_size
-                    if not self.config.dry_run:
-                        dst_fs = self.dst_fs[i]
-                        # TODO: Wrap os with fixing layer instead this crap.
-                        fixed_name = dst_name.decode(errors='replace') if dst_fs is os else dst_name
-                        dst_fs.utime(fixed_name, (s.st_atime, s.st_mtime))
+                                self.dst_fs[i].makedirs(self.dst[i] + name)
+                                self._SetTimes(i, name, s)
+                        else:
+                            pool.Submit(self._Copy, i, kind, entries)
+            # With nothing to copy, the deletions still have to happen.
+            for _ in self.diff:
+                pass
+            self._DeleteStaleParts()
+        if self.plan is not None:
+            self.plan.Close()
+            self.plan = None
+
+    @_Batched
+    def ApplyPlan(self, ops: Iterable[PlanOp]) -> None:
+        """Performs the operations of a plan written by a dry run, without scanning.
+
+        Each operation is checked against its entries as planned first: a
+        deletion needs the destination entry, a copy all its source entries,
+        to still be there with the same type, size and mtime. Directories
+        only need to keep their type, as their contents change their mtime.
+        Operations that fail the check are skipped and logged.
+
+        Args:
+          ops: The operations, as read by ReadPlan().
+        """
+        precision = self.adb.MtimePrecision()
+        with TransferPool(self.config.transfer_workers, self.config.transfer_limit) as pool:
+            for kind, i, unit, entries in ops:
+                # The side the entries were listed on.
+                side = i if kind in (COPY, SEED) else 1 - i
+                if not self._Unchanged(side, entries) or (
+                        kind == SEED and self._SeedStat(*entries[0], precision) is None):
+                    logger.warning('Changed since planned, skipping {} of {}',
+                                   unit or kind, self.dst[i] + entries[0][0])
+                elif kind == DELETE:
+                    self._Delete(i, *entries[0])
+                elif kind == SEED:
+                    self._Seed(*entries[0])
+                elif kind == CONFLICT:
+                    name = entries[0][0]
+                    logger.info('{}-Delete-Conflicting: {}', self.push[i], self.dst[i] + name)
+                    self.dst_fs[i].unlink(self.dst[i] + name)
+                elif unit == TREE and os.path.lexists(self.dst[i] + entries[0][0]):
+                    # Pulled as a whole, it would end up inside the directory
+                    # that appeared since; pulled in parts, it fills it.
+                    for part_unit, part_entries in PlanPulls(entries, self.src[i], self.dst[i], set()):
+                        self._ApplyCopy(pool, i, part_unit, part_entries)
+                else:
+                    self._ApplyCopy(pool, i, unit, entries)
+
+    def _ApplyCopy(self, pool: TransferPool, i: int, unit: str,
+                   entries: List[Tuple[bytes, os.stat_result]]) -> None:
+        """Performs a planned copy for ApplyPlan()."""
+        if unit == DIR:
+            name, s = entries[0]
+            self._LogCopy(i, name)
+            if i == 0 or not os.path.isdir(self.dst[i] + name):
+                self.dst_fs[i].makedirs(self.dst[i] + name)
+            self._SetTimes(i, name, s)
+        else:
+            pool.Submit(self._Copy, i, unit, entries)
+
+    def _Unchanged(self, side: int, entries: List[Tuple[bytes, os.stat_result]]) -> bool:
+        """Tells whether entries on one side (0: local, 1: remote) are as planned."""
+        paths = [self.src[side] + name for name, _ in entries]
+        if side == 1:
+            current = self.adb.StatMany(paths)
+        else:
+            current = {}
+            for path in paths:
+                try:
+                    current[path] = os.lstat(path)
+                except OSError:
+                    pass
+        for path, (_, planned) in zip(paths, entries):
+            s = current.get(path)
+            if s is None or stat.S_IFMT(s.st_mode) != stat.S_IFMT(planned.st_mode):
+                return False
+            if not stat.S_ISDIR(s.st_mode) and (
+                    s.st_size != planned.st_size or int(s.st_mtime) != int(planned.st_mtime)):
+                return False
+        return True
+
+    def _DeleteStaleParts(self) -> None:
+        """Deletes the part files no pull of this sync has resumed."""
+        suffix = AdbFileSystem.PART_SUFFIX
+        if self.config.remote_to_local:
+            # A part file has the mtime of the pull that left it, which the
+            # time range may leave out of the diff.
+            self.leftover_parts.update(
+                name[:-len(suffix)] for name in self.local_skipped
+                if name.endswith(suffix) and not self.excludes.Match(name)
+                and name not in self.remote_skipped)
+        for name in sorted(self.leftover_parts):
+            part = self.local + name + suffix
+            if os.path.isfile(part) and not os.path.islink(part):
+                logger.info('Delete-Stale-Part: {}', part)
+                if not self.config.dry_run:
+                    os.unlink(part)
+
+    def _Copy(self, i: int, kind: str, entries: List[Tuple[bytes, os.stat_result]]) -> None:
+        """Copy a transfer unit, then delete its sources and set its times."""
+        files = [(name, s) for name, s in entries if not stat.S_ISDIR(s.st_mode)]
+        for name, _ in entries:
+            self._LogCopy(i, name)
+        deletable = files
+        resumable = kind == HASHED or (
+            kind == FILE and i == 1 and self.config.resumable_pulls
+            and stat.S_ISREG(entries[0][1].st_mode))
+        # A resumable pull keeps what it got in its part file instead.
+        interruptible = [] if resumable else files
+        with DeleteInterruptedFile(self.config.dry_run, self.dst_fs[i],
+                                   *[self.dst[i] + name for name, _ in interruptible]):
+            if not self.config.dry_run:
+                start = time.time()
+                first = entries[0][0]
+                if kind == HASHED:
+                    deletable = self._PullVerified(files)
+                elif resumable:
+                    self.adb.PullHashed(self.src[i] + first, self.dst[i] + first,
+                                        entries[0][1].st_size)
+                elif kind == FILE:
+                    self.copy[i](self.src[i] + first, self.dst[i] + first)
+                elif kind == FILES:
+                    self.adb.PullMany([self.src[i] + name for name, _ in entries],
+                                      self.dst[i] + first[:first.rfind(b'/')])
+                elif kind == TAR:
+                    self.adb.PullTar(self.src[i], [name for name, _ in entries], self.dst[i])
+                else:
+                    self.adb.PullMany([self.src[i] + first], self.dst[i] + first)
+                dt = time.time() - start
+                self.metrics.AddPhase('transfer', dt)
+                self.metrics.AddTransfer([s.st_size for _, s in files if stat.S_ISREG(s.st_mode)], dt)
+                if self.config.del_source:
+                    with self.metrics.Phase('delete_source'):
+                        for name, _ in deletable:
+                            self.dst_fs[1 - i].unlink(self.src[i] + name)
+            num_bytes = sum(s.st_size for _, s in files if stat.S_ISREG(s.st_mode))
+            with self.lock:
+                self.num_bytes += num_bytes
+        if not self.config.dry_run and kind != TAR:
+            # Innermost first, so that filling a directory does not touch its time again.
+            for name, s in reversed(entries):
+                self._SetTimes(i, name, s)
+
+    def _PullVerified(self, files: List[Tuple[bytes, os.stat_result]]
+                      ) -> List[Tuple[bytes, os.stat_result]]:
+        """Pull files while hashing them, checking against hashes taken on the device.
+
+        Returns:
+          The files whose copies match; only their sources may be deleted.
+        """
+        expected = self.adb.Md5Many([self.remote + name for name, _ in files])
+        verified = []  # type: List[Tuple[bytes, os.stat_result]]
+        for name, s in files:
+            digest = self.adb.PullHashed(self.remote + name, self.local + name, s.st_size)
+            if expected.get(self.remote + name) == digest:
+                verified.append((name, s))
+            else:
+                logger.error('Checksum mismatch, keeping source: {}', self.remote + name)
+        return verified
+
+    def _LogCopy(self, i: int, name: bytes) -> None:
+        logger.info('{}: {}', self.push[i], (self.src[i] + name).decode("utf-8", "replace")
+                     + " -> " + (self.dst[i] + name).decode("utf-8", "replace"))
+
+    def _SetTimes(self, i: int, name: bytes, s: os.stat_result) -> None:
+        self.dst_fs[i].utime(self.dst[i] + name, (s.st_atime, s.st_mtime))
 
     def TimeReport(self) -> None:
         """Report time and amount of data transferred."""
@@ -198,59 +619,210 @@ class FileSyncer(object):
                          dt)
 
 
+@dataclasses.dataclass
+class WalkCounts:
+    """What a BuildFileList() walk came across."""
+    # The root and every name listed, whether left out or not.
+    visited: int = 0
+    # Names left out by the excludes.
+    excluded: int = 0
+    # Names left out by the time range.
+    filtered: int = 0
+
+
 def BuildFileList(
-        fs: OSLike, path: bytes, follow_links: bool, prefix: bytes, excludes: str, exlist=None, *, time_range
-) -> Iterable[Tuple[bytes, os.stat_result]]:
+        fs: OSLike, path: bytes, follow_links: bool, prefix: bytes, excludes: ExcludeMatcher, *, time_range,
+        skipped: Optional[Set[bytes]] = None, lister: Optional[ListingPrefetcher] = None,
+        counts: Optional[WalkCounts] = None
+) -> Iterator[Tuple[bytes, os.stat_result]]:
     """Builds a file list.
 
+    Walks the tree with an explicit stack of the directories being listed,
+    so each entry is yielded once however deep it is, and the depth is not
+    bounded by the recursion limit.
+
     Args:
-      fs: File system provider (can be os or AdbFileSystem()).
+      fs: File system provider (LocalFileSystem() or AdbFileSystem()).
       path: Initial path.
       follow_links: Whether to follow symlinks while iterating. May recurse
         endlessly.
       prefix: Path prefix for output file names.
+      excludes: Matcher for the prefixed names of entries to leave out.
+      skipped: If given, receives the prefixed names of entries that were
+        excluded or filtered out, and of directories that could not be listed
+        or were listed with filters on the device (with a trailing slash).
+      lister: If given, lists the directories instead of fs.listdir(),
+        possibly ahead of the walk.
+      counts: If given, counts what the walk comes across as it goes.
 
     Yields:
-      File names from path (prefixed by prefix).
+      File names from path (prefixed by prefix), in SortKey() order.
       Directories are yielded before their contents.
     """
-    if exlist is None:
-        exlist = []
-    try:
-        if follow_links:
-            statresult = fs.stat(path)
-        else:
-            statresult = fs.lstat(path)
-    except OSError:
-        return
-    if stat.S_ISDIR(statresult.st_mode):
-        yield prefix, statresult
+    if counts is None:
+        counts = WalkCounts()
+    # Per directory being walked: its path, prefix, the rest of its sorted
+    # names, and the names the time range keeps if known from the listing.
+    stack = []  # type: List[Tuple[bytes, bytes, Iterator[bytes], Optional[Set[bytes]]]]
+    counts.visited += 1
+    while path is not None:
         try:
-            files = fs.listdir(path)
-        except OSError:
-            return
-        for x in excludes:
-            exlist.extend(glob.glob(path + b"/" + x.encode()))
-            try:
-                exlist.extend(fs.glob(path + b"/" + x.encode()))
-            except:
-                pass
-        for n in files:
-            if n == b'.' or n == b'..' or ((path + b'/' + n) in exlist) or (n.decode(errors="replace") in excludes):
-                continue
+            if follow_links:
+                statresult = fs.stat(path)
             else:
-                for t in BuildFileList(fs, path + b'/' + n, follow_links,
-                                       prefix + b'/' + n, excludes, exlist, time_range=time_range):
-                    if t not in exlist:
-                        yield t
-    elif stat.S_ISREG(statresult.st_mode):
-        if within_time_range(statresult, time_range):
-            yield prefix, statresult
-    elif stat.S_ISLNK(statresult.st_mode) and not follow_links:
-        if within_time_range(statresult, time_range):
+                statresult = fs.lstat(path)
+        except OSError:
+            statresult = None
+        if statresult is None:
+            pass
+        elif stat.S_ISDIR(statresult.st_mode):
             yield prefix, statresult
-    else:
-        logger.info('Unsupported file: {}.', path)
+            listing = _ListForWalk(fs, path, follow_links, prefix, time_range, skipped, lister)
+            if listing is not None:
+                stack.append((path, prefix, iter(listing[0]), listing[1]))
+        elif stat.S_ISREG(statresult.st_mode) or (stat.S_ISLNK(statresult.st_mode) and not follow_links):
+            if within_time_range(statresult, time_range):
+                yield prefix, statresult
+            else:
+                counts.filtered += 1
+                if skipped is not None:
+                    skipped.add(prefix)
+        else:
+            logger.info('Unsupported file: {}.', path)
+            if skipped is not None:
+                skipped.add(prefix)
+        # On to the next name of the innermost directory with any left.
+        path = None
+        while stack and path is None:
+            dir_path, dir_prefix, names, kept = stack[-1]
+            for n in names:
+                if n == b'.' or n == b'..':
+                    continue
+                counts.visited += 1
+                name = dir_prefix + b'/' + n
+                if excludes.Match(name):
+                    counts.excluded += 1
+                elif kept is not None and n not in kept:
+                    counts.filtered += 1
+                else:
+                    path, prefix = dir_path + b'/' + n, name
+                    break
+                if skipped is not None:
+                    skipped.add(name)
+            else:
+                stack.pop()
+                if isinstance(fs, LocalFileSystem):
+                    # Excluded and filtered names were never stat'ed.
+                    fs.ForgetListing(dir_path)
+
+
+def _ListForWalk(fs: OSLike, path: bytes, follow_links: bool, prefix: bytes, time_range,
+                 skipped: Optional[Set[bytes]], lister: Optional[ListingPrefetcher]
+                 ) -> Optional[Tuple[List[bytes], Optional[Set[bytes]]]]:
+    """Lists a directory for BuildFileList().
+
+    Returns:
+      The sorted names in the directory and, if the listing tells without a
+      stat result per file, the names the time range keeps; None if the
+      directory could not be listed.
+    """
+    try:
+        # Sorted, so that the walk yields names in SortKey() order.
+        files = lister.Listdir(path) if lister is not None else sorted(fs.listdir(path))
+    except OSError:
+        if skipped is not None:
+            skipped.add(prefix + b'/')
+        return None
+    if skipped is not None and isinstance(fs, AdbFileSystem) and fs.ListedFiltered(path):
+        # What the device left out is unknown, so the whole directory counts.
+        skipped.add(prefix + b'/')
+    kept = None  # type: Optional[Set[bytes]]
+    if time_range is not None and not follow_links and isinstance(fs, AdbFileSystem):
+        # Masks over the listing find the files out of range at once,
+        # instead of a stat result per file.
+        in_range = fs.SelectNames(path, time_range=time_range)
+        if in_range is not None:
+            kept = in_range | fs.SelectNames(path, file_type=stat.S_IFDIR)
+    return files, kept
+
+
+def ScanAndDiffShared(syncers: List[FileSyncer]) -> None:
+    """Scans and diffs for several syncers of one remote tree with a single walk.
+
+    The syncers differ only in their local destination, time range and what
+    they do with the sources; the walk, listing options and excludes are
+    those of the first one. Each syncer then runs its phases as usual, the
+    first one driving the walk and the others reading what it buffered for
+    them. An entry whose mtime fits several time ranges goes to the first.
+    """
+    first = syncers[0]
+    first.PrefetchRemote(EnclosingTimeRange([s.config.time_range for s in syncers]))
+    walk_skipped = set()  # type: Set[bytes]
+    remotelist = first.WalkRemote(None, walk_skipped)
+    partitions = PartitionListing(remotelist, [s.config.time_range for s in syncers], walk_skipped)
+    for syncer, (entries, skipped) in zip(syncers, partitions):
+        syncer.ScanAndDiff(entries, skipped)
+
+
+def PartitionListing(listing: Iterable[Tuple[bytes, os.stat_result]], time_ranges: List,
+                     walk_skipped: Set[bytes]
+                     ) -> List[Tuple[Iterator[Tuple[bytes, os.stat_result]], Set[bytes]]]:
+    """Splits one walk into several listings by time range.
+
+    Directories go into every partition. Any other entry goes into the first
+    partition whose time range holds its mtime and counts as skipped in the
+    others, as if each had been walked by BuildFileList() with its own time
+    range. Whichever partition is read first drives the walk; what the
+    others have not read yet is buffered for them.
+
+    Args:
+      listing: Walk of the tree with no time range.
+      time_ranges: Time range of each partition.
+      walk_skipped: Where the walk records skipped names; they are moved on
+        to every partition as it goes.
+
+    Returns:
+      (entries, skipped) per partition; skipped is filled in as entries is
+      read.
+    """
+    listing = iter(listing)
+    lock = threading.Lock()
+    buffers = [collections.deque() for _ in time_ranges]  # type: List[collections.deque]
+    skipped = [set() for _ in time_ranges]  # type: List[Set[bytes]]
+
+    def Step() -> bool:
+        """Routes the next entry of the walk; returns False at its end."""
+        entry = next(listing, None)
+        for names in skipped:
+            names.update(walk_skipped)
+        walk_skipped.clear()
+        if entry is None:
+            return False
+        name, s = entry
+        for k, time_range in enumerate(time_ranges):
+            if stat.S_ISDIR(s.st_mode):
+                buffers[k].append(entry)
+            elif within_time_range(s, time_range):
+                buffers[k].append(entry)
+                # Skipped by the partitions after it.
+                for names in skipped[k + 1:]:
+                    names.add(name)
+                break
+            else:
+                skipped[k].add(name)
+        return True
+
+    def Read(buffer: collections.deque) -> Iterator[Tuple[bytes, os.stat_result]]:
+        while True:
+            with lock:
+                while not buffer and Step():
+                    pass
+                if not buffer:
+                    return
+                entry = buffer.popleft()
+            yield entry
+
+    return [(Read(buffer), names) for buffer, names in zip(buffers, skipped)]
 
 
 def within_time_range(statresult, time_range):
@@ -259,54 +831,65 @@ def within_time_range(statresult, time_range):
         (time_range[1] is None or statresult.st_mtime <= time_range[1])
 
 
-def DiffLists(a: Iterable[Tuple[bytes, os.stat_result]],
-              b: Iterable[Tuple[bytes, os.stat_result]]
-              ) -> Tuple[List[Tuple[bytes, os.stat_result]], List[
-    Tuple[bytes, os.stat_result, os
-        .stat_result]], List[Tuple[bytes, os.stat_result]]]:
-    """Compares two lists.
+def EnclosingTimeRange(time_ranges: List[Optional[Sequence[Optional[int]]]]
+                       ) -> Optional[Sequence[Optional[int]]]:
+    """Returns the smallest time range holding all of time_ranges."""
+    if any(time_range is None for time_range in time_ranges):
+        return None
+    starts = [time_range[0] for time_range in time_ranges]
+    ends = [time_range[1] for time_range in time_ranges]
+    return [None if None in starts else min(starts), None if None in ends else max(ends)]
+
+
+def SortKey(name: bytes) -> bytes:
+    """Orders names the way a depth first walk with sorted directories yields them."""
+    # '/' has to sort before any other character, so that 'a/b' precedes 'a.b'.
+    return name.replace(b'/', b'\0')
+
+
+def DiffStreams(a: Iterable[Tuple[bytes, os.stat_result]],
+                b: Iterable[Tuple[bytes, os.stat_result]]) -> Iterator[DiffRecord]:
+    """Compares two listings by merging them, as they are produced.
 
     Args:
-      a: the first list.
-      b: the second list.
+      a: the first listing, in SortKey() order.
+      b: the second listing, in SortKey() order.
 
-    Returns:
-      a_only: the items from list a.
-      both: the items from both list, with the remaining tuple items combined.
-      b_only: the items from list b.
+    Yields:
+      (name, a_stat, b_stat) for each name in either listing, in SortKey()
+      order; the stat result is None on the side missing the name.
+
+    Raises:
+      ValueError: if a listing is not in order.
     """
-    a_only = []  # type: List[Tuple[bytes, os.stat_result]]
-    b_only = []  # type: List[Tuple[bytes, os.stat_result]]
-    both = []  # type: List[Tuple[bytes, os.stat_result, os.stat_result]]
-
-    a_revlist = sorted(a)
-    a_revlist.reverse()
-    b_revlist = sorted(b)
-    b_revlist.reverse()
-
-    while True:
-        if not a_revlist:
-            b_only.extend(reversed(b_revlist))
-            break
-        if not b_revlist:
-            a_only.extend(reversed(a_revlist))
-            break
-        a_item = a_revlist[len(a_revlist) - 1]
-        b_item = b_revlist[len(b_revlist) - 1]
-        if a_item[0] == b_item[0]:
-            both.append((a_item[0], a_item[1], b_item[1]))
-            a_revlist.pop()
-            b_revlist.pop()
-        elif a_item[0] < b_item[0]:
-            a_only.append(a_item)
-            a_revlist.pop()
-        elif a_item[0] > b_item[0]:
-            b_only.append(b_item)
-            b_revlist.pop()
+    a = iter(a)
+    b = iter(b)
+    a_item = next(a, None)
+    b_item = next(b, None)
+    a_key = None if a_item is None else SortKey(a_item[0])
+    b_key = None if b_item is None else SortKey(b_item[0])
+    while a_item is not None or b_item is not None:
+        if b_key is None or (a_key is not None and a_key < b_key):
+            yield a_item[0], a_item[1], None
+            a_item, a_key = _NextInOrder(a, a_key)
+        elif a_key is None or a_key > b_key:
+            yield b_item[0], None, b_item[1]
+            b_item, b_key = _NextInOrder(b, b_key)
         else:
-            raise
+            yield a_item[0], a_item[1], b_item[1]
+            a_item, a_key = _NextInOrder(a, a_key)
+            b_item, b_key = _NextInOrder(b, b_key)
 
-    return a_only, both, b_only
+
+def _NextInOrder(it: Iterator[Tuple[bytes, os.stat_result]], key: bytes
+                 ) -> Tuple[Optional[Tuple[bytes, os.stat_result]], Optional[bytes]]:
+    item = next(it, None)
+    if item is None:
+        return None, None
+    next_key = SortKey(item[0])
+    if next_key <= key:
+        raise ValueError('Listing out of order at %r' % (item[0],))
+    return item, next_key
 
 
 def ExpandWildcards(globber: GlobLike, path: bytes) -> Iterable[bytes]:
@@ -338,7 +921,7 @@ def FixPath(src: bytes, dst: bytes) -> Tuple[bytes, bytes]:
 
 class DeleteInterruptedFile(object):
 
-    def __init__(self, dry_run: bool, fs: OSLike, name: bytes) -> None:
+    def __init__(self, dry_run: bool, fs: OSLike, *names: bytes) -> None:
         """Sets up interrupt protection.
 
         Usage:
@@ -351,14 +934,15 @@ class DeleteInterruptedFile(object):
         Args:
           dry_run: If true, we don't actually delete.
           fs: File system object.
-          name: File name to delete.
+          names: File names to delete. With more than one, files that were not
+            created yet are skipped silently.
 
         Returns:
           An object for use by 'with'.
         """
         self.dry_run = dry_run
         self.fs = fs
-        self.name = name
+        self.names = names
 
     def __enter__(self) -> None:
         pass
@@ -367,12 +951,14 @@ class DeleteInterruptedFile(object):
                  exc_val: Optional[Exception],
                  exc_tb: Optional[TracebackType]) -> bool:
         if exc_type is not None:
-            logger.warning(
-                'Interrupted-{}-Delete: {}: {}',
-                'Pull' if self.fs == os else 'Push', self.name, exc_val)
-            if not self.dry_run:
-                try:
-                    self.fs.unlink(self.name)
-                except Exception as e:
-                    logger.warning('Failed to delete interrupted file: {}.', e)
+            for name in self.names:
+                logger.warning(
+                    'Interrupted-{}-Delete: {}: {}',
+                    'Pull' if isinstance(self.fs, LocalFileSystem) else 'Push', name, exc_val)
+                if not self.dry_run:
+                    try:
+                        self.fs.unlink(name)
+                    except Exception as e:
+                        if len(self.names) == 1 or not isinstance(e, FileNotFoundError):
+                            logger.warning('Failed to delete interrupted file: {}.', e)
         return False
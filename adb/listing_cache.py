@@ -0,0 +1,156 @@
+import hashlib
+import itertools
+import os
+import sqlite3
+import stat
+import uuid
+from typing import Optional, Set, Tuple
+
+from loguru import logger
+
+from .adb_file_system import AdbFileSystem
+from .listing_store import ListingStore
+
+# Where the stamp files marking the time of a snapshot live on the device.
+STAMP_DIR = b'/data/local/tmp'
+
+
+class ListingCache(object):
+    """Snapshot of remote directory listings, kept on disk between runs.
+
+    Along with each snapshot, a stamp file is touched on the device right
+    before listing. On the next scan, one 'find -cnewer' reports everything
+    changed since: directories whose entries changed are listed again, files
+    modified in place are stat'ed again, and everything else is taken from
+    the snapshot. Comparing ctimes also catches files whose mtime was set
+    back.
+
+    Each snapshot has a random token, which is part of its stamp's name, so
+    that snapshots of one tree in several caches each keep their own stamp.
+    A snapshot is saved before the stamp of the one it replaces is removed;
+    without its stamp, a snapshot is not used.
+    """
+
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS dirs (
+                root BLOB, dir BLOB, PRIMARY KEY (root, dir));
+            CREATE TABLE IF NOT EXISTS entries (
+                root BLOB, dir BLOB, name BLOB,
+                mode INTEGER, size INTEGER, mtime INTEGER,
+                PRIMARY KEY (root, dir, name));
+            CREATE TABLE IF NOT EXISTS snapshots (
+                root BLOB PRIMARY KEY, token TEXT);
+        ''')
+
+    def Close(self) -> None:
+        self.db.close()
+
+    def Prefetch(self, adb: AdbFileSystem, root: bytes, save: bool = True) -> None:
+        """Fills adb's listdir_cache and stat_cache for a tree, then saves it.
+
+        Args:
+          adb: File system to list with and to fill.
+          root: Root of the tree, spelled the same way as later listdir() calls.
+          save: Whether to stamp and save the new snapshot; if not, e.g. for a
+            dry run, neither the device nor the cache is changed.
+        """
+        stamp_prefix = STAMP_DIR + b'/meow_listing_%s_' % (
+            hashlib.md5(root).hexdigest()[:16].encode('ascii'),)
+        token = uuid.uuid4().hex[:16]
+        new_stamp = stamp_prefix + token.encode('ascii')
+        listings, old_token = self._Load(root)
+        stamp = None if old_token is None else stamp_prefix + old_token.encode('ascii')
+        changed = None  # type: Optional[Set[bytes]]
+        if listings and stamp is not None:
+            quoted = adb.QuoteArgument(stamp)
+            touch = b' touch %s || exit 3;' % (adb.QuoteArgument(new_stamp),) if save else b''
+            # Older finds only know -newer, which misses mtimes set back.
+            status, output = adb.shell.Run(
+                b'[ -e %s ] || exit 3;%s newer=-cnewer;'
+                b' find %s -maxdepth 0 -cnewer %s >/dev/null 2>&1 || newer=-newer;'
+                b' find %s $newer %s; exit 0' % (
+                    quoted, touch, quoted, quoted, adb.QuoteArgument(root + b'/'), quoted))
+            if status == 0:
+                changed = set(adb.RebasePath(root, line.rstrip(b'\r'))
+                              for line in output.split(b'\n') if line)
+        if changed is None:
+            stamped = save and adb.shell.Run(b'touch %s' % (adb.QuoteArgument(new_stamp),))[0] == 0
+            listings = ListingStore()
+            for directory, _ in adb.ListTree(root):
+                listings.SetDir(directory, adb.stat_cache.Entries(directory))
+        else:
+            stamped = save
+            listings = self._Update(adb, root, listings, changed)
+            logger.info('Listing cache: {} changed entries, {} directories.',
+                        len(changed), len(listings.Dirs()))
+        if stamped:
+            try:
+                self._Save(root, listings, token)
+            except BaseException:
+                adb.shell.Run(b'rm -f %s' % (adb.QuoteArgument(new_stamp),))
+                raise
+            if stamp is not None:
+                adb.shell.Run(b'rm -f %s' % (adb.QuoteArgument(stamp),))
+        elif save:
+            logger.warning('Could not stamp listing of {}; not caching it.', root)
+        for directory in listings.Dirs():
+            adb.listdir_cache[directory] = listings.Select(directory)
+
+    def _Update(self, adb: AdbFileSystem, root: bytes, old: ListingStore,
+                changed: Set[bytes]) -> ListingStore:
+        """Brings a loaded snapshot up to date, listing only what changed."""
+        listings = ListingStore()
+        restat = []  # type: list[bytes]
+        pending = [root]
+        while pending:
+            relist = []  # type: list[bytes]
+            subdirs = []  # type: list[bytes]
+            for directory in pending:
+                if directory in changed or not old.HasDir(directory):
+                    relist.append(directory)
+                    continue
+                entries = old.Entries(directory)
+                listings.SetDir(directory, entries)
+                adb.stat_cache.SetDir(directory, entries)
+                for name, s in entries:
+                    path = directory + b'/' + name
+                    if stat.S_ISDIR(s.st_mode):
+                        subdirs.append(path)
+                    elif path in changed:
+                        restat.append(path)
+            for directory, _ in adb.ListDirs(root, relist):
+                listings.SetDir(directory, adb.stat_cache.Entries(directory))
+                subdirs.extend(directory + b'/' + name
+                               for name in listings.Select(directory, file_type=stat.S_IFDIR))
+            pending = subdirs
+        for path, s in adb.StatMany(restat).items():
+            listings.Set(path, s)
+        return listings
+
+    def _Load(self, root: bytes) -> Tuple[ListingStore, Optional[str]]:
+        """Returns the snapshot of a tree and its token; None if it has none."""
+        row = self.db.execute('SELECT token FROM snapshots WHERE root = ?', (root,)).fetchone()
+        listings = ListingStore()
+        rows = self.db.execute(
+            'SELECT dirs.dir, name, mode, size, mtime FROM dirs LEFT JOIN entries'
+            ' ON entries.root = dirs.root AND entries.dir = dirs.dir'
+            ' WHERE dirs.root = ? ORDER BY dirs.dir', (root,))
+        for directory, group in itertools.groupby(rows, lambda row: row[0]):
+            listings.SetDir(directory, [(name, AdbFileSystem.MakeStat(mode, size, mtime))
+                                        for _, name, mode, size, mtime in group
+                                        if name is not None])
+        return listings, None if row is None else row[0]
+
+    def _Save(self, root: bytes, listings: ListingStore, token: str) -> None:
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?)', (root, token))
+            self.db.execute('DELETE FROM dirs WHERE root = ?', (root,))
+            self.db.execute('DELETE FROM entries WHERE root = ?', (root,))
+            self.db.executemany('INSERT INTO dirs VALUES (?, ?)',
+                                ((root, directory) for directory in listings.Dirs()))
+            self.db.executemany(
+                'INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                ((root,) + item for item in listings.Items()))
@@ -0,0 +1,138 @@
+import collections
+import stat
+import threading
+from types import TracebackType
+from typing import Callable, List, Optional, Type
+
+from .os_like import OSLike
+
+
+class ListingPrefetcher(object):
+    """Lists the directories of a tree on several threads, ahead of a walk.
+
+    Usage:
+      with ListingPrefetcher(fs, 4, root, Wanted) as lister:
+        Walk(root), calling lister.Listdir(path) instead of fs.listdir(path)
+
+      Workers take directories from a queue in breadth first order; every
+      listing adds the subdirectories Wanted() accepts to its end. The walk
+      may visit the directories in any order: asking for one that is still
+      queued moves it to the front, and asking for one nobody listed lists it
+      right away. The listings are sorted, as a depth first walk needs them to
+      yield names in order.
+
+      A directory is listed for each time it is queued or asked for; a walk
+      should ask once for each directory it gets to.
+
+    Args:
+      fs: File system to list; its listdir(), lstat() and stat() must allow
+        calls from several threads.
+      workers: Maximum number of listings in flight.
+      root: Directory to start listing at.
+      wanted: Tells whether to list a subdirectory, by its path; e.g. False
+        if the walk excludes it.
+      follow_links: Whether symlinks to directories count as directories.
+    """
+
+    def __init__(self, fs: OSLike, workers: int, root: bytes, wanted: Callable[[bytes], bool],
+                 follow_links: bool = False) -> None:
+        self.fs = fs
+        self.workers = max(1, workers)
+        self.wanted = wanted
+        self.follow_links = follow_links
+        self.cond = threading.Condition()
+        self.queue = collections.deque([root])  # type: collections.deque[bytes]
+        # Queued directories; a path may be in the queue twice once moved to
+        # the front, and is listed where it is met first.
+        self.queued = {root}  # type: set[bytes]
+        self.in_flight = set()  # type: set[bytes]
+        # Per directory listed: its sorted names, or the exception listing it raised.
+        self.results = {}  # type: dict[bytes, tuple[Optional[list[bytes]], Optional[BaseException]]]
+        self.stopped = False
+
+    def __enter__(self) -> 'ListingPrefetcher':
+        for i in range(self.workers):
+            threading.Thread(target=self._Work, name='listing-%d' % (i,), daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]],
+                 exc_val: Optional[Exception],
+                 exc_tb: Optional[TracebackType]) -> bool:
+        # Listings in flight finish on their own; nothing waits for them.
+        with self.cond:
+            self.stopped = True
+            self.queue.clear()
+            self.queued.clear()
+            self.results.clear()
+            self.cond.notify_all()
+        return False
+
+    def Listdir(self, path: bytes) -> List[bytes]:
+        """Returns the sorted names in a directory, as listed ahead if it was.
+
+        Raises:
+          OSError: if the directory could not be listed.
+        """
+        with self.cond:
+            if path in self.queued:
+                self.queue.appendleft(path)
+                self.cond.notify_all()
+            elif path not in self.in_flight and path not in self.results:
+                # Not expected by the workers; list it here.
+                self.in_flight.add(path)
+                self.cond.release()
+                try:
+                    self._List(path)
+                finally:
+                    self.cond.acquire()
+            while path not in self.results:
+                self.cond.wait()
+            names, error = self.results.pop(path)
+        if error is not None:
+            raise error
+        return names
+
+    def _Work(self) -> None:
+        with self.cond:
+            while True:
+                while not self.stopped and not self.queue:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                path = self.queue.popleft()
+                if path not in self.queued:
+                    continue
+                self.queued.discard(path)
+                self.in_flight.add(path)
+                self.cond.release()
+                try:
+                    self._List(path)
+                finally:
+                    self.cond.acquire()
+
+    def _List(self, path: bytes) -> None:
+        """Lists a directory, queueing its subdirectories; called unlocked."""
+        names = None  # type: Optional[List[bytes]]
+        error = None  # type: Optional[BaseException]
+        subdirs = []  # type: List[bytes]
+        try:
+            names = sorted(n for n in self.fs.listdir(path) if n != b'.' and n != b'..')
+            for n in names:
+                child = path + b'/' + n
+                try:
+                    s = self.fs.stat(child) if self.follow_links else self.fs.lstat(child)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(s.st_mode) and self.wanted(child):
+                    subdirs.append(child)
+        except BaseException as e:
+            error = e
+        with self.cond:
+            self.in_flight.discard(path)
+            if self.stopped:
+                return
+            self.results[path] = (names, error)
+            for child in subdirs:
+                self.queued.add(child)
+                self.queue.append(child)
+            self.cond.notify_all()
@@ -0,0 +1,227 @@
+import array
+import bisect
+import os
+import stat
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Stored for a size 'ls -l' does not show.
+_NO_SIZE = -1
+# The file type bits of a mode, as stat.S_IFMT() keeps them.
+_TYPE_MASK = 0o170000
+
+
+class ListingStore(object):
+    """Stat results of listed directories, kept in columns.
+
+    Every entry is one row: its name in a shared byte buffer, and its mode,
+    size and mtime in typed arrays. A directory's rows are contiguous and
+    sorted by name, so an entry is found by binary search. This takes some
+    50 bytes per entry, where a dict of paths to os.stat_result objects takes
+    several hundred.
+
+    Listing a directory again appends new rows and leaves the old ones
+    unused; once they make up half the rows, the columns are compacted.
+
+    Only the fields the syncer uses survive: stat results read back have
+    the mtime as atime and ctime, and dummy values for everything else.
+    """
+
+    def __init__(self) -> None:
+        self.Clear()
+
+    def Clear(self) -> None:
+        """Forgets everything stored."""
+        self.dir_ids = {}  # type: dict[bytes, int]
+        self.dir_paths = []  # type: List[bytes]
+        # Per directory id: first row and number of rows.
+        self.dir_rows = []  # type: List[Tuple[int, int]]
+        self.names = bytearray()
+        self.name_ends = array.array('Q')
+        self.modes = array.array('I')
+        self.sizes = array.array('q')
+        self.mtimes = array.array('q')
+        # Rows left unused by directories listed again.
+        self.stale_rows = 0
+        # Entries of directories that were never listed, e.g. single lstat()s.
+        self.extra = {}  # type: dict[bytes, os.stat_result]
+
+    def SetDir(self, directory: bytes, entries: Iterable[Tuple[bytes, os.stat_result]]) -> None:
+        """Stores the complete listing of a directory, replacing any earlier one."""
+        dir_id = self.dir_ids.get(directory)
+        if dir_id is None:
+            dir_id = self.dir_ids[directory] = len(self.dir_paths)
+            self.dir_paths.append(directory)
+            self.dir_rows.append((0, 0))
+        else:
+            self.stale_rows += self.dir_rows[dir_id][1]
+        entries = sorted(entries, key=lambda entry: entry[0])
+        start = len(self.modes)
+        for name, s in entries:
+            self.names += name
+            self.name_ends.append(len(self.names))
+            self.modes.append(s.st_mode)
+            self.sizes.append(_NO_SIZE if s.st_size is None else s.st_size)
+            self.mtimes.append(int(s.st_mtime))
+        self.dir_rows[dir_id] = (start, len(entries))
+        if self.extra:
+            for name, _ in entries:
+                self.extra.pop(directory + b'/' + name, None)
+        if self.stale_rows * 2 > len(self.modes):
+            self._Compact()
+
+    def _Compact(self) -> None:
+        """Drops the rows of replaced listings, moving every directory's rows down."""
+        names = bytearray()
+        name_ends = array.array('Q')
+        modes = array.array('I')
+        sizes = array.array('q')
+        mtimes = array.array('q')
+        for dir_id, (start, count) in enumerate(self.dir_rows):
+            if not count:
+                continue
+            end = start + count
+            names_start = self.name_ends[start - 1] if start else 0
+            shift = len(names) - names_start
+            names += self.names[names_start:self.name_ends[end - 1]]
+            name_ends.extend(name_end + shift for name_end in self.name_ends[start:end])
+            self.dir_rows[dir_id] = (len(modes), count)
+            modes += self.modes[start:end]
+            sizes += self.sizes[start:end]
+            mtimes += self.mtimes[start:end]
+        self.names, self.name_ends = names, name_ends
+        self.modes, self.sizes, self.mtimes = modes, sizes, mtimes
+        self.stale_rows = 0
+
+    def Set(self, path: bytes, s: os.stat_result) -> None:
+        """Stores the stat result of a single path."""
+        row = self._Find(path)
+        if row is None:
+            self.extra[path] = s
+        else:
+            self.modes[row] = s.st_mode
+            self.sizes[row] = _NO_SIZE if s.st_size is None else s.st_size
+            self.mtimes[row] = int(s.st_mtime)
+
+    def Get(self, path: bytes) -> Optional[os.stat_result]:
+        """Returns the stored stat result of a path, if any."""
+        row = self._Find(path)
+        if row is None:
+            return self.extra.get(path)
+        return self._Stat(row)
+
+    def HasDir(self, directory: bytes) -> bool:
+        return directory in self.dir_ids
+
+    def Dirs(self) -> List[bytes]:
+        """Returns the listed directories."""
+        return list(self.dir_paths)
+
+    def Entries(self, directory: bytes) -> Optional[List[Tuple[bytes, os.stat_result]]]:
+        """Returns the listing of a directory, sorted by name; None if it was not listed."""
+        rows = self._Rows(directory)
+        if rows is None:
+            return None
+        return [(self._Name(row), self._Stat(row)) for row in rows]
+
+    def Items(self) -> Iterator[Tuple[bytes, bytes, int, Optional[int], int]]:
+        """Yields (directory, name, mode, size, mtime) for every listed entry."""
+        for directory in self.dir_paths:
+            for row in self._Rows(directory):
+                size = self.sizes[row]
+                yield (directory, self._Name(row), self.modes[row],
+                       None if size == _NO_SIZE else size, self.mtimes[row])
+
+    def Select(self, directory: bytes, *, file_type: Optional[int] = None,
+               time_range: Optional[Sequence[Optional[int]]] = None,
+               size_range: Optional[Sequence[Optional[int]]] = None) -> Optional[List[bytes]]:
+        """Filters the listing of a directory with vectorized masks.
+
+        Args:
+          directory: Listed directory.
+          file_type: Only keep entries of this stat.S_IFMT() type.
+          time_range: Only keep entries with mtimes in this inclusive range;
+            None for an open end.
+          size_range: Only keep entries with sizes in this inclusive range;
+            None for an open end.
+
+        Returns:
+          The names of the entries kept, sorted; None if the directory was not
+          listed.
+        """
+        rows = self._Rows(directory)
+        if rows is None:
+            return None
+        if numpy is not None:
+            mask = numpy.ones(len(rows), dtype=bool)
+            if file_type is not None:
+                modes = numpy.frombuffer(self.modes, dtype=numpy.uint32)[rows.start:rows.stop]
+                mask &= (modes & _TYPE_MASK) == file_type
+            for column, dtype, limits in [(self.mtimes, numpy.int64, time_range),
+                                          (self.sizes, numpy.int64, size_range)]:
+                if limits is None:
+                    continue
+                values = numpy.frombuffer(column, dtype=dtype)[rows.start:rows.stop]
+                if limits[0] is not None:
+                    mask &= values >= limits[0]
+                if limits[1] is not None:
+                    mask &= values <= limits[1]
+            kept = (rows.start + i for i in numpy.flatnonzero(mask).tolist())
+        else:
+            kept = rows
+            if file_type is not None:
+                kept = [row for row in kept if stat.S_IFMT(self.modes[row]) == file_type]
+            for column, limits in [(self.mtimes, time_range), (self.sizes, size_range)]:
+                if limits is None:
+                    continue
+                low, high = limits
+                kept = [row for row in kept
+                        if (low is None or low <= column[row]) and (high is None or column[row] <= high)]
+        return [self._Name(row) for row in kept]
+
+    def _Rows(self, directory: bytes) -> Optional[range]:
+        dir_id = self.dir_ids.get(directory)
+        if dir_id is None:
+            return None
+        start, count = self.dir_rows[dir_id]
+        return range(start, start + count)
+
+    def _Find(self, path: bytes) -> Optional[int]:
+        pos = path.rfind(b'/')
+        if pos < 0:
+            return None
+        rows = self._Rows(path[:pos])
+        if rows is None:
+            return None
+        name = path[pos + 1:]
+        i = bisect.bisect_left(_Names(self, rows), name)
+        if i < len(rows) and self._Name(rows[i]) == name:
+            return rows[i]
+        return None
+
+    def _Name(self, row: int) -> bytes:
+        return bytes(self.names[self.name_ends[row - 1] if row else 0:self.name_ends[row]])
+
+    def _Stat(self, row: int) -> os.stat_result:
+        size = self.sizes[row]
+        mtime = self.mtimes[row]
+        return os.stat_result((self.modes[row], 1, 0, 1, -2, -2,
+                               None if size == _NO_SIZE else size, mtime, mtime, mtime))
+
+
+class _Names(object):
+    """The names of a range of rows, as a sequence for bisect."""
+
+    def __init__(self, store: ListingStore, rows: range) -> None:
+        self.store = store
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.store._Name(self.rows[i])
@@ -0,0 +1,80 @@
+import os
+import shutil
+from typing import Iterable, Optional, Tuple
+
+from .os_like import OSLike
+
+# Whether os.scandir() returns the whole stat result with each entry, as
+# FindNextFile() does on Windows. Elsewhere it only knows the type, and
+# keeping the entries would cost more than it saves.
+SCANDIR_STATS = os.name == 'nt'
+
+
+class LocalFileSystem(OSLike):
+    """The local file system.
+
+    Directories are listed with os.listdir(), or with os.scandir() where
+    that carries stat results (see SCANDIR_STATS). listdir() then keeps the
+    DirEntry of each name until it is lstat'ed or stat'ed, so a walk needs
+    no further call per entry; what a walk leaves unused, it drops with
+    ForgetListing(). Paths are bytes throughout, which os takes as they
+    are; on Windows it decodes them as UTF-8.
+    """
+
+    def __init__(self) -> None:
+        # Per listed directory: the entries not yet stat'ed, by name.
+        self.entries = {}  # type: dict[bytes, dict[bytes, os.DirEntry]]
+
+    def listdir(self, path: bytes) -> Iterable[bytes]:  # os's name, so pylint: disable=g-bad-name
+        if not SCANDIR_STATS:
+            return os.listdir(path)
+        with os.scandir(path) as it:
+            entries = {entry.name: entry for entry in it}
+        self.entries[path] = entries
+        return list(entries)
+
+    def ForgetListing(self, path: bytes) -> None:
+        """Drops what is left of the listing of a directory a walk is done with."""
+        self.entries.pop(path, None)
+
+    def _PopEntry(self, path: bytes) -> Optional[os.DirEntry]:
+        if not self.entries:
+            return None
+        directory, _, name = path.rpartition(b'/')
+        entries = self.entries.get(directory)
+        return None if entries is None else entries.pop(name, None)
+
+    def lstat(self, path: bytes) -> os.stat_result:  # os's name, so pylint: disable=g-bad-name
+        entry = self._PopEntry(path)
+        if entry is not None:
+            return entry.stat(follow_symlinks=False)
+        return os.lstat(path)
+
+    def stat(self, path: bytes) -> os.stat_result:  # os's name, so pylint: disable=g-bad-name
+        entry = self._PopEntry(path)
+        if entry is not None:
+            return entry.stat()
+        return os.stat(path)
+
+    def unlink(self, path: bytes) -> None:  # os's name, so pylint: disable=g-bad-name
+        self._PopEntry(path)
+        os.unlink(path)
+
+    def rmdir(self, path: bytes) -> None:  # os's name, so pylint: disable=g-bad-name
+        self._PopEntry(path)
+        self.entries.pop(path, None)
+        os.rmdir(path)
+
+    def makedirs(self, path: bytes) -> None:  # os's name, so pylint: disable=g-bad-name
+        os.makedirs(path)
+
+    def utime(self, path: bytes, times: Tuple[float, float]) -> None:  # os's name, so pylint: disable=g-bad-name
+        os.utime(path, times)
+
+    def Link(self, src: bytes, dst: bytes) -> None:
+        """Hardlinks src to a new name dst."""
+        os.link(src, dst)
+
+    def CopyFile(self, src: bytes, dst: bytes) -> None:
+        """Copies the file src to dst, with its times and mode."""
+        shutil.copy2(src, dst)
@@ -21,14 +21,20 @@ from pathlib import PurePosixPath
 import subprocess
 import datetime
 import posixpath
-from typing import List
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 from loguru import logger
 
 from .adb_file_system import AdbFileSystem
 from .file_syncer import FileSyncer
 from .sync_config import SyncConfig
 from .adb_file_system import AdbFileSystem
-from .file_syncer import FixPath
+from .adb_socket_file_system import AdbSocketFileSystem
+from .file_syncer import FixPath, ScanAndDiffShared
+from .sync_plan import ReadPlan
 from .sync_config import SyncConfig
 from .time_range_parser import parse_date
 
@@ -119,36 +125,293 @@ if os.name == 'nt':
     subprocess.list2cmdline = list2cmdline_patch
 
 
-def do_sync(adb: AdbFileSystem, localpath: bytes, remotepath: bytes, cfg: SyncConfig):
-    syncer = FileSyncer(adb, localpath, remotepath, cfg)
+def do_sync(adb: AdbFileSystem, localpath: bytes, remotepath: bytes, cfg: SyncConfig,
+            metrics_path: Optional[str] = None, plan_path: Optional[str] = None,
+            seed_path: Optional[bytes] = None) -> Optional[FileSyncer]:
+    """Syncs one directory.
+
+    Args:
+      metrics_path: Where to write the metrics of this sync as JSON, if set.
+      plan_path: With cfg.dry_run, where to write the plan for apply_plan().
+      seed_path: Earlier snapshot of localpath to take unchanged files from.
+    """
+    # The metrics of adb then only cover this sync.
+    adb.metrics.Reset()
+    syncer = FileSyncer(adb, localpath, remotepath, cfg, plan_path, seed_path)
     if not syncer.IsWorking():
         logger.error('Device not connected or not working.')
-        return
+        return None
     syncer.ScanAndDiff()
     syncer.PerformDeletions()
     syncer.PerformOverwrites()
+    syncer.PerformSeeding()
     syncer.PerformCopies()
     syncer.TimeReport()
+    if metrics_path is not None:
+        syncer.metrics.Export(metrics_path)
+    return syncer
 
 
-def do(date_digits: str, keep_days: int, dirs: List[str], bak_home: str, *, excludes: List[str]):
-    adb = AdbFileSystem([b'adb'])
+def do_sync_split(adb: AdbFileSystem, remotepath: bytes,
+                  targets: List[Tuple[bytes, SyncConfig, Optional[str], Optional[bytes]]],
+                  metrics_path: Optional[str] = None) -> List[FileSyncer]:
+    """Syncs one remote directory into several local ones with a single scan.
+
+    Args:
+      targets: (local path, config, plan path, seed path) tuples; the configs
+        differ only in their time ranges and what they do with the sources.
+        See ScanAndDiffShared(). The plan and seed paths are as for do_sync().
+      metrics_path: Where to write the metrics of the syncs as JSON, if set.
+    """
+    adb.metrics.Reset()
+    syncers = [FileSyncer(adb, localpath, remotepath, cfg, plan_path, seed_path)
+               for localpath, cfg, plan_path, seed_path in targets]
+    if not syncers[0].IsWorking():
+        logger.error('Device not connected or not working.')
+        return []
+    ScanAndDiffShared(syncers)
+    for syncer in syncers:
+        syncer.PerformDeletions()
+        syncer.PerformOverwrites()
+        syncer.PerformSeeding()
+        syncer.PerformCopies()
+        syncer.TimeReport()
+    if metrics_path is not None:
+        adb.metrics.Export(metrics_path)
+    return syncers
+
+
+def apply_plan(adb: AdbFileSystem, plan_path: str,
+               transfer_limit: Optional[threading.Semaphore] = None) -> Optional[FileSyncer]:
+    """Performs a sync as planned by a dry run, without scanning again.
+
+    Args:
+      plan_path: Plan written by do_sync() or do_sync_split().
+      transfer_limit: See SyncConfig.transfer_limit.
+    """
+    header, ops = ReadPlan(plan_path)
+    cfg = SyncConfig(**header['config'])
+    cfg.transfer_limit = transfer_limit
+    syncer = FileSyncer(adb, header['local'], header['remote'], cfg, seed_path=header.get('seed'))
+    if not syncer.IsWorking():
+        logger.error('Device not connected or not working.')
+        return None
+    syncer.ApplyPlan(ops)
+    syncer.TimeReport()
+    return syncer
+
+
+def list_devices(adb: bytes = b'adb') -> List[str]:
+    """Returns the serials of the devices 'adb devices' lists as ready."""
+    output = subprocess.check_output([adb, b'devices']).decode('utf-8', 'replace')
+    serials = []
+    for line in output.splitlines()[1:]:
+        fields = line.split()
+        if len(fields) >= 2 and fields[1] == 'device':
+            serials.append(fields[0])
+    return serials
+
+
+def do(date_digits: str, keep_days: int, dirs: List[str], bak_home: str, *, excludes: List[str],
+       serials: Optional[List[str]] = None, transfer_workers: int = 1,
+       max_transfers: Optional[int] = None, transfer_mode: str = 'pull',
+       verify_before_delete: bool = False, pipelined_scan: bool = False,
+       resumable_pulls: bool = False, listing_cache: bool = False, metrics: bool = False,
+       dry_run: bool = False, native_adb: bool = False):
+    """Backs up dirs of one or more devices, all at the same time.
+
+    Args:
+      date_digits: Date of the backup, as parsed by parse_date().
+      keep_days: Files modified in this many days before the date are copied
+        to 'storage-keep' and kept on the device; older ones are moved to
+        'storage'. Files of 'storage-keep' the newest earlier backup has
+        unchanged are hardlinked from it instead of pulled again.
+      dirs: Directories below /sdcard to back up.
+      bak_home: Local backup root. With more than one device, each gets its
+        own root below it, named after its serial.
+      excludes: Patterns of names to skip.
+      serials: Devices to back up; all devices 'adb devices' lists as ready if
+        None.
+      transfer_workers: Transfers in flight per device.
+      max_transfers: Transfers in flight, and so local disk writers, over all
+        devices; unlimited if None.
+      transfer_mode: See SyncConfig.transfer_mode.
+      verify_before_delete: See SyncConfig.verify_before_delete.
+      pipelined_scan: See SyncConfig.pipelined_scan.
+      resumable_pulls: See SyncConfig.resumable_pulls.
+      listing_cache: Keep the device listings in '.listing-cache' below
+        bak_home, and list only what changed since the last backup. Each
+        backup then lists the whole tree of dirs up front, unfiltered; see
+        SyncConfig.listing_cache.
+      metrics: Write the metrics of each directory's sync as JSON below
+        '<date>/sync-metrics' of each device root.
+      dry_run: Only plan the backup, writing what it would do below
+        '<date>/sync-plans' of each device root for apply_plans().
+      native_adb: Talk to the adb server directly instead of running adb;
+        see AdbSocketFileSystem.
+    """
+    if serials is None:
+        serials = list_devices()
+    if not serials:
+        logger.error('No device connected.')
+        return
+    cache_home = posixpath.join(bak_home, ".listing-cache") if listing_cache else None
+    transfer_limit = None if max_transfers is None else threading.BoundedSemaphore(max_transfers)
     to_date = parse_date(date_digits)
     to_date -= datetime.timedelta(days=keep_days)
-    bak_long_home = posixpath.join(bak_home, date_digits, "storage")
-    bak_recent_home = posixpath.join(bak_home, date_digits, "storage-keep")
-    os.makedirs(bak_long_home, exist_ok=True)
-    os.makedirs(bak_recent_home, exist_ok=True)
     to_time = int(to_date.timestamp())
-    for bak_home, time_range, del_source in [
-        (bak_long_home, [0, to_time], True),
-        (bak_recent_home, [to_time, None], False),
+    configs = []
+    for storage, time_range, del_source in [
+        ("storage", [0, to_time], True),
+        ("storage-keep", [to_time, None], False),
     ]:
-        cfg = SyncConfig(
+        configs.append((storage, SyncConfig(
             excludes=excludes, remote_to_local=True, delete_missing=False, del_source=del_source,
-            allow_overwrite=True, allow_replace=True, time_range=time_range)
+            allow_overwrite=True, allow_replace=True, time_range=time_range,
+            transfer_workers=transfer_workers, transfer_mode=transfer_mode,
+            listing_cache=cache_home, verify_before_delete=verify_before_delete,
+            pipelined_scan=pipelined_scan, resumable_pulls=resumable_pulls,
+            transfer_limit=transfer_limit, dry_run=dry_run)))
+    with ThreadPoolExecutor(len(serials), 'device') as executor:
+        futures = [(serial, executor.submit(
+            backup_device, serial, device_root(bak_home, serial, serials),
+            date_digits, dirs, configs, native_adb, metrics)) for serial in serials]
+    _report_devices(futures)
+
+
+def apply_plans(date_digits: str, bak_home: str, *, serials: Optional[List[str]] = None,
+                max_transfers: Optional[int] = None, native_adb: bool = False):
+    """Performs the backups planned by do(dry_run=True), all devices at the same time.
+
+    Args:
+      date_digits: Date of the planned backup.
+      bak_home: Local backup root, as passed to do().
+      serials: Devices to apply the plans of; as for do().
+      max_transfers: See do().
+      native_adb: See do().
+    """
+    if serials is None:
+        serials = list_devices()
+    if not serials:
+        logger.error('No device connected.')
+        return
+    transfer_limit = None if max_transfers is None else threading.BoundedSemaphore(max_transfers)
+    with ThreadPoolExecutor(len(serials), 'device') as executor:
+        futures = [(serial, executor.submit(
+            apply_device_plans, serial, device_root(bak_home, serial, serials),
+            date_digits, transfer_limit, native_adb)) for serial in serials]
+    _report_devices(futures)
+
+
+def previous_snapshot(device_home: str, date_digits: str) -> Optional[str]:
+    """Returns the newest dated backup in device_home before date_digits, if any."""
+    date = parse_date(date_digits)
+    previous = None  # type: Optional[Tuple[datetime.datetime, str]]
+    for name in os.listdir(device_home) if os.path.isdir(device_home) else []:
+        try:
+            name_date = parse_date(name)
+        except ValueError:
+            continue
+        if name_date < date and (previous is None or name_date > previous[0]):
+            previous = name_date, name
+    return None if previous is None else previous[1]
+
+
+def open_device(serial: str, native_adb: bool = False) -> AdbFileSystem:
+    """Returns the file system of a device, reached through adb or the adb server."""
+    if native_adb:
+        return AdbSocketFileSystem(serial)
+    return AdbFileSystem([b'adb', b'-s', serial.encode()])
+
+
+def device_root(bak_home: str, serial: str, serials: List[str]) -> str:
+    """Returns the local backup root of one of the devices backed up together."""
+    if len(serials) > 1:
+        return posixpath.join(bak_home, re.sub(r'[^\w.-]', '_', serial))
+    return bak_home
+
+
+def _report_devices(futures) -> None:
+    errors = []
+    for serial, future in futures:
+        try:
+            num_bytes, dt = future.result()
+        except Exception as e:
+            logger.error('Device {}: failed: {}', serial, e)
+            errors.append(e)
+            continue
+        logger.info('Device {}: {} KB/s ({} bytes in {:.3f}s)', serial,
+                    num_bytes / 1024.0 / dt, num_bytes, dt)
+    if errors:
+        raise errors[0]
+
+
+def backup_device(serial: str, device_home: str, date_digits: str, dirs: List[str],
+                  configs: List[Tuple[str, SyncConfig]], native_adb: bool = False,
+                  metrics: bool = False) -> Tuple[int, float]:
+    """Backs up dirs of one device into device_home.
+
+    Args:
+      metrics: Write the metrics of each directory's sync below
+        '<date>/sync-metrics'.
+
+    Returns:
+      The number of bytes copied and the seconds it took.
+    """
+    start_time = time.time()
+    num_bytes = 0
+    previous = previous_snapshot(device_home, date_digits)
+    if previous is not None:
+        logger.info('Seeding from the backup of {}.', previous)
+    adb = open_device(serial, native_adb)
+    metrics_home = posixpath.join(device_home, date_digits, 'sync-metrics')
+    if metrics:
+        os.makedirs(metrics_home, exist_ok=True)
+    try:
         for bak_src in dirs:
+            file_name = re.sub(r'[^\w.-]', '_', bak_src)
+            metrics_path = posixpath.join(metrics_home, file_name + '.json') if metrics else None
             bak_src = str(PurePosixPath("/sdcard") / bak_src)
-            bak_src, bak_dst = FixPath(
-                os.fsencode(bak_src), os.fsencode(bak_home))
-            do_sync(adb, bak_dst, bak_src, cfg)
+            # One scan of bak_src feeds every storage.
+            targets = []
+            for storage, cfg in configs:
+                bak_home = posixpath.join(device_home, date_digits, storage)
+                os.makedirs(bak_home, exist_ok=True)
+                src, bak_dst = FixPath(os.fsencode(bak_src), os.fsencode(bak_home))
+                plan_path = posixpath.join(device_home, date_digits, 'sync-plans',
+                                           '{}_{}.jsonl'.format(storage, file_name)) if cfg.dry_run else None
+                # Sources that stay on the device are mostly in the last backup already.
+                seed_path = None
+                if previous is not None and not cfg.del_source:
+                    seed_path = FixPath(os.fsencode(bak_src), os.fsencode(
+                        posixpath.join(device_home, previous, storage)))[1]
+                    if not os.path.isdir(seed_path):
+                        seed_path = None
+                targets.append((bak_dst, cfg, plan_path, seed_path))
+            for syncer in do_sync_split(adb, src, targets, metrics_path):
+                num_bytes += syncer.num_bytes
+    finally:
+        adb.Close()
+    return num_bytes, time.time() - start_time
+
+
+def apply_device_plans(serial: str, device_home: str, date_digits: str,
+                       transfer_limit: Optional[threading.Semaphore],
+                       native_adb: bool = False) -> Tuple[int, float]:
+    """Applies the plans of one device written by backup_device().
+
+    Returns:
+      The number of bytes copied and the seconds it took.
+    """
+    start_time = time.time()
+    num_bytes = 0
+    plan_home = posixpath.join(device_home, date_digits, 'sync-plans')
+    adb = open_device(serial, native_adb)
+    try:
+        for name in sorted(os.listdir(plan_home)):
+            syncer = apply_plan(adb, posixpath.join(plan_home, name), transfer_limit)
+            if syncer is not None:
+                num_bytes += syncer.num_bytes
+    finally:
+        adb.Close()
+    return num_bytes, time.time() - start_time
@@ -0,0 +1,104 @@
+from typing import Callable, List, Optional, Tuple
+
+# Tests on "$p" which are true if an operation failed for that path.
+EXISTS_CHECK = b'[ -e "$p" -o -L "$p" ]'
+NOT_DIR_CHECK = b'[ ! -d "$p" ]'
+# Test on "$p", made before the operation, which is true if it will fail:
+# deleting a path that is already missing fails, as it does for 'rm'.
+MISSING_CHECK = b'[ ! -e "$p" -a ! -L "$p" ]'
+
+
+class MutationQueue(object):
+    """Collects remote file system mutations and runs them in batches.
+
+    Consecutive operations using the same command are sent as one multi-path
+    command line. If it fails, a shell loop on the device reports which paths
+    failed, so every path can still be told apart. The command lines of a
+    flush are sent together, as few scripts as fit, so operations that each
+    need their own command line, like setting a file's time, still share a
+    round trip.
+    """
+
+    def __init__(self) -> None:
+        # Per operation: command, check, precheck and path.
+        self.operations = []  # type: List[Tuple[bytes, bytes, bytes, bytes]]
+
+    def __len__(self) -> int:
+        return len(self.operations)
+
+    def Add(self, command: bytes, check: Optional[bytes], path: bytes,
+            precheck: Optional[bytes] = None) -> None:
+        """Queues a command to be run on a path.
+
+        Args:
+          command: Command line to which quoted paths are appended.
+          check: Shell test on "$p" that is true if the command failed for it.
+            None to rerun the command on each path of a failed batch instead.
+          path: Path to operate on.
+          precheck: Shell test on "$p", made before the command runs, that is
+            true if the command is going to fail for it; e.g. MISSING_CHECK.
+        """
+        self.operations.append((command, FullCheck(command, check), precheck or b'', path))
+
+    def Flush(self, run: Callable[[bytes], Tuple[int, bytes]],
+              quote: Callable[[bytes], bytes],
+              arg_budget: int) -> List[Tuple[bytes, bytes]]:
+        """Runs and clears all queued operations, in order.
+
+        Args:
+          run: Runs a shell command, returning exit status and output.
+          quote: Quotes a path for the shell.
+          arg_budget: Maximum total length of the paths in one command.
+
+        Returns:
+          (command, path) for every operation that failed.
+        """
+        operations, self.operations = self.operations, []
+        failures = []  # type: List[Tuple[bytes, bytes]]
+        start = 0
+        while start < len(operations):
+            # Per command line of the script: command, check and paths.
+            groups = []  # type: List[Tuple[bytes, bytes, List[bytes]]]
+            size = 0
+            while start < len(operations) and size < arg_budget:
+                command, check, precheck, _ = operations[start]
+                end = start
+                while (end < len(operations) and operations[end][:3] == (command, check, precheck)
+                       and (end == start or size + len(operations[end][3]) < arg_budget)):
+                    size += len(operations[end][3]) + 3
+                    end += 1
+                size += len(command) + len(check) + len(precheck) + 200
+                groups.append((command, check, precheck,
+                               [path for _, _, _, path in operations[start:end]]))
+                start = end
+            script = b'\n'.join(
+                b'set -- %s; %s%s "$@" || %s'
+                % (b' '.join(quote(path) for path in paths),
+                   _Report(precheck, k) + b'; ' if precheck else b'', command, _Report(check, k))
+                for k, (command, check, precheck, paths) in enumerate(groups)) + b'\necho .'
+            _, output = run(script)
+            lines = [line.strip() for line in output.split(b'\n')]
+            if b'.' not in lines:
+                # The script did not run to its end; assume nothing in it succeeded.
+                failures.extend((command, path) for command, _, _, paths in groups for path in paths)
+                continue
+            failed = set()
+            for line in lines:
+                k, _, i = line.partition(b':')
+                if k.isdigit() and i.isdigit() and int(k) < len(groups) and (k, i) not in failed:
+                    failed.add((k, i))
+                    command, _, _, paths = groups[int(k)]
+                    if int(i) < len(paths):
+                        failures.append((command, paths[int(i)]))
+        return failures
+
+
+def FullCheck(command: bytes, check: Optional[bytes]) -> bytes:
+    """Returns the check of an operation; see MutationQueue.Add()."""
+    return b'! %s "$p"' % (command,) if check is None else check
+
+
+def _Report(check: bytes, group: int) -> bytes:
+    """Returns a loop printing 'group:index' for each path in "$@" the check holds for."""
+    return (b'{ i=0; for p in "$@"; do if %s; then echo %d:$i; fi; i=$((i+1)); done; }'
+            % (check, group))
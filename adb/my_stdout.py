@@ -1,11 +1,11 @@
 import subprocess
 from types import TracebackType
-from typing import List, IO, Optional, Type
+from typing import List, IO, Iterator, Optional, Type
 
 
 class Stdout(object):
 
-    def __init__(self, args: List[bytes]) -> None:
+    def __init__(self, args: List[bytes], check: bool = True) -> None:
         """Closes the process's stdout when done.
 
         Usage:
@@ -14,11 +14,13 @@ class Stdout(object):
 
         Args:
           args: Which program to run.
+          check: Whether a nonzero exit status should raise OSError.
 
         Returns:
           An object for use by 'with'.
         """
         self.popen = subprocess.Popen(args, stdout=subprocess.PIPE)
+        self.check = check
 
     def __enter__(self) -> IO:
         return self.popen.stdout
@@ -27,6 +29,30 @@ class Stdout(object):
                  exc_val: Optional[Exception],
                  exc_tb: Optional[TracebackType]) -> bool:
         self.popen.stdout.close()
-        if self.popen.wait() != 0:
+        # An exception from the block says more than the exit status.
+        if self.popen.wait() != 0 and self.check and exc_type is None:
             raise OSError('Subprocess exited with nonzero status.')
-        return False
\ No newline at end of file
+        return False
+
+def ReadLines(stream: IO, chunk_size: int = 1 << 20) -> Iterator[bytes]:
+    """Splits a byte stream into lines, reading it in large chunks.
+
+    Args:
+      stream: Binary stream to read, usually a subprocess's stdout.
+      chunk_size: Maximum number of bytes to read at once.
+
+    Yields:
+      Lines including their line terminator, except possibly for the last one.
+    """
+    read = getattr(stream, 'read1', stream.read)
+    pending = b''
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if pending:
+        yield pending
@@ -0,0 +1,63 @@
+import queue
+import threading
+from typing import Iterable, Iterator, TypeVar
+
+T = TypeVar('T')
+
+# How long the producer waits for room before checking whether to stop.
+_PUT_TIMEOUT = 0.1
+
+
+def RunAhead(items: Iterable[T], max_ahead: int) -> Iterator[T]:
+    """Produces items on a separate thread, ahead of the consumer.
+
+    Usage:
+      for item in RunAhead(SlowGenerator(), 1000):
+        Consume(item)
+
+      SlowGenerator() keeps running while Consume() works, until max_ahead
+      items are waiting. An exception it raises is raised to the consumer once
+      the items before it have been consumed. If the consumer stops early, the
+      producer stops before its next item.
+
+    Args:
+      items: Items to produce; only ever iterated by the producer thread.
+      max_ahead: Maximum number of items produced but not yet consumed.
+
+    Yields:
+      The items, in order.
+    """
+    results = queue.Queue(max_ahead)  # type: queue.Queue
+    stop = threading.Event()
+
+    def Put(result) -> bool:
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def Produce() -> None:
+        try:
+            for item in items:
+                if not Put((True, item)):
+                    return
+        except BaseException as e:
+            Put((False, e))
+        else:
+            Put((False, None))
+
+    threading.Thread(target=Produce, name='run-ahead', daemon=True).start()
+    try:
+        while True:
+            ok, value = results.get()
+            if ok:
+                yield value
+            elif value is None:
+                return
+            else:
+                raise value
+    finally:
+        stop.set()
@@ -0,0 +1,145 @@
+import re
+import subprocess
+import threading
+import uuid
+from typing import List, Optional, Tuple
+
+from loguru import logger
+
+from .sync_metrics import SyncMetrics
+
+
+class ShellSession(object):
+    """Runs shell commands through one long-lived 'adb shell' process.
+
+    Commands are written to the shell's stdin. Each one is followed by an echo
+    of a unique marker and its exit status, which tells where its output ends.
+    If the process dies, it is restarted and the command is tried once more.
+    """
+
+    def __init__(self, adb: List[bytes], metrics: Optional[SyncMetrics] = None) -> None:
+        self.adb = adb
+        self.metrics = metrics
+        self.popen = None  # type: Optional[subprocess.Popen]
+        self.lock = threading.Lock()
+        self._token = uuid.uuid4().hex.encode('ascii')
+        self._counter = 0
+        self._buffer = b''
+
+    def Run(self, command: bytes) -> Tuple[int, bytes]:
+        """Runs a command.
+
+        Args:
+          command: Shell command line, quoted as for 'adb shell'.
+
+        Returns:
+          The exit status and the standard output of the command.
+
+        Raises:
+          OSError: if the session could not be (re)started, or the command's
+            output could not be read.
+        """
+        # A command interrupted while running stops the session: the rest of
+        # its output would otherwise be taken for the next command's.
+        with self.lock:
+            if self.metrics is None:
+                return self._Run(command)
+            with self.metrics.Call('shell ' + CommandKind(command)):
+                return self._Run(command)
+
+    def _Run(self, command: bytes) -> Tuple[int, bytes]:
+        try:
+            return self._Execute(command)
+        except OSError as e:
+            logger.warning('adb shell session died, reconnecting: {}', e)
+            self._Stop()
+        except BaseException:
+            self._Stop()
+            raise
+        try:
+            return self._Execute(command)
+        except BaseException:
+            self._Stop()
+            raise
+
+    def Close(self) -> None:
+        """Terminates the shell process."""
+        with self.lock:
+            self._Stop()
+
+    def _Start(self) -> subprocess.Popen:
+        if self.popen is None:
+            self.popen = subprocess.Popen(
+                self.adb + [b'shell'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._buffer = b''
+        return self.popen
+
+    def _Stop(self) -> None:
+        if self.popen is None:
+            return
+        popen, self.popen = self.popen, None
+        try:
+            popen.stdin.close()
+        except OSError:
+            pass
+        try:
+            popen.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            popen.kill()
+            popen.wait()
+        popen.stdout.close()
+
+    def _Execute(self, command: bytes) -> Tuple[int, bytes]:
+        popen = self._Start()
+        self._counter += 1
+        marker = b'__meow_%s_%d__' % (self._token, self._counter)
+        # The command runs in a subshell via eval, so that syntax errors or an
+        # 'exit' cannot take down the session shell.
+        script = (b'(eval %s) </dev/null; __meow_rc=$?; echo; echo %s $__meow_rc\n' %
+                  (_QuoteForEval(command), marker))
+        try:
+            popen.stdin.write(script)
+            popen.stdin.flush()
+        except (OSError, ValueError) as e:
+            raise OSError('Could not write to adb shell: %s' % e)
+        needle = b'\n' + marker + b' '
+        start = 0
+        while True:
+            pos = self._buffer.find(needle, start)
+            if pos >= 0:
+                end = self._buffer.find(b'\n', pos + len(needle))
+                if end >= 0:
+                    break
+            else:
+                start = max(0, len(self._buffer) - len(needle))
+            chunk = popen.stdout.read1(1 << 16)
+            if not chunk:
+                raise OSError('adb shell exited unexpectedly.')
+            self._buffer += chunk
+        output = self._buffer[:pos]
+        status = self._buffer[pos + len(needle):end].rstrip(b'\r')
+        self._buffer = self._buffer[end + 1:]
+        if output.endswith(b'\r'):
+            output = output[:-1]
+        try:
+            return int(status), output
+        except ValueError:
+            raise OSError('Malformed exit status from adb shell: %r' % (status,))
+
+
+def _QuoteForEval(command: bytes) -> bytes:
+    command = command.replace(b'\\', b'\\\\')
+    command = command.replace(b'"', b'\\"')
+    command = command.replace(b'$', b'\\$')
+    command = command.replace(b'`', b'\\`')
+    return b'"' + command + b'"'
+
+
+def CommandKind(command: bytes) -> str:
+    """Names the program a shell command line runs, for accounting."""
+    # Batched mutations set their arguments first: 'set -- ...; rm "$@" || ...'.
+    match = re.search(br'; ([^;]*?) "\$@" \|\| ', command) if command.startswith(b'set -- ') else None
+    if match is not None:
+        command = match.group(1)
+    words = command.split(None, 1)
+    return words[0].decode('utf-8', 'replace') if words else ''
@@ -1,3 +1,4 @@
+import threading
 from dataclasses import dataclass
 from typing import Optional, Sequence, List
 
@@ -14,3 +15,29 @@ class SyncConfig:
     dry_run: bool = False
     time_range: Optional[Sequence[Optional[int]]] = None
     del_source: bool = False
+    # With del_source, stream pulls through an MD5 and only delete verified sources.
+    # Files are then pulled one at a time, whatever transfer_mode and batch_pulls say.
+    verify_before_delete: bool = False
+    bulk_listing: bool = True
+    # Without bulk_listing or listing_cache, remote directory listings in
+    # flight while scanning, taken breadth first ahead of the walk.
+    scan_workers: int = 1
+    transfer_workers: int = 1
+    batch_pulls: bool = True
+    # 'pull' uses adb pull; 'tar' streams pulled files through tar on the device.
+    transfer_mode: str = 'pull'
+    # Directory keeping remote listings between runs, one file per device.
+    # Pays off for large trees that change little: a run lists only what
+    # changed since the last one. But every run then lists the whole tree,
+    # before scanning and regardless of time_range and excludes, and
+    # scan_workers does not apply; pipelined_scan has little left to overlap.
+    listing_cache: Optional[str] = None
+    # Keep scanning on a separate thread while copying what is already known.
+    # Deletions then wait for the scan to finish, and a folder and a file of
+    # the same name are skipped with a warning instead of prompting.
+    pipelined_scan: bool = False
+    # Pull single files through a '.part' file that a later sync can resume.
+    resumable_pulls: bool = False
+    # Held by every transfer while running; shared by concurrent syncs, e.g. of
+    # several devices, to cap their transfers and local disk writers in total.
+    transfer_limit: Optional[threading.Semaphore] = None
@@ -0,0 +1,135 @@
+import contextlib
+import json
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, TypeVar
+
+T = TypeVar('T')
+
+# Upper bounds of the file size classes transfers are accounted in.
+SIZE_CLASSES = [
+    (64 * 1024, '<64KiB'),
+    (1024 * 1024, '<1MiB'),
+    (16 * 1024 * 1024, '<16MiB'),
+    (256 * 1024 * 1024, '<256MiB'),
+]
+LARGEST_SIZE_CLASS = '>=256MiB'
+
+
+class SyncMetrics(object):
+    """Accounts where a sync spends its time.
+
+    Phases of a streamed sync overlap, so their times are busy times: each is
+    the total time spent doing that kind of work, possibly on several threads
+    at once, and they do not add up to the wall time.
+
+    All methods may be called from any thread.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.Reset()
+
+    def Reset(self) -> None:
+        """Forgets everything accounted so far."""
+        with self.lock:
+            self.start_time = time.time()
+            self.phases = {}  # type: Dict[str, float]
+            # Per kind of adb invocation: count, total and maximum seconds.
+            self.calls = {}  # type: Dict[str, List[float]]
+            # Per size class: files, bytes and seconds.
+            self.transfers = {}  # type: Dict[str, List[float]]
+            # Per walk of a tree: the counts of what it came across.
+            self.walks = {}  # type: Dict[str, Dict[str, int]]
+
+    @contextlib.contextmanager
+    def Phase(self, name: str) -> Iterator[None]:
+        """Adds the time spent in the block to a phase."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.AddPhase(name, time.time() - start)
+
+    def AddPhase(self, name: str, seconds: float) -> None:
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def Timed(self, name: str, items: Iterable[T]) -> Iterator[T]:
+        """Passes on items, adding the time spent producing them to a phase."""
+        it = iter(items)
+        while True:
+            start = time.time()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.AddPhase(name, time.time() - start)
+                return
+            self.AddPhase(name, time.time() - start)
+            yield item
+
+    @contextlib.contextmanager
+    def Call(self, kind: str) -> Iterator[None]:
+        """Accounts the block as one adb invocation of the given kind."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            with self.lock:
+                call = self.calls.setdefault(kind, [0, 0.0, 0.0])
+                call[0] += 1
+                call[1] += seconds
+                call[2] = max(call[2], seconds)
+
+    def AddTransfer(self, sizes: List[int], seconds: float) -> None:
+        """Accounts files transferred together, sharing the time by their sizes.
+
+        Args:
+          sizes: Sizes of the files.
+          seconds: Time the transfer took.
+        """
+        total = sum(sizes)
+        with self.lock:
+            for size in sizes:
+                bucket = self.transfers.setdefault(SizeClass(size), [0, 0, 0.0])
+                bucket[0] += 1
+                bucket[1] += size
+                bucket[2] += seconds * (size / total if total else 1.0 / len(sizes))
+
+    def AddWalk(self, name: str, counts: Dict[str, int]) -> None:
+        """Accounts a walk of a tree, e.g. the entries it visited and excluded."""
+        with self.lock:
+            walk = self.walks.setdefault(name, {})
+            for key, count in counts.items():
+                walk[key] = walk.get(key, 0) + count
+
+    def ToJson(self) -> dict:
+        """Returns everything accounted, as a JSON serializable dict."""
+        with self.lock:
+            return {
+                'wall_seconds': time.time() - self.start_time,
+                'phases': dict(self.phases),
+                'adb_calls': {
+                    kind: {'count': count, 'seconds': seconds, 'max_seconds': max_seconds}
+                    for kind, (count, seconds, max_seconds) in sorted(self.calls.items())},
+                'transfers': {
+                    size_class: {
+                        'files': files, 'bytes': num_bytes, 'seconds': seconds,
+                        'files_per_second': files / seconds if seconds else None,
+                        'bytes_per_second': num_bytes / seconds if seconds else None,
+                    } for size_class, (files, num_bytes, seconds) in self.transfers.items()},
+                'walks': {name: dict(counts) for name, counts in self.walks.items()},
+            }
+
+    def Export(self, path: str) -> None:
+        """Writes everything accounted to a JSON file."""
+        with open(path, 'w') as f:
+            json.dump(self.ToJson(), f, indent=2)
+
+
+def SizeClass(size: int) -> str:
+    for limit, name in SIZE_CLASSES:
+        if size < limit:
+            return name
+    return LARGEST_SIZE_CLASS
@@ -0,0 +1,96 @@
+import dataclasses
+import json
+import os
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .sync_config import SyncConfig
+
+# Kinds of planned operations.
+DELETE = 'delete'  # An entry only at the destination, deleted by delete_missing.
+CONFLICT = 'conflict'  # A destination file deleted to make way for the copy after it.
+COPY = 'copy'  # A transfer unit, as planned by transfer_plan.
+SEED = 'seed'  # An entry taken from an earlier local snapshot instead of pulled.
+
+# Config fields that belong to the run applying a plan, not to the plan.
+_RUN_FIELDS = ('dry_run', 'transfer_limit')
+
+# (kind, direction, unit kind, entries). Deletions and seeds have no unit
+# kind and a single entry. The stat results of deletions are the
+# destination's, those of copies and seeds the source's.
+PlanOp = Tuple[str, int, str, List[Tuple[bytes, os.stat_result]]]
+
+
+class PlanWriter(object):
+    """Writes the operations of a dry run to a file, for review and ApplyPlan().
+
+    The file holds one JSON value per line: a header with the paths and the
+    config of the sync, then one array per operation, in the order the sync
+    would have performed them. Names are decoded with surrogateescape, so
+    undecodable bytes survive the round trip.
+    """
+
+    def __init__(self, path: str, local: bytes, remote: bytes, config: SyncConfig,
+                 seed: Optional[bytes] = None) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'w', encoding='utf-8', errors='surrogateescape')
+        self.lock = threading.Lock()
+        self._Write({
+            'local': _Decode(local),
+            'remote': _Decode(remote),
+            'seed': None if seed is None else _Decode(seed),
+            'config': {f.name: getattr(config, f.name) for f in dataclasses.fields(config)
+                       if f.name not in _RUN_FIELDS},
+        })
+
+    def Add(self, kind: str, i: int, unit: str, entries: List[Tuple[bytes, os.stat_result]]) -> None:
+        """Adds an operation; see PlanOp."""
+        self._Write([kind, i, unit, [[_Decode(name), s.st_mode, s.st_size, s.st_atime, s.st_mtime]
+                                     for name, s in entries]])
+
+    def _Write(self, value: Any) -> None:
+        line = json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def Close(self) -> None:
+        self.file.close()
+
+
+def ReadPlan(path: str) -> Tuple[Dict[str, Any], Iterator[PlanOp]]:
+    """Reads a plan written by PlanWriter.
+
+    Returns:
+      The header, with the paths encoded again, and the operations, read
+      lazily. The file stays open until they have all been read.
+    """
+    f = open(path, encoding='utf-8', errors='surrogateescape')
+    try:
+        header = json.loads(f.readline())
+    except ValueError:
+        f.close()
+        raise
+    header['local'] = _Encode(header['local'])
+    header['remote'] = _Encode(header['remote'])
+    if header.get('seed') is not None:
+        header['seed'] = _Encode(header['seed'])
+    return header, _ReadOps(f)
+
+
+def _ReadOps(f) -> Iterator[PlanOp]:
+    with f:
+        for line in f:
+            if not line.strip():
+                continue
+            kind, i, unit, entries = json.loads(line)
+            yield kind, i, unit, [
+                (_Encode(name), os.stat_result((mode, 0, 0, 1, -2, -2, size, atime, mtime, mtime)))
+                for name, mode, size, atime, mtime in entries]
+
+
+def _Decode(name: bytes) -> str:
+    return name.decode('utf-8', 'surrogateescape')
+
+
+def _Encode(name: str) -> bytes:
+    return name.encode('utf-8', 'surrogateescape')
@@ -0,0 +1,221 @@
+import itertools
+import os
+import stat
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+# Kinds of transfer units.
+DIR = 'dir'  # A directory to create.
+FILE = 'file'  # A single file, copied on its own.
+FILES = 'files'  # Several files from one directory, pulled with one command.
+TREE = 'tree'  # A directory pulled as a whole, followed by all its contents.
+TAR = 'tar'  # Files from anywhere in the tree, streamed through one tar.
+HASHED = 'hashed'  # Files from one directory, streamed and verified one by one.
+
+# Files larger than this are not worth batching; the transfer dominates.
+MAX_BATCHED_FILE_SIZE = 4 * 1024 * 1024
+# Limits for one multi-source 'adb pull', kept well below the Windows
+# command line limit.
+MAX_BATCH_FILES = 100
+MAX_BATCH_ARG_BYTES = 16 * 1024
+# Files per verified unit; each unit hashes its sources with one md5sum.
+MAX_HASHED_FILES = 256
+# Limit for the names passed to one device side 'tar'.
+MAX_TAR_ARG_BYTES = 24 * 1024
+# adb cannot create local paths longer than this (see AdbFileSystem.Pull).
+MAX_DST_PATH = 200
+
+
+def Ancestors(name: bytes) -> Iterable[bytes]:
+    """Yields the parent directory names of an entry name, innermost first."""
+    pos = name.rfind(b'/')
+    while pos >= 0:
+        name = name[:pos]
+        yield name
+        pos = name.rfind(b'/')
+
+
+def PlanPulls(entries: Iterable[Tuple[bytes, os.stat_result]], src: bytes, dst: bytes,
+              skipped: Set[bytes]) -> Iterator[Tuple[str, List[Tuple[bytes, os.stat_result]]]]:
+    """Groups the entries to pull into as few adb commands as possible.
+
+    A directory that does not exist locally is pulled as a whole, unless
+    something inside it was excluded or filtered out while listing. Other
+    small files are pulled in batches per directory.
+
+    Units are planned as the entries come in. A directory that may be pulled
+    as a whole is held back, with its contents, until the entries have left
+    it; only then is it known whether anything inside was skipped.
+
+    Args:
+      entries: Entries to copy, in the order of a depth first walk.
+      src: Remote path the entry names are relative to.
+      dst: Local path the entry names are relative to.
+      skipped: Names of entries left out of the remote listing; those below a
+        directory must be known once entries has moved past it.
+
+    Yields:
+      (kind, entries) pairs in the order they should be started. A TREE unit
+      lists its directory first.
+    """
+    held = []  # type: List[Tuple[bytes, os.stat_result]]
+    batches = {}  # type: Dict[bytes, List[Tuple[bytes, os.stat_result]]]
+    batch_sizes = {}  # type: Dict[bytes, int]
+    for entry in entries:
+        name, s = entry
+        if held:
+            if name.startswith(held[0][0] + b'/'):
+                held.append(entry)
+                continue
+            yield from _PlanHeld(held, src, dst, skipped)
+            held = []
+        for batch in _LeftBatches(batches, name):
+            yield _BatchUnit(FILES, batch)
+        if stat.S_ISDIR(s.st_mode):
+            if os.path.lexists(dst + name):
+                yield DIR, [entry]
+            else:
+                held = [entry]
+        elif (not stat.S_ISREG(s.st_mode) or s.st_size > MAX_BATCHED_FILE_SIZE
+              or len(dst + name) > MAX_DST_PATH):
+            yield FILE, [entry]
+        else:
+            parent = name[:name.rfind(b'/')]
+            size = len(src + name) + 1
+            batch = batches.get(parent)
+            if batch is not None and (len(batch) >= MAX_BATCH_FILES
+                                      or batch_sizes[parent] + size > MAX_BATCH_ARG_BYTES):
+                yield _BatchUnit(FILES, batch)
+                batch = None
+            if batch is None:
+                batch = batches[parent] = []
+                batch_sizes[parent] = 0
+            batch.append(entry)
+            batch_sizes[parent] += size
+    if held:
+        yield from _PlanHeld(held, src, dst, skipped)
+    for batch in batches.values():
+        yield _BatchUnit(FILES, batch)
+
+
+def _PlanHeld(held: List[Tuple[bytes, os.stat_result]], src: bytes, dst: bytes,
+              skipped: Set[bytes]) -> Iterable[Tuple[str, List[Tuple[bytes, os.stat_result]]]]:
+    """Plans a new directory and its complete contents."""
+    root = held[0][0] + b'/'
+    blocked = set()  # type: Set[bytes]
+    # A copy, as a pipelined scan may still be adding to it.
+    for name in itertools.chain((n for n in list(skipped) if n.startswith(root)),
+                                (n for n, _ in held if len(dst + n) > MAX_DST_PATH)):
+        for parent in Ancestors(name):
+            if parent in blocked:
+                break
+            blocked.add(parent)
+
+    units = []  # type: List[Tuple[str, List[Tuple[bytes, os.stat_result]]]]
+    trees = {}  # type: Dict[bytes, List[Tuple[bytes, os.stat_result]]]
+    batches = {}  # type: Dict[bytes, List[Tuple[bytes, os.stat_result]]]
+    batch_sizes = {}  # type: Dict[bytes, int]
+    for entry in held:
+        name, s = entry
+        pos = name.rfind(b'/')
+        parent = name[:pos] if pos >= 0 else None
+        if parent in trees:
+            trees[parent].append(entry)
+            if stat.S_ISDIR(s.st_mode):
+                trees[name] = trees[parent]
+        elif stat.S_ISDIR(s.st_mode):
+            if name in blocked:
+                units.append((DIR, [entry]))
+            else:
+                trees[name] = [entry]
+                units.append((TREE, trees[name]))
+        elif (not stat.S_ISREG(s.st_mode) or s.st_size > MAX_BATCHED_FILE_SIZE
+              or len(dst + name) > MAX_DST_PATH):
+            units.append((FILE, [entry]))
+        else:
+            batch = batches.get(parent)
+            size = len(src + name) + 1
+            if (batch is None or len(batch) >= MAX_BATCH_FILES
+                    or batch_sizes[parent] + size > MAX_BATCH_ARG_BYTES):
+                batch = batches[parent] = []
+                batch_sizes[parent] = 0
+                units.append((FILES, batch))
+            batch.append(entry)
+            batch_sizes[parent] += size
+    return [_BatchUnit(kind, batch) for kind, batch in units]
+
+
+def _LeftBatches(batches: Dict[bytes, List[Tuple[bytes, os.stat_result]]],
+                 name: bytes) -> Iterator[List[Tuple[bytes, os.stat_result]]]:
+    """Pops the batches of the directories a walk has left on reaching name."""
+    for parent in [p for p in batches if not name.startswith(p + b'/')]:
+        yield batches.pop(parent)
+
+
+def _BatchUnit(kind: str, batch: List[Tuple[bytes, os.stat_result]]
+               ) -> Tuple[str, List[Tuple[bytes, os.stat_result]]]:
+    return (FILE, batch) if kind == FILES and len(batch) == 1 else (kind, batch)
+
+
+def PlanTarPulls(entries: Iterable[Tuple[bytes, os.stat_result]]
+                 ) -> Iterable[Tuple[str, List[Tuple[bytes, os.stat_result]]]]:
+    """Groups the entries to pull into tar streams.
+
+    Directories are left to be created locally; regular files are streamed in
+    chunks of names that fit into one command line; anything else is copied
+    on its own.
+
+    Args:
+      entries: Entries to copy, directories before their contents.
+
+    Yields:
+      (kind, entries) pairs in the order they should be started.
+    """
+    chunk = []  # type: List[Tuple[bytes, os.stat_result]]
+    size = 0
+    for entry in entries:
+        name, s = entry
+        if stat.S_ISDIR(s.st_mode):
+            yield DIR, [entry]
+        elif not stat.S_ISREG(s.st_mode):
+            yield FILE, [entry]
+        else:
+            if chunk and size + len(name) + 4 > MAX_TAR_ARG_BYTES:
+                yield TAR, chunk
+                chunk = []
+                size = 0
+            chunk.append(entry)
+            size += len(name) + 4
+    if chunk:
+        yield TAR, chunk
+
+
+def PlanHashedPulls(entries: Iterable[Tuple[bytes, os.stat_result]]
+                    ) -> Iterator[Tuple[str, List[Tuple[bytes, os.stat_result]]]]:
+    """Groups the entries to pull into verified units per directory.
+
+    Args:
+      entries: Entries to copy, in the order of a depth first walk.
+
+    Yields:
+      (kind, entries) pairs in the order they should be started.
+    """
+    batches = {}  # type: Dict[bytes, List[Tuple[bytes, os.stat_result]]]
+    for entry in entries:
+        name, s = entry
+        for batch in _LeftBatches(batches, name):
+            yield HASHED, batch
+        if stat.S_ISDIR(s.st_mode):
+            yield DIR, [entry]
+        elif not stat.S_ISREG(s.st_mode):
+            yield FILE, [entry]
+        else:
+            parent = name[:name.rfind(b'/')]
+            batch = batches.get(parent)
+            if batch is not None and len(batch) >= MAX_HASHED_FILES:
+                yield HASHED, batch
+                batch = None
+            if batch is None:
+                batch = batches[parent] = []
+            batch.append(entry)
+    for batch in batches.values():
+        yield HASHED, batch
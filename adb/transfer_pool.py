@@ -0,0 +1,71 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import TracebackType
+from typing import Callable, Optional, Type
+
+
+class TransferPool(object):
+
+    def __init__(self, workers: int, limit: Optional[threading.Semaphore] = None) -> None:
+        """Runs transfers on a bounded number of worker threads.
+
+        Usage:
+          with TransferPool(4) as pool:
+            for ...:
+              pool.Submit(DoSomething, arg)
+
+          Submit() blocks while too many transfers are pending. Leaving the block
+          waits for all of them; the first exception raised by any of them is
+          then passed on. With a single worker everything runs inline.
+
+        Args:
+          workers: Maximum number of transfers in flight.
+          limit: If given, every transfer holds it while running; shared by
+            several pools, it caps their transfers in total.
+
+        Returns:
+          An object for use by 'with'.
+        """
+        self.workers = max(1, workers)
+        self.executor = None  # type: Optional[ThreadPoolExecutor]
+        self.slots = threading.BoundedSemaphore(self.workers * 2)
+        self.error = None  # type: Optional[BaseException]
+        self.limit = limit
+
+    def __enter__(self) -> 'TransferPool':
+        if self.workers > 1:
+            self.executor = ThreadPoolExecutor(self.workers, 'transfer')
+        return self
+
+    def Submit(self, fn: Callable[..., None], *args) -> None:
+        """Schedules fn(*args), raising the first error of an earlier transfer."""
+        if self.executor is None:
+            self._Run(fn, *args)
+            return
+        self.slots.acquire()
+        if self.error is not None:
+            self.slots.release()
+            raise self.error
+        self.executor.submit(self._Run, fn, *args).add_done_callback(self._Done)
+
+    def _Run(self, fn: Callable[..., None], *args) -> None:
+        if self.limit is None:
+            fn(*args)
+            return
+        with self.limit:
+            fn(*args)
+
+    def _Done(self, future: Future) -> None:
+        if not future.cancelled() and future.exception() is not None and self.error is None:
+            self.error = future.exception()
+        self.slots.release()
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]],
+                 exc_val: Optional[Exception],
+                 exc_tb: Optional[TracebackType]) -> bool:
+        if self.executor is None:
+            return False
+        self.executor.shutdown(wait=True, cancel_futures=exc_type is not None)
+        if exc_type is None and self.error is not None:
+            raise self.error
+        return False
@@ -0,0 +1,5 @@
+""" Perform a backup planned by adb_dl.py with dry_run=True, without scanning again. """
+from adb.meow_bak import apply_plans
+
+if __name__ == '__main__':
+    apply_plans("250111", r"C:\Users\barco\bak_tmp")
@@ -0,0 +1,158 @@
+"""Benchmark syncing synthetic trees from temporaries/fake_adb.py.
+
+Each tree is pulled twice: a first sync copying everything, then a sync
+finding nothing to do, which is all scanning and diffing. Prints a JSON
+report per tree size with the scan, diff and transfer times, the transfer
+throughput and the number of adb processes, shell commands and sync
+requests.
+
+  python -m temporaries.bench_sync [--files 1000 100000 1000000]
+      [--latency SECONDS] [--bandwidth BYTES_PER_SECOND] [--output FILE]
+      [--backend process|socket] [--no-bulk-listing] [--scan-workers N]
+      [--time-range START END]
+
+With --scan-workers, the syncs keep a time range holding every file unless
+--time-range is given, so that the walk filters listings while the workers
+are still adding to them.
+
+The socket backend is AdbSocketFileSystem against fake_adb_server.py.
+
+Trees of a million files take a while to create and several GB of disk.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from adb.adb_file_system import AdbFileSystem
+from adb.adb_socket_file_system import AdbSocketFileSystem
+from adb.meow_bak import do_sync
+from adb.sync_config import SyncConfig
+from temporaries import fake_adb_server
+
+FAKE_ADB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_adb.py')
+REMOTE_DIR = b'/sdcard/DCIM'
+# Mtime of the first file of a tree; each next one is a second later.
+MTIME = 1700000000
+
+
+def make_tree(root, num_files, files_per_dir, file_size):
+    data = os.urandom(file_size)
+    mtime = MTIME
+    for i in range(num_files):
+        directory = os.path.join(root, 'dir%04d' % (i // files_per_dir))
+        if i % files_per_dir == 0:
+            os.makedirs(directory)
+        path = os.path.join(directory, 'IMG_%07d.jpg' % i)
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.utime(path, (mtime + i, mtime + i))
+
+
+def count_log(path):
+    counts = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                counts[line.strip()] = counts.get(line.strip(), 0) + 1
+        os.unlink(path)
+    return counts
+
+
+def summarize(metrics, invocations, wall):
+    phases = metrics['phases']
+    scan = phases.get('scan_local', 0.0) + phases.get('scan_remote', 0.0)
+    transferred = [metrics['transfers'][size_class] for size_class in metrics['transfers']]
+    num_bytes = sum(t['bytes'] for t in transferred)
+    seconds = sum(t['seconds'] for t in transferred)
+    return {
+        'wall_seconds': wall,
+        'scan_local_seconds': phases.get('scan_local', 0.0),
+        'scan_remote_seconds': phases.get('scan_remote', 0.0),
+        'diff_seconds': max(0.0, phases.get('scan_and_diff', 0.0) - scan),
+        'transfer_seconds': phases.get('transfer', 0.0),
+        'files_transferred': sum(t['files'] for t in transferred),
+        'bytes_transferred': num_bytes,
+        'bytes_per_second': num_bytes / seconds if seconds else None,
+        'adb_processes': sum(count for command, count in invocations.items()
+                             if command != 'session' and not command.startswith('sync ')),
+        'shell_session_commands': invocations.get('session', 0),
+        'sync_requests': sum(count for command, count in invocations.items() if command.startswith('sync ')),
+        'adb_calls': metrics['adb_calls'],
+        'walks': metrics['walks'],
+        'phases': phases,
+    }
+
+
+def bench(num_files, args):
+    work = tempfile.mkdtemp(prefix='bench_sync_')
+    try:
+        root = os.path.join(work, 'device')
+        local = os.path.join(work, 'local')
+        log = os.path.join(work, 'adb.log')
+        os.makedirs(local)
+        start = time.time()
+        make_tree(root + os.fsdecode(REMOTE_DIR), num_files, args.files_per_dir, args.file_size)
+        report = {'files': num_files, 'setup_seconds': time.time() - start}
+        os.environ.update(FAKE_ADB_ROOT=root, FAKE_ADB_LOG=log,
+                          FAKE_ADB_LATENCY=str(args.latency))
+        if args.bandwidth:
+            os.environ['FAKE_ADB_BANDWIDTH'] = str(args.bandwidth)
+        server = None
+        if args.backend == 'socket':
+            server = fake_adb_server.serve(root)
+            adb = AdbSocketFileSystem(port=server.server_address[1])
+        else:
+            adb = AdbFileSystem([os.fsencode(sys.executable), os.fsencode(FAKE_ADB)])
+        time_range = args.time_range
+        if time_range is None and args.scan_workers > 1:
+            time_range = [0, MTIME + num_files]
+        cfg = SyncConfig(remote_to_local=True, transfer_workers=args.workers,
+                         bulk_listing=args.bulk_listing, scan_workers=args.scan_workers,
+                         time_range=time_range)
+        for run in ['initial', 'unchanged']:
+            start = time.time()
+            syncer = do_sync(adb, os.fsencode(local) + b'/DCIM', REMOTE_DIR, cfg)
+            wall = time.time() - start
+            report[run] = summarize(syncer.metrics.ToJson(), count_log(log), wall)
+        adb.Close()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        return report
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--files-per-dir', type=int, default=1000)
+    parser.add_argument('--file-size', type=int, default=1024)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds per adb invocation and shell command')
+    parser.add_argument('--bandwidth', type=float, default=0.0,
+                        help='bytes per second; unlimited if 0')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--no-bulk-listing', dest='bulk_listing', action='store_false',
+                        help='list the device directory by directory')
+    parser.add_argument('--scan-workers', type=int, default=1,
+                        help='directory listings in flight without bulk listing')
+    parser.add_argument('--time-range', type=int, nargs=2, metavar=('START', 'END'),
+                        help='mtimes of the files to sync')
+    parser.add_argument('--backend', choices=['process', 'socket'], default='process')
+    parser.add_argument('--output', help='file to write the JSON report to')
+    args = parser.parse_args()
+    reports = [bench(num_files, args) for num_files in args.files]
+    text = json.dumps(reports, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
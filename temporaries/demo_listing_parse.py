@@ -0,0 +1,53 @@
+"""Compare the throughput of parsing 'ls -al' and 'stat -c' listings."""
+import time
+
+from adb.adb_file_system import AdbFileSystem
+
+NUM_LINES = 1000000
+FILES_PER_DIR = 1000
+ROOT = b'/sdcard/DCIM'
+
+
+def ls_lines():
+    for d in range(NUM_LINES // FILES_PER_DIR):
+        if d:
+            yield b''
+            yield ROOT + b'/dir%d:' % d
+        yield b'total %d' % FILES_PER_DIR
+        for f in range(FILES_PER_DIR):
+            yield b'-rw-rw---- 1 u0_a123 media_rw %d 2023-04-%02d 12:%02d IMG_%06d.jpg' % (
+                f * 4096, f % 28 + 1, f % 60, f)
+
+
+def stat_lines():
+    for d in range(NUM_LINES // FILES_PER_DIR):
+        directory = ROOT + b'/dir%d' % d if d else ROOT
+        yield directory + b':'
+        for f in range(FILES_PER_DIR):
+            yield b'%d %d 81b0 %s/IMG_%06d.jpg' % (f * 4096, 1680000000 + f, directory, f)
+        yield b''
+
+
+def run_ls(lines):
+    return sum(1 for _ in AdbFileSystem([b'adb']).ParseListing(lines, ROOT))
+
+
+def run_stat(lines):
+    return sum(1 for _ in AdbFileSystem([b'adb']).ParseStatTree(lines, ROOT))
+
+
+def main():
+    for name, make, fn in [('ls -al', ls_lines, run_ls), ('stat -c', stat_lines, run_stat)]:
+        lines = list(make())
+        dt = timeit(lambda: fn(lines))
+        print('{}: {} lines in {:.3f}s, {:.0f} lines/s'.format(name, len(lines), dt, len(lines) / dt))
+
+
+def timeit(fn):
+    t = time.time()
+    fn()
+    return time.time() - t
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""Compare the memory taken by stat results kept in a dict and in a ListingStore."""
+import tracemalloc
+
+from adb.adb_file_system import AdbFileSystem
+from adb.listing_store import ListingStore
+
+NUM_FILES = 200000
+FILES_PER_DIR = 1000
+ROOT = b'/sdcard/DCIM'
+
+
+def listings():
+    for d in range(NUM_FILES // FILES_PER_DIR):
+        yield ROOT + b'/dir%d' % d, [
+            (b'IMG_%06d.jpg' % f, AdbFileSystem.MakeStat(0o100660, f * 4096, 1680000000 + f))
+            for f in range(FILES_PER_DIR)]
+
+
+def fill_dict():
+    cache = {}
+    for directory, entries in listings():
+        for name, s in entries:
+            cache[directory + b'/' + name] = s
+    return cache
+
+
+def fill_store():
+    store = ListingStore()
+    for directory, entries in listings():
+        store.SetDir(directory, entries)
+    return store
+
+
+def main():
+    for name, fill in [('dict', fill_dict), ('ListingStore', fill_store)]:
+        tracemalloc.start()
+        kept = fill()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('{}: {} files in {:.1f} MB, {:.0f} bytes per file'.format(
+            name, NUM_FILES, size / 1e6, size / NUM_FILES))
+        del kept
+
+
+if __name__ == '__main__':
+    main()
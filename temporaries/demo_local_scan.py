@@ -0,0 +1,40 @@
+"""Compare walking a local tree through os and through LocalFileSystem."""
+import os
+import sys
+import tempfile
+import time
+
+from adb.exclude_matcher import ExcludeMatcher
+from adb.file_syncer import BuildFileList
+from adb.local_file_system import LocalFileSystem
+
+NUM_DIRS = 100
+FILES_PER_DIR = 500
+
+
+def make_tree(root):
+    for d in range(NUM_DIRS):
+        directory = os.path.join(root, 'dir%d' % d)
+        os.mkdir(directory)
+        for f in range(FILES_PER_DIR):
+            open(os.path.join(directory, 'IMG_%06d.jpg' % f), 'wb').close()
+
+
+def walk(fs, root):
+    start = time.time()
+    count = sum(1 for _ in BuildFileList(fs, root, False, b'', ExcludeMatcher([]), time_range=None))
+    return count, time.time() - start
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.fsencode(sys.argv[1]) if len(sys.argv) > 1 else os.fsencode(tmp)
+        if len(sys.argv) <= 1:
+            make_tree(tmp)
+        for name, fs in [('os', os), ('LocalFileSystem', LocalFileSystem())]:
+            count, seconds = walk(fs, root)
+            print('{}: {} entries in {:.3f}s'.format(name, count, seconds))
+
+
+if __name__ == '__main__':
+    main()
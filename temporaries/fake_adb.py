@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""A stand-in for the adb executable, backed by a local directory tree.
+
+Use it as the adb command line of AdbFileSystem:
+
+  AdbFileSystem([sys.executable.encode(), b'temporaries/fake_adb.py'])
+
+The device's /sdcard, /storage and /data are the directories of the same
+names under FAKE_ADB_ROOT. Shell commands run in the local sh, with device
+paths rewritten on the way in and out, and an 'ls' that prints dates the
+way toybox does. Supported: devices, get-serialno, shell (with a command or
+as a session reading stdin), exec-out, pull and push, optionally after -s.
+
+Configured by environment variables:
+  FAKE_ADB_ROOT: Directory holding the device tree (required).
+  FAKE_ADB_SERIAL: Serial of the single device; FAKE0001 by default.
+  FAKE_ADB_LATENCY: Seconds each invocation, and each command of a shell
+    session, takes before running; 0 by default.
+  FAKE_ADB_LATENCY_<COMMAND>: The same for one command, e.g.
+    FAKE_ADB_LATENCY_PULL or FAKE_ADB_LATENCY_EXEC_OUT.
+  FAKE_ADB_BANDWIDTH: Bytes per second that pulls, pushes and command
+    output are throttled to; unlimited by default.
+  FAKE_ADB_LOG: File that gets one line per invocation and per session
+    command, for counting them.
+"""
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.fsencode(os.environ.get('FAKE_ADB_ROOT', ''))
+SERIAL = os.environ.get('FAKE_ADB_SERIAL', 'FAKE0001')
+
+# Device directories that live under ROOT.
+DEVICE_DIRS = (b'sdcard', b'storage', b'data')
+# A device path where an argument or a redirection starts.
+DEVICE_PATH_RE = re.compile(br'(?<=[\s"\'=])(?=/(?:%s)(?:/|\b))' % b'|'.join(DEVICE_DIRS))
+# Defines an 'ls' printing dates as 'YYYY-MM-DD HH:MM', like toybox's.
+SHELL_PRELUDE = b'ls() { command ls --time-style=long-iso "$@"; }\n'
+CHUNK_SIZE = 64 * 1024
+
+
+def to_local(command):
+    return DEVICE_PATH_RE.sub(ROOT.replace(b'\\', b'\\\\'), b' ' + command)[1:]
+
+
+def to_device(output):
+    return output.replace(ROOT, b'')
+
+
+def log(command):
+    path = os.environ.get('FAKE_ADB_LOG')
+    if path:
+        with open(path, 'a') as f:
+            f.write(command + '\n')
+
+
+def delay(command):
+    key = 'FAKE_ADB_LATENCY_' + command.upper().replace('-', '_')
+    seconds = float(os.environ.get(key, os.environ.get('FAKE_ADB_LATENCY', '0')))
+    if seconds:
+        time.sleep(seconds)
+
+
+class Throttle(object):
+    """Delays data so that it passes at no more than FAKE_ADB_BANDWIDTH."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.num_bytes = 0
+        self.bandwidth = float(os.environ.get('FAKE_ADB_BANDWIDTH', '0')) or None
+
+    def Pass(self, num_bytes):
+        if self.bandwidth is None:
+            return
+        self.num_bytes += num_bytes
+        ahead = self.num_bytes / self.bandwidth - (time.time() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def copy_data(src, dst, throttle):
+    while True:
+        chunk = src.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        throttle.Pass(len(chunk))
+        dst.write(chunk)
+
+
+def copy_file(src, dst, throttle):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        copy_data(fsrc, fdst, throttle)
+
+
+def copy_tree(src, dst, throttle):
+    if not os.path.isdir(src):
+        copy_file(src, dst, throttle)
+        return
+    os.makedirs(dst, exist_ok=True)
+    for name in sorted(os.listdir(src)):
+        copy_tree(os.path.join(src, name), os.path.join(dst, name), throttle)
+
+
+def pull(args):
+    *srcs, dst = [arg for arg in args if not arg.startswith(b'-')]
+    throttle = Throttle()
+    for src in srcs:
+        local = ROOT + src
+        if not os.path.exists(local):
+            sys.stderr.write('adb: error: remote object %r does not exist\n' % src)
+            return 1
+        target = os.path.join(dst, os.path.basename(src)) if os.path.isdir(dst) else dst
+        copy_tree(local, target, throttle)
+    return 0
+
+
+def push(args):
+    src, dst = [arg for arg in args if not arg.startswith(b'-')]
+    local = ROOT + dst
+    os.makedirs(os.path.dirname(local), exist_ok=True)
+    copy_tree(src, local, Throttle())
+    return 0
+
+
+def run(command, binary):
+    # Like adbd's raw exec service, exec-out passes stderr in the same stream.
+    popen = subprocess.Popen([b'sh', b'-c', SHELL_PRELUDE + to_local(command)],
+                             stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT if binary else None)
+    throttle = Throttle()
+    out = sys.stdout.buffer
+    if binary:
+        copy_data(popen.stdout, out, throttle)
+    else:
+        for line in popen.stdout:
+            throttle.Pass(len(line))
+            out.write(to_device(line))
+    out.flush()
+    return popen.wait()
+
+
+def session():
+    popen = subprocess.Popen([b'sh'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    popen.stdin.write(SHELL_PRELUDE)
+    popen.stdin.flush()
+
+    def Feed():
+        for line in sys.stdin.buffer:
+            log('session')
+            delay('session')
+            popen.stdin.write(to_local(line))
+            popen.stdin.flush()
+        popen.stdin.close()
+
+    threading.Thread(target=Feed, daemon=True).start()
+    throttle = Throttle()
+    out = sys.stdout.buffer
+    # Output always ends with the session's marker line, so lines never wait.
+    for line in popen.stdout:
+        throttle.Pass(len(line))
+        out.write(to_device(line))
+        out.flush()
+    return popen.wait()
+
+
+def main():
+    args = [os.fsencode(arg) for arg in sys.argv[1:]]
+    if args[:1] == [b'-s']:
+        if args[1].decode() != SERIAL:
+            sys.stderr.write("adb: device '%s' not found\n" % args[1].decode())
+            return 1
+        args = args[2:]
+    if not args:
+        sys.stderr.write('adb: no command\n')
+        return 1
+    command = args[0].decode()
+    log(command)
+    delay(command)
+    if command == 'devices':
+        print('List of devices attached\n%s\tdevice\n' % SERIAL)
+        return 0
+    if command == 'get-serialno':
+        print(SERIAL)
+        return 0
+    if not ROOT:
+        sys.stderr.write('FAKE_ADB_ROOT is not set\n')
+        return 1
+    if command == 'pull':
+        return pull(args[1:])
+    if command == 'push':
+        return push(args[1:])
+    if command in ('shell', 'exec-out'):
+        if len(args) == 1:
+            return session()
+        return run(b' '.join(args[1:]), binary=command == 'exec-out')
+    sys.stderr.write('adb: unknown command %s\n' % command)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
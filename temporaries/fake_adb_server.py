@@ -0,0 +1,275 @@
+"""A stand-in for the adb server, serving one fake device from a directory tree.
+
+Speaks enough of the smart socket protocol for AdbSocketFileSystem:
+host:version, host:devices, host:features, host:get-serialno (also as
+host-serial:SERIAL:...), host:transport-any and host:transport:SERIAL, then
+the device services sync: (LIST, LIS2, STAT, LST2, STA2, RECV, SEND, QUIT),
+shell:COMMAND and exec:COMMAND, with exec:sh as an interactive shell.
+
+The device tree, path rewriting and latencies are those of fake_adb.py:
+
+  python -m temporaries.fake_adb_server ROOT [--port 5037] [--v1]
+
+Or from Python, serve() runs it on a thread.
+"""
+import argparse
+import errno
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+
+from temporaries import fake_adb
+
+SYNC_DATA_MAX = 64 * 1024
+HEADER = struct.Struct('<4sI')
+STAT_V1 = struct.Struct('<III')
+DENT_V1 = struct.Struct('<IIII')
+STAT_V2 = struct.Struct('<IQQIIIIQqqq')
+DENT_V2 = struct.Struct('<IQQIIIIQqqqI')
+
+
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, root, serial, v2):
+        super().__init__(address, Handler)
+        self.root = os.fsencode(root)
+        self.serial = serial
+        self.features = ['shell_v2', 'cmd'] + (['stat_v2', 'ls_v2'] if v2 else [])
+
+
+class Handler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        # Replies are written in pieces; without this each waits for an ACK.
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def recv_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def read_request(self):
+        return self.recv_exactly(int(self.recv_exactly(4), 16))
+
+    def okay(self, reply=None):
+        self.request.sendall(b'OKAY' if reply is None else b'OKAY%04x%s' % (len(reply), reply))
+
+    def fail(self, message):
+        self.request.sendall(b'FAIL%04x%s' % (len(message), message))
+
+    def handle(self):
+        try:
+            self.serve_request(self.read_request())
+        except (EOFError, ConnectionError):
+            pass
+
+    def serve_request(self, request):
+        serial = self.server.serial.encode()
+        host_serial = b'host-serial:' + serial + b':'
+        if request.startswith(host_serial):
+            request = b'host:' + request[len(host_serial):]
+        if request == b'host:version':
+            self.okay(b'0029')
+        elif request == b'host:devices':
+            self.okay(serial + b'\tdevice\n')
+        elif request == b'host:features':
+            self.okay(','.join(self.server.features).encode())
+        elif request == b'host:get-serialno':
+            self.okay(serial)
+        elif request in (b'host:transport-any', b'host:transport:' + serial):
+            self.okay()
+            self.serve_service(self.read_request())
+        elif request.startswith(b'host:transport:'):
+            self.fail(b"device '%s' not found" % (request[len(b'host:transport:'):],))
+        else:
+            self.fail(b'unknown host service')
+
+    def serve_service(self, service):
+        fake_adb.ROOT = self.server.root
+        if service == b'sync:':
+            self.okay()
+            self.serve_sync()
+        elif service == b'exec:sh':
+            self.okay()
+            self.serve_session()
+        elif service.startswith((b'shell:', b'exec:')):
+            kind, command = service.split(b':', 1)
+            self.okay()
+            fake_adb.log(kind.decode())
+            fake_adb.delay(kind.decode())
+            self.serve_command(command, binary=kind == b'exec')
+        else:
+            self.fail(b'unknown device service')
+
+    def serve_command(self, command, binary):
+        popen = subprocess.Popen([b'sh', b'-c', fake_adb.SHELL_PRELUDE + fake_adb.to_local(command)],
+                                 stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+        throttle = fake_adb.Throttle()
+        try:
+            if binary:
+                while chunk := popen.stdout.read(SYNC_DATA_MAX):
+                    throttle.Pass(len(chunk))
+                    self.request.sendall(chunk)
+            else:
+                for line in popen.stdout:
+                    throttle.Pass(len(line))
+                    self.request.sendall(fake_adb.to_device(line))
+        finally:
+            popen.stdout.close()
+            popen.wait()
+
+    def serve_session(self):
+        popen = subprocess.Popen([b'sh'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        popen.stdin.write(fake_adb.SHELL_PRELUDE)
+        popen.stdin.flush()
+
+        def Feed():
+            try:
+                for line in self.request.makefile('rb'):
+                    fake_adb.log('session')
+                    fake_adb.delay('session')
+                    popen.stdin.write(fake_adb.to_local(line))
+                    popen.stdin.flush()
+            except (OSError, ValueError):
+                pass
+            try:
+                popen.stdin.close()
+            except OSError:
+                pass
+
+        threading.Thread(target=Feed, daemon=True).start()
+        try:
+            for line in popen.stdout:
+                self.request.sendall(fake_adb.to_device(line))
+        except OSError:
+            popen.kill()
+        popen.wait()
+
+    def serve_sync(self):
+        while True:
+            msg_id, length = HEADER.unpack(self.recv_exactly(HEADER.size))
+            if msg_id == b'QUIT':
+                return
+            path = self.recv_exactly(length)
+            fake_adb.log('sync ' + msg_id.decode())
+            fake_adb.delay('sync')
+            if msg_id in (b'LIST', b'LIS2'):
+                self.sync_list(path, v2=msg_id == b'LIS2')
+            elif msg_id == b'STAT':
+                try:
+                    s = os.lstat(self.server.root + path)
+                    self.request.sendall(b'STAT' + STAT_V1.pack(
+                        s.st_mode, s.st_size & 0xffffffff, int(s.st_mtime) & 0xffffffff))
+                except OSError:
+                    self.request.sendall(b'STAT' + STAT_V1.pack(0, 0, 0))
+            elif msg_id in (b'LST2', b'STA2'):
+                try:
+                    local = self.server.root + path
+                    s = os.lstat(local) if msg_id == b'LST2' else os.stat(local)
+                    self.request.sendall(msg_id + STAT_V2.pack(0, *stat_v2_fields(s)))
+                except OSError as e:
+                    self.request.sendall(msg_id + STAT_V2.pack(e.errno or errno.EIO, *[0] * 10))
+            elif msg_id == b'RECV':
+                self.sync_recv(path)
+            elif msg_id == b'SEND':
+                self.sync_send(path)
+            else:
+                self.sync_fail(b'unknown sync request')
+                return
+
+    def sync_list(self, path, v2):
+        local = self.server.root + path
+        try:
+            names = [b'.', b'..'] + os.listdir(local)
+        except OSError:
+            names = []
+        for name in names:
+            try:
+                s = os.lstat(os.path.join(local, name))
+            except OSError:
+                continue
+            if v2:
+                self.request.sendall(b'DNT2' + DENT_V2.pack(0, *stat_v2_fields(s), len(name)) + name)
+            else:
+                self.request.sendall(b'DENT' + DENT_V1.pack(
+                    s.st_mode, s.st_size & 0xffffffff, int(s.st_mtime) & 0xffffffff, len(name)) + name)
+        dent = DENT_V2 if v2 else DENT_V1
+        self.request.sendall(b'DONE' + b'\0' * dent.size)
+
+    def sync_recv(self, path):
+        try:
+            f = open(self.server.root + path, 'rb')
+        except OSError as e:
+            self.sync_fail(os.strerror(e.errno).encode())
+            return
+        throttle = fake_adb.Throttle()
+        with f:
+            while chunk := f.read(SYNC_DATA_MAX):
+                throttle.Pass(len(chunk))
+                self.request.sendall(HEADER.pack(b'DATA', len(chunk)) + chunk)
+        self.request.sendall(HEADER.pack(b'DONE', 0))
+
+    def sync_send(self, spec):
+        path, mode = spec.rsplit(b',', 1)
+        local = self.server.root + path
+        chunks = []
+        throttle = fake_adb.Throttle()
+        while True:
+            msg_id, length = HEADER.unpack(self.recv_exactly(HEADER.size))
+            if msg_id == b'DONE':
+                mtime = length
+                break
+            chunks.append(self.recv_exactly(length))
+            throttle.Pass(length)
+        try:
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            with open(local, 'wb') as f:
+                f.write(b''.join(chunks))
+            os.chmod(local, int(mode) & 0o777)
+            os.utime(local, (mtime, mtime))
+        except OSError as e:
+            self.sync_fail(os.strerror(e.errno).encode())
+            return
+        self.request.sendall(HEADER.pack(b'OKAY', 0))
+
+    def sync_fail(self, message):
+        self.request.sendall(HEADER.pack(b'FAIL', len(message)) + message)
+
+
+def stat_v2_fields(s):
+    return (s.st_dev, s.st_ino, s.st_mode, s.st_nlink, s.st_uid, s.st_gid, s.st_size,
+            int(s.st_atime), int(s.st_mtime), int(s.st_ctime))
+
+
+def serve(root, port=0, serial='FAKE0001', v2=True):
+    """Starts a server on a thread; returns it, with its port in server_address."""
+    server = FakeAdbServer(('127.0.0.1', port), root, serial, v2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('root')
+    parser.add_argument('--port', type=int, default=5037)
+    parser.add_argument('--serial', default='FAKE0001')
+    parser.add_argument('--v1', action='store_true', help='leave out stat_v2 and ls_v2')
+    args = parser.parse_args()
+    server = FakeAdbServer(('127.0.0.1', args.port), args.root, args.serial, not args.v1)
+    sys.stderr.write('Serving {} on port {}\n'.format(args.root, server.server_address[1]))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
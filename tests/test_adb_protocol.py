@@ -0,0 +1,131 @@
+"""Tests for the adb smart socket and sync protocols, against temporaries/fake_adb_server.py."""
+import errno
+import io
+import os
+import socket
+import stat
+import struct
+import shutil
+import tempfile
+import unittest
+
+from adb.adb_protocol import SYNC_DATA_MAX, AdbServer, SyncConnection
+from temporaries import fake_adb_server
+
+MTIME = 1700000000
+# More than two DATA messages.
+CONTENTS = bytes(range(256)) * (SYNC_DATA_MAX // 128 + 7)
+
+
+class SyncProtocolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = os.fsencode(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root)
+        self.dcim = self.root + b'/sdcard/DCIM'
+        os.makedirs(self.dcim + b'/sub')
+        with open(self.dcim + b'/a.jpg', 'wb') as f:
+            f.write(CONTENTS)
+        os.utime(self.dcim + b'/a.jpg', (MTIME, MTIME))
+        os.symlink(b'a.jpg', self.dcim + b'/link')
+
+    def Connect(self, v2=True, serial=None):
+        server = fake_adb_server.serve(self.root, v2=v2)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        adb = AdbServer(serial, port=server.server_address[1])
+        sync = SyncConnection(adb.Open(b'sync:'), adb.Features())
+        self.addCleanup(sync.Close)
+        return sync
+
+    def CheckListing(self, entries):
+        by_name = dict(entries)
+        self.assertEqual(sorted(by_name), [b'.', b'..', b'a.jpg', b'link', b'sub'])
+        self.assertTrue(stat.S_ISREG(by_name[b'a.jpg'].st_mode))
+        self.assertEqual(by_name[b'a.jpg'].st_size, len(CONTENTS))
+        self.assertEqual(by_name[b'a.jpg'].st_mtime, MTIME)
+        self.assertTrue(stat.S_ISDIR(by_name[b'sub'].st_mode))
+        self.assertTrue(stat.S_ISLNK(by_name[b'link'].st_mode))
+
+    def testListV1(self):
+        self.CheckListing(self.Connect(v2=False).List(b'/sdcard/DCIM'))
+
+    def testListV2(self):
+        self.CheckListing(self.Connect().List(b'/sdcard/DCIM'))
+
+    def testListMissing(self):
+        sync = self.Connect()
+        with self.assertRaises(OSError) as raised:
+            sync.List(b'/sdcard/missing')
+        self.assertEqual(raised.exception.errno, errno.EACCES)
+        # Nothing of the failed listing is left in the stream.
+        self.assertEqual(len(sync.List(b'/sdcard/DCIM')), 5)
+
+    def testStatV1(self):
+        sync = self.Connect(v2=False)
+        s = sync.Lstat(b'/sdcard/DCIM/a.jpg')
+        self.assertEqual((stat.S_IFMT(s.st_mode), s.st_size, s.st_mtime),
+                         (stat.S_IFREG, len(CONTENTS), MTIME))
+        self.assertTrue(stat.S_ISLNK(sync.Lstat(b'/sdcard/DCIM/link').st_mode))
+        with self.assertRaises(OSError) as raised:
+            sync.Lstat(b'/sdcard/DCIM/missing')
+        self.assertEqual(raised.exception.errno, errno.ENOENT)
+
+    def testStatV2(self):
+        sync = self.Connect()
+        self.assertTrue(stat.S_ISLNK(sync.Lstat(b'/sdcard/DCIM/link').st_mode))
+        s = sync.Stat(b'/sdcard/DCIM/link')
+        self.assertEqual((stat.S_IFMT(s.st_mode), s.st_size, s.st_mtime),
+                         (stat.S_IFREG, len(CONTENTS), MTIME))
+        with self.assertRaises(OSError) as raised:
+            sync.Stat(b'/sdcard/DCIM/missing')
+        self.assertEqual(raised.exception.errno, errno.ENOENT)
+
+    def testRecv(self):
+        sync = self.Connect()
+        f = io.BytesIO()
+        self.assertEqual(sync.Recv(b'/sdcard/DCIM/a.jpg', f), len(CONTENTS))
+        self.assertEqual(f.getvalue(), CONTENTS)
+
+    def testRecvFail(self):
+        with self.assertRaisesRegex(OSError, 'pull failed: No such file'):
+            self.Connect().Recv(b'/sdcard/DCIM/missing', io.BytesIO())
+
+    def testSend(self):
+        sync = self.Connect()
+        sync.Send(io.BytesIO(CONTENTS), b'/sdcard/new/b.jpg', 0o100640, MTIME + 1)
+        with open(self.root + b'/sdcard/new/b.jpg', 'rb') as f:
+            self.assertEqual(f.read(), CONTENTS)
+        s = os.stat(self.root + b'/sdcard/new/b.jpg')
+        self.assertEqual((stat.S_IMODE(s.st_mode), s.st_mtime), (0o640, MTIME + 1))
+
+    def testSendFail(self):
+        # The parent directory is a file.
+        with self.assertRaisesRegex(OSError, 'push failed'):
+            self.Connect().Send(io.BytesIO(b'x'), b'/sdcard/DCIM/a.jpg/b', 0o100644, MTIME)
+
+    def testUnknownDevice(self):
+        with self.assertRaisesRegex(OSError, "adb: device 'NOPE' not found"):
+            self.Connect(serial='NOPE')
+
+    def testConnectionClosed(self):
+        # The device stops in the middle of a DATA message.
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        theirs.sendall(struct.pack('<4sI', b'DATA', 100) + b'x' * 10)
+        theirs.shutdown(socket.SHUT_WR)
+        with self.assertRaisesRegex(OSError, 'connection closed'):
+            SyncConnection(ours, set()).Recv(b'/sdcard/a', io.BytesIO())
+
+    def testUnexpectedMessage(self):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        theirs.sendall(b'XXXX' + b'\0' * 12)
+        with self.assertRaisesRegex(OSError, 'Unexpected sync message'):
+            SyncConnection(ours, set()).Lstat(b'/sdcard/a')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""Tests for pulls interrupted in either pass of a backup, and resumed."""
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from adb.adb_file_system import AdbFileSystem
+from adb.file_syncer import FixPath
+from adb.meow_bak import do_sync_split
+from adb.sync_config import SyncConfig
+
+FAKE_ADB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'temporaries', 'fake_adb.py')
+SIZE = 4 * AdbFileSystem.RESUME_BLOCK_SIZE + 123
+DAY = 24 * 3600
+
+
+class DroppedStream(object):
+    """Passes on the first limit bytes of a stream, then fails like a lost connection."""
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+
+    def read(self, size=-1):
+        if self.limit <= 0:
+            raise OSError('device disconnected')
+        chunk = self.stream.read(min(size, self.limit) if size >= 0 else self.limit)
+        self.limit -= len(chunk)
+        return chunk
+
+
+class ResumablePullTest(unittest.TestCase):
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.home)
+        self.device = os.path.join(self.home, 'device', 'sdcard', 'DCIM')
+        os.makedirs(self.device)
+        os.environ['FAKE_ADB_ROOT'] = os.path.join(self.home, 'device')
+        self.addCleanup(os.environ.pop, 'FAKE_ADB_ROOT')
+        self.to_time = int(time.time()) - 30 * DAY
+        # One file for each pass: moved to 'storage', and copied to 'storage-keep'.
+        self.contents = {}
+        for name, mtime in [('old.mp4', self.to_time - DAY), ('new.mp4', self.to_time + DAY)]:
+            self.contents[name] = os.urandom(SIZE)
+            path = os.path.join(self.device, name)
+            with open(path, 'wb') as f:
+                f.write(self.contents[name])
+            os.utime(path, (mtime, mtime))
+        self.fs = AdbFileSystem([sys.executable.encode(), FAKE_ADB.encode()])
+        self.addCleanup(self.fs.Close)
+
+    def Sync(self):
+        targets = []
+        for storage, time_range, del_source in [('storage', [0, self.to_time], True),
+                                                ('storage-keep', [self.to_time, None], False)]:
+            cfg = SyncConfig(excludes=['.*'], remote_to_local=True, del_source=del_source,
+                             allow_replace=True, time_range=time_range, resumable_pulls=True)
+            src, dst = FixPath(b'/sdcard/DCIM', os.fsencode(os.path.join(self.home, storage)))
+            os.makedirs(dst, exist_ok=True)
+            targets.append((dst, cfg, None, None))
+        do_sync_split(self.fs, src, targets)
+
+    @contextlib.contextmanager
+    def Interrupted(self, name):
+        """Cuts pulls of name streamed through 'exec-out' short, as if the device was unplugged."""
+        stream = self.fs._Stream
+
+        @contextlib.contextmanager
+        def Dropping(service, command, check=True):
+            with stream(service, command, check=check) as stdout:
+                if service == b'exec-out' and name.encode() in command:
+                    stdout = DroppedStream(stdout, 2 * AdbFileSystem.RESUME_BLOCK_SIZE + 10)
+                yield stdout
+
+        self.fs._Stream = Dropping
+        try:
+            yield
+        finally:
+            del self.fs._Stream
+
+    def Part(self, storage, name):
+        return os.path.join(self.home, storage, 'DCIM', name) + os.fsdecode(AdbFileSystem.PART_SUFFIX)
+
+    def Interrupt(self, storage, name):
+        with self.Interrupted(name):
+            with self.assertRaises(OSError):
+                self.Sync()
+        self.assertGreater(os.path.getsize(self.Part(storage, name)), 0)
+
+    def testResumedInStoragePass(self):
+        self.Interrupt('storage', 'old.mp4')
+        self.Sync()
+        with open(os.path.join(self.home, 'storage', 'DCIM', 'old.mp4'), 'rb') as f:
+            self.assertEqual(f.read(), self.contents['old.mp4'])
+        self.assertFalse(os.path.exists(self.Part('storage', 'old.mp4')))
+        self.assertEqual(os.listdir(self.device), ['new.mp4'])
+
+    def testResumedInKeepPass(self):
+        self.Interrupt('storage-keep', 'new.mp4')
+        self.Sync()
+        with open(os.path.join(self.home, 'storage-keep', 'DCIM', 'new.mp4'), 'rb') as f:
+            self.assertEqual(f.read(), self.contents['new.mp4'])
+        self.assertFalse(os.path.exists(self.Part('storage-keep', 'new.mp4')))
+
+    def testStalePartDeletedInStoragePass(self):
+        self.Interrupt('storage', 'old.mp4')
+        # The source is gone before the next backup, e.g. deleted on the phone.
+        os.unlink(os.path.join(self.device, 'old.mp4'))
+        self.Sync()
+        self.assertFalse(os.path.exists(self.Part('storage', 'old.mp4')))
+
+    def testStalePartDeletedInKeepPass(self):
+        self.Interrupt('storage-keep', 'new.mp4')
+        os.unlink(os.path.join(self.device, 'new.mp4'))
+        self.Sync()
+        self.assertFalse(os.path.exists(self.Part('storage-keep', 'new.mp4')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""Tests for listing whole trees with AdbFileSystem.PrefetchTree()."""
+import contextlib
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from adb.adb_file_system import AdbFileSystem
+
+
+class CountingStream(object):
+    """Hands out a command's output a line per read, counting the lines read."""
+
+    def __init__(self, output):
+        self.lines = output.splitlines(keepends=True)
+        self.read = 0
+
+    def read1(self, size=-1):
+        if self.read == len(self.lines):
+            return b''
+        self.read += 1
+        return self.lines[self.read - 1]
+
+
+@unittest.skipUnless(shutil.which('find') and shutil.which('stat'), 'needs find and stat')
+class TreeListingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = os.fsencode(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root)
+        for i in range(20):
+            os.makedirs(b'%s/d%02d/sub' % (self.root, i))
+            with open(b'%s/d%02d/file' % (self.root, i), 'wb'):
+                pass
+        self.fs = AdbFileSystem([b'adb'], stat_backend=True)
+        self.streams = []
+        self.fs._Stream = self._Stream
+
+    @contextlib.contextmanager
+    def _Stream(self, service, command, check=True):
+        # Runs device commands locally; the tree listing only uses find and stat.
+        stream = CountingStream(subprocess.check_output([b'sh', b'-c', command]))
+        self.streams.append(stream)
+        yield stream
+
+    def testRootListedBeforeTheRest(self):
+        self.fs.PrefetchTree(self.root)
+        names = sorted(self.fs.listdir(self.root))
+        self.assertEqual(names, [b'd%02d' % i for i in range(20)])
+        self.assertLess(self.streams[0].read, len(self.streams[0].lines) // 4)
+        self.assertEqual(self.fs.listdir_cache, {})
+
+    def testAllDirectoriesListed(self):
+        self.fs.PrefetchTree(self.root)
+        listed = {directory: sorted(names) for directory, names in self.fs.ListTree(self.root)}
+        self.assertEqual(len(listed), 41)
+        self.assertEqual(listed[self.root + b'/d07'], [b'file', b'sub'])
+        self.assertEqual(listed[self.root + b'/d07/sub'], [])
+        self.assertTrue(self.fs.lstat(self.root + b'/d07/sub').st_mode & 0o040000)
+
+    def testCutShortSectionLeftOut(self):
+        lines = [b'/r:', b'1 2 81a4 /r/a', b'', b'/r/b:', b'1 2 81a4 /r/b/c']
+        self.assertEqual(list(self.fs.ParseStatTree(lines, b'/r')), [(b'/r', [b'a'])])
+
+
+if __name__ == '__main__':
+    unittest.main()